@@ -1,25 +1,9 @@
 import streamlit as st
 import ui
 import content
-import processing
-import calculator
-import visualization
-import numpy as np 
-import matplotlib 
-
-# Set Matplotlib backend (good practice for Streamlit)
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-import matplotlib.colors as colors
-import matplotlib.cm as cmx
-import matplotlib.colorbar
-import pandas as pd
-import plotly.graph_objects as go
-import plotly.express as px
-import tempfile
-import os
-import zipfile
-from io import BytesIO
+# The modules of the other views (processing, calculator, visualization) and
+# their dependencies are imported by the tab that uses them, so that the
+# first page is shown without loading pandas, plotly or osmium.
 
 # Page Config
 st.set_page_config(page_title="Advanced Traffic Emission Calculator", layout="wide", initial_sidebar_state="expanded")
@@ -32,6 +16,8 @@ ui.display_header()
 inputs = ui.render_sidebar()
 
 # 3. Main Tabs
+# Only the open tab runs: switching tabs reruns the app, and the widgets of
+# the analysis, map and download views only rerun their own fragment.
 tab1, tab2, tab3, tab4, tab5, tab6, tab7 = st.tabs([
     "📖 Instructions",
     "📊 Data Preview",
@@ -40,39 +26,51 @@ tab1, tab2, tab3, tab4, tab5, tab6, tab7 = st.tabs([
     "📈 Multi-Metric Analysis",
     "🗺️ Interactive Map",
     "📥 Download Results"
-])
+], on_change="rerun", key="active_tab")
 
 # --- TAB LOGIC ---
 
 # Tab 1: Instructions
-with tab1:
-    content.render_instructions()
+if tab1.open:
+    with tab1:
+        content.render_instructions()
 
 # Tab 2: Data Preview
-with tab2:
-    # We pass the file object for the Link Data for preview
-    processing.preview_data(inputs['link_osm'])
+if tab2.open:
+    import processing
+    with tab2:
+        # We pass the file object for the Link Data for preview
+        processing.preview_data(inputs['link_osm'], inputs['osm_file'], inputs['map_params'])
 
 # Tab 3: Formulas
-with tab3:
-    # Pass BOTH the 'accuracy' settings AND the 'pollutants_available' dictionary
-    content.render_formulas(inputs['accuracy'], inputs['pollutants_available'])
+if tab3.open:
+    with tab3:
+        # Pass BOTH the 'accuracy' settings AND the 'pollutants_available' dictionary
+        content.render_formulas(inputs['accuracy'], inputs['pollutants_available'])
 
 # Tab 4: Calculation (The Core Logic)
-with tab4:
-    calculator.run_calculations(inputs)
+if tab4.open:
+    import calculator
+    with tab4:
+        calculator.run_calculations(inputs)
 
 # Tab 5: Analysis
-with tab5:
-    visualization.render_analysis()
+if tab5.open:
+    import visualization
+    with tab5:
+        visualization.render_analysis()
 
 # Tab 6: Map
-with tab6:
-    visualization.render_map(inputs['osm_file'], inputs['map_params'])
+if tab6.open:
+    import visualization
+    with tab6:
+        visualization.render_map(inputs['osm_file'], inputs['map_params'])
 
 # Tab 7: Download
-with tab7:
-    visualization.render_downloads(inputs['methodology'], inputs['selected_pollutants'])
+if tab7.open:
+    import visualization
+    with tab7:
+        visualization.render_downloads(inputs['methodology'], inputs['selected_pollutants'], inputs['osm_file'], inputs['map_params'])
 
 # Footer
 st.markdown("---")
@@ -0,0 +1,148 @@
+# Emission calculation in a background thread, so that the application stays
+# responsive during long runs: the script run that starts a CalculationJob
+# returns at once, and the later reruns poll its progress, cancel it or read
+# the results of the links done so far. The job is kept in the session state,
+# so a rerun (a widget change, another tab) neither stops nor loses it.
+#
+# A thread is used rather than a process: the uploads and the results are
+# shared without copies, and the emission loop gives the GIL back to the
+# server every sys.getswitchinterval().
+
+import contextlib
+import io
+import threading
+import time
+
+import numpy as np
+
+import engine
+import instrumentation
+import profiling
+
+RUNNING = "running"
+DONE = "done"
+CANCELLED = "cancelled"
+FAILED = "failed"
+
+
+class CalculationJob(object):
+    """
+    One run of engine.run in a background thread. 'link_table' is the table
+    of processing.read_link_table; the other arguments are those of
+    engine.run. The stages are recorded for the Performance panel, after
+    the 'spans' recorded before the job (e.g., the decoding of the upload),
+    and the emission loop is profiled if 'profile' is True.
+    """
+    def __init__(self, link_table, selected_pollutants, files=None, accuracy=None,
+                 trace_memory=False, profile=False, spans=None):
+        self.selected_pollutants = list(selected_pollutants)
+        self.accuracy = accuracy
+        # The uploads are copied: the script thread reads them too.
+        self.files = {key: io.BytesIO(source.getvalue()) if hasattr(source, "getvalue") else source
+                      for key, source in (files or {}).items()}
+        self.trace_memory = trace_memory
+        self.profile = profile
+        self.spans = list(spans or [])
+        self.link_table = link_table
+        self.data_link = link_table.to_numpy(dtype=np.float64)
+        self.total = self.data_link.shape[0]
+        self.done = 0
+        # Filled link after link by the emission loop.
+        self.emissions_data = engine.allocate_emissions(self.selected_pollutants, self.total)
+        self.state = RUNNING
+        # Set by the application once it has stored the results.
+        self.collected = False
+        self.error = None
+        self.results_df = None
+        self.performance = None
+        self.profile_data = None
+        self.started = None
+        self.finished = None
+        self._loop_started = None
+        self._cancel = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="emission-calculation",
+                                        daemon=True)
+
+    def start(self):
+        self.started = time.perf_counter()
+        self._thread.start()
+        return self
+
+    def cancel(self):
+        """
+        Stops the emission loop at its next progress step; the links done so
+        far are kept (see 'partial_results').
+        """
+        self._cancel.set()
+
+    def running(self):
+        return self.state == RUNNING
+
+    def _progress(self, done, total):
+        if self._loop_started is None:
+            self._loop_started = time.perf_counter()
+        self.done = done
+
+    def _run(self):
+        try:
+            with instrumentation.recording(self.trace_memory) as recorder:
+                with profiling.profiling() if self.profile else contextlib.nullcontext() as profiler:
+                    try:
+                        self.results_df = engine.run(
+                            self.link_table, self.selected_pollutants, self.files,
+                            self.accuracy, self._progress, cancel=self._cancel,
+                            emissions_data=self.emissions_data)
+                        state = DONE
+                    except engine.Cancelled as e:
+                        self.done = e.links
+                        state = CANCELLED
+            self.performance = self.spans + recorder.to_dict()
+            if profiler is not None:
+                self.profile_data = (profiler.hot_paths(), profiler.collapsed())
+            self.state = state
+        except Exception as e:
+            self.error = e
+            self.state = FAILED
+        finally:
+            self.finished = time.perf_counter()
+
+    def elapsed(self):
+        """
+        Returns the time since the start of the job, in seconds.
+        """
+        if self.started is None:
+            return 0.
+        return (self.finished or time.perf_counter()) - self.started
+
+    def links_per_second(self):
+        """
+        Returns the throughput of the emission loop so far, in links per
+        second (None before its first progress step).
+        """
+        if self._loop_started is None or self.done == 0:
+            return None
+        seconds = (self.finished or time.perf_counter()) - self._loop_started
+        # The first step is not timed: the clock starts at its end.
+        done = self.done - min(engine.PROGRESS_LINKS, self.done)
+        return done / seconds if done > 0 and seconds > 0. else None
+
+    def remaining_seconds(self):
+        """
+        Returns an estimate of the time left in the emission loop, in seconds,
+        or None.
+        """
+        speed = self.links_per_second()
+        return None if speed is None else (self.total - self.done) / speed
+
+    def partial_results(self):
+        """
+        Returns the results table of the links done so far (all of them once
+        the job is done).
+        """
+        if self.results_df is not None:
+            return self.results_df
+        done = self.done
+        emissions_data = {poll: {category: values[:done] for category, values in data.items()}
+                          for poll, data in self.emissions_data.items()}
+        return engine.build_results_frame(self.data_link[:done], emissions_data,
+                                          self.selected_pollutants)
@@ -0,0 +1,248 @@
+# Batch runner of the emission calculation: runs the jobs of a manifest (one
+# city or scenario per job) in a pool of worker processes. The completed jobs
+# are recorded in a checkpoint file, so that an interrupted batch resumes
+# where it stopped when it is run again.
+#
+# Usage: python batch.py MANIFEST [--workers N] [--checkpoint FILE] [--restart]
+#            [--performance DIR]
+#
+# The manifest is a JSON object:
+#
+#     {"defaults": {"pollutants": ["CO", "NOx"], "accuracy": {...}},
+#      "jobs": [{"name": "paris", "link_file": "paris/links.txt",
+#                "output": "out/paris.parquet", "osm": "paris.osm.pbf",
+#                "zone": [[2.22, 48.81], [2.47, 48.81], [2.47, 48.91], [2.22, 48.91]],
+#                "files": {"pc": "paris/PC_parameter.csv", ...},
+#                "settings": "paris/settings.json"}, ...]}
+#
+# "link_file" and "output" are required; the other keys are optional and are
+# those of the settings files of cli.py, plus "osm", "zone" (study-area
+# polygon of [lon, lat] points, at which the roads are clipped), "compression",
+# "tolerance" (margin around the zone) and "ncore". The "defaults" apply to
+# every job. Paths are relative to the manifest.
+
+import argparse
+import concurrent.futures
+import json
+import os
+import sys
+import time
+
+import cli
+import engine
+import export
+import instrumentation
+
+# Copert instances of the worker process, by parameter files.
+_copert_instances = {}
+
+
+def parameter_key(files):
+    """
+    Returns the paths of the parameter files of a job (None for a default
+    file), which identify its Copert instance.
+    """
+    return tuple(files.get(key) for key in engine.PARAMETER_FILES)
+
+
+def worker_copert(key):
+    """
+    Returns the Copert instance of the worker for the parameter files 'key'
+    (see 'parameter_key'), which is loaded once per worker.
+    """
+    if key not in _copert_instances:
+        _copert_instances[key] = engine.load_copert(*key)
+    return _copert_instances[key]
+
+
+def _init_worker(keys):
+    # Loads the parameter files of the batch before the first job.
+    for key in keys:
+        worker_copert(key)
+
+
+def load_manifest(path):
+    """
+    Reads a manifest and returns its jobs, with the defaults and the settings
+    files applied and the paths made relative to the current directory.
+    """
+    with open(path) as f:
+        manifest = json.load(f)
+    directory = os.path.dirname(os.path.abspath(path))
+
+    def resolve(value):
+        return None if value is None else os.path.join(directory, value)
+
+    jobs, names = [], set()
+    for i, entry in enumerate(manifest.get("jobs", [])):
+        entry = dict(manifest.get("defaults", {}), **entry)
+        for key in ("link_file", "output"):
+            if key not in entry:
+                raise ValueError("Job {0} of the manifest has no '{1}'.".format(i, key))
+        if entry.get("zone") is not None and len(entry["zone"]) < 3:
+            raise ValueError("The zone of job {0} of the manifest needs at least 3 points.".format(i))
+        settings = cli.load_settings(resolve(entry["settings"])) if "settings" in entry else {}
+        files = dict(settings.get("files", {}))
+        files.update({key: resolve(value) for key, value in entry.get("files", {}).items()})
+        job = {
+            "name": entry.get("name", os.path.splitext(os.path.basename(entry["output"]))[0]),
+            "link_file": resolve(entry["link_file"]),
+            "output": resolve(entry["output"]),
+            "osm": resolve(entry.get("osm")),
+            "files": files,
+            "pollutants": entry.get("pollutants") or settings.get("pollutants")
+                          or list(engine.POLLUTANTS),
+            "accuracy": dict(engine.DEFAULT_ACCURACY, **settings.get("accuracy", {}),
+                             **entry.get("accuracy", {})),
+            "compression": entry.get("compression"),
+            "zone": None if entry.get("zone") is None
+                    else [(float(lon), float(lat)) for lon, lat in entry["zone"]],
+            "tolerance": entry.get("tolerance", 0.005),
+            "ncore": entry.get("ncore", 1),
+        }
+        if job["name"] in names:
+            raise ValueError("Two jobs of the manifest are named '{0}'.".format(job["name"]))
+        names.add(job["name"])
+        jobs.append(job)
+    return jobs
+
+
+def run_job(job, performance_dir=None, trace_memory=False):
+    """
+    Runs one job in a worker process and writes its output. Returns a summary
+    of the run, with the wall time of its stages. The timing and memory of
+    every stage are written to 'performance_dir'/NAME.json if a directory is
+    given.
+    """
+    start = time.perf_counter()
+    file_format = export.file_format_of(job["output"])
+    if file_format in export.GIS_FORMATS and job["osm"] is None:
+        raise ValueError("The {0} format needs an 'osm' file.".format(file_format))
+    with instrumentation.recording(trace_memory) as recorder:
+        results_df = engine.run(job["link_file"], job["pollutants"], job["files"], job["accuracy"],
+                                cop=worker_copert(parameter_key(job["files"])))
+        network = None
+        if file_format in export.GIS_FORMATS:
+            network = engine.load_network(job["osm"], job["zone"], job["tolerance"], job["ncore"])
+        # The output is complete when it appears under its name.
+        os.makedirs(os.path.dirname(job["output"]) or ".", exist_ok=True)
+        partial = job["output"] + ".part"
+        export.write_results(results_df, partial, file_format, job["compression"], network)
+        os.replace(partial, job["output"])
+    if performance_dir is not None:
+        os.makedirs(performance_dir, exist_ok=True)
+        recorder.write_json(os.path.join(performance_dir, job["name"] + ".json"), job=job)
+    return {"links": len(results_df), "seconds": round(time.perf_counter() - start, 3),
+            "stages": {name: round(seconds, 3) for name, seconds in recorder.totals().items()}}
+
+
+def read_checkpoint(path):
+    """
+    Returns the records of the checkpoint file, by job name (the last record
+    of a job wins).
+    """
+    records = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    record = json.loads(line)
+                    records[record["name"]] = record
+    return records
+
+
+def _append_checkpoint(path, record):
+    with open(path, "a") as f:
+        f.write(json.dumps(record) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def pending_jobs(jobs, checkpoint):
+    """
+    Returns the jobs that are not recorded as done in the checkpoint file or
+    whose output was removed.
+    """
+    records = read_checkpoint(checkpoint)
+    return [job for job in jobs
+            if records.get(job["name"], {}).get("status") != "done"
+            or not os.path.exists(job["output"])]
+
+
+def run_batch(jobs, checkpoint, workers=None, report=print, performance_dir=None,
+              trace_memory=False):
+    """
+    Runs the jobs that are not done yet in a pool of 'workers' processes (the
+    number of CPUs by default), recording every finished job in the
+    checkpoint file. Returns the number of failed jobs.
+    """
+    todo = pending_jobs(jobs, checkpoint)
+    report("{0} jobs, {1} to run".format(len(jobs), len(todo)))
+    if not todo:
+        return 0
+    keys = sorted({parameter_key(job["files"]) for job in todo},
+                  key=lambda key: [str(path) for path in key])
+    failures = 0
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers, initializer=_init_worker, initargs=(keys,)) as pool:
+        futures = {pool.submit(run_job, job, performance_dir, trace_memory): job
+                   for job in todo}
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                job = futures[future]
+                record = {"name": job["name"], "output": job["output"]}
+                try:
+                    record.update(future.result(), status="done")
+                except Exception as e:
+                    record.update(status="failed", error=str(e))
+                    failures += 1
+                _append_checkpoint(checkpoint, record)
+                report("{0}: {1}".format(job["name"], record["status"] if "error" not in record
+                                         else "failed ({0})".format(record["error"])))
+        except KeyboardInterrupt:
+            # The jobs that did not start are dropped; the batch resumes
+            # from the checkpoint.
+            pool.shutdown(wait=False, cancel_futures=True)
+            raise
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Runs the emission calculation jobs of a manifest.")
+    parser.add_argument("manifest", help="JSON manifest of the jobs")
+    parser.add_argument("--workers", type=int,
+                        help="number of worker processes (default: number of CPUs)")
+    parser.add_argument("--checkpoint",
+                        help="checkpoint file (default: MANIFEST.checkpoint.jsonl)")
+    parser.add_argument("--restart", action="store_true",
+                        help="ignore the checkpoint and run every job")
+    parser.add_argument("--performance",
+                        help="directory of the timing and memory of the stages, one JSON "
+                        "file per job")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="measure the peak memory of the stages (slower)")
+    args = parser.parse_args(argv)
+
+    checkpoint = args.checkpoint or os.path.splitext(args.manifest)[0] + ".checkpoint.jsonl"
+    if args.restart and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    try:
+        jobs = load_manifest(args.manifest)
+    except (OSError, ValueError) as e:
+        print("error: {0}".format(e), file=sys.stderr)
+        return 1
+    start = time.perf_counter()
+    try:
+        failures = run_batch(jobs, checkpoint, args.workers,
+                             performance_dir=args.performance, trace_memory=args.trace_memory)
+    except KeyboardInterrupt:
+        print("interrupted; run again to resume from {0}".format(checkpoint), file=sys.stderr)
+        return 130
+    print("done in {0:.1f} s, {1} failed".format(time.perf_counter() - start, failures))
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
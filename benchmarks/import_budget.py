@@ -0,0 +1,125 @@
+# This script measures the import time of the modules of the application with
+# "python -X importtime", in a fresh interpreter per module, and checks it
+# against a budget. The modules of the first page must import quickly, and
+# the heavy packages must only be imported by the features that use them.
+#
+# Usage: python benchmarks/import_budget.py [--repeat N] [--json FILE]
+#
+# The exit status is 1 if a budget is exceeded or if a module imports one of
+# the LAZY_PACKAGES.
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Imported before the measured module: the cost of Streamlit and numpy is
+# paid by every page and is not counted.
+BASELINE_MODULES = ["streamlit", "numpy"]
+# Modules of the application, and their budget in milliseconds on top of the
+# baseline (None: reported only).
+MODULE_BUDGETS_MS = {
+    "ui": 50,
+    "content": 50,
+    "copert": 50,
+    "geometry": 50,
+    "processing": None,
+    "calculator": None,
+    "engine": None,
+    "visualization": None,
+    "export": None,
+    "tiles": None,
+    "gridding": None,
+}
+# Packages that no module may import when it is loaded (pyarrow is not
+# listed: pandas imports it when it is installed).
+LAZY_PACKAGES = ["matplotlib", "plotly.express"]
+
+
+def import_times(module, python=sys.executable):
+    """
+    Imports 'module' after the baseline modules in a new interpreter. Returns
+    the cumulative import time of the module, in milliseconds, and the self
+    time of every module it loaded.
+    """
+    code = "import {0}; import {1}".format(", ".join(BASELINE_MODULES),
+                                           module)
+    result = subprocess.run([python, "-X", "importtime", "-c", code],
+                            cwd=ROOT, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError("Cannot import {0}:\n{1}".format(module,
+                                                            result.stderr))
+    entries = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        entries.append((name.rstrip(), int(self_us), int(cumulative_us)))
+    # The lines are written when the imports complete: what follows the last
+    # baseline module was loaded by 'module'.
+    # Top-level imports are indented by one space.
+    start = max(i for i, (name, _, _) in enumerate(entries)
+                if name[1:] in BASELINE_MODULES) + 1
+    loaded = {name.strip(): self_us / 1000.
+              for name, self_us, _ in entries[start:]}
+    cumulative = sum(loaded.values())
+    return cumulative, loaded
+
+
+def package_times(loaded, count=5):
+    """
+    Returns the 'count' top-level packages with the largest import time.
+    """
+    packages = {}
+    for name, ms in loaded.items():
+        package = name.split(".")[0]
+        packages[package] = packages.get(package, 0.) + ms
+    return sorted(packages.items(), key=lambda item: -item[1])[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Checks the import time of the application modules.")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="number of measurements per module (the "
+                        "minimum is kept)")
+    parser.add_argument("--json", help="file to write the results to")
+    args = parser.parse_args()
+
+    report, failures = {}, []
+    for module, budget in MODULE_BUDGETS_MS.items():
+        runs = [import_times(module) for _ in range(args.repeat)]
+        cumulative, loaded = min(runs, key=lambda run: run[0])
+        eager = [p for p in LAZY_PACKAGES if p in loaded]
+        report[module] = {"import_ms": round(cumulative, 1),
+                          "budget_ms": budget,
+                          "packages_ms": {p: round(ms, 1) for p, ms
+                                          in package_times(loaded)},
+                          "eager_packages": eager}
+        status = "ok"
+        if budget is not None and cumulative > budget:
+            status = "OVER BUDGET"
+            failures.append("{0}: {1:.0f} ms > {2} ms".format(
+                module, cumulative, budget))
+        if eager:
+            status = "EAGER IMPORT"
+            failures.append("{0} imports {1}".format(module,
+                                                     ", ".join(eager)))
+        print("{0:<15} {1:8.1f} ms  {2:<12}  {3}".format(
+            module, cumulative, status, ", ".join(
+                "{0} {1:.0f}".format(p, ms)
+                for p, ms in package_times(loaded))))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    for failure in failures:
+        print("FAILED:", failure)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
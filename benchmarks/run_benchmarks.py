@@ -0,0 +1,265 @@
+# This script measures the performance of the emission calculation on
+# synthetic datasets (see synthetic.py) and writes the results as JSON, so
+# that runs on different commits can be compared.
+#
+# Usage: python benchmarks/run_benchmarks.py [--sizes N ...] [--only NAME ...]
+#            [--output FILE] [--compare FILE] [--data-dir DIR]
+#
+# Benchmarks:
+#   copert_init      Copert.__init__ with the default parameter files, and
+#                    the parsing of the class tables
+#   copert_ef        emission factor evaluation, per equation family
+#   link_ingestion   parsing of the link data file
+#   retrieve_highway road extraction from OSM XML and PBF files
+#   pipeline         engine.run on a dataset, with its Python peak memory
+#   queries          top-N links and region queries of queries.py (index
+#                    build, small and large bounding boxes, polygon)
+#
+# Each result has a wall time in seconds ("seconds", the best of --repeat
+# runs); the results of two files are compared by benchmark, case and size.
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(ROOT))
+sys.path.insert(0, ROOT)
+
+import copert  # noqa: E402
+import engine  # noqa: E402
+import osm_network  # noqa: E402
+import queries  # noqa: E402
+import synthetic  # noqa: E402
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+# The per-link loop of the pipeline is much slower than the other stages:
+# it only runs on the sizes up to this number of links by default.
+PIPELINE_MAX_LINKS = 10000
+PIPELINE_POLLUTANTS = ["CO", "NOx", "PM", "FC"]
+# Number of links of the top-N queries.
+TOP_LINKS = 100
+# Data tables of Copert, parsed on first access (taken before any access).
+COPERT_TABLES = [value for value in vars(copert.Copert).values()
+                 if isinstance(value, copert._Table)]
+# Number of emission factor evaluations per case of 'copert_ef'.
+EF_CALLS = 20000
+# Emission factor of a speed in km/h (in the validity range of every case),
+# by equation family.
+EF_CASES = {
+    "pc_gasoline": lambda cop, v: cop.HEFGasolinePassengerCar(
+        cop.pollutant_NOx, v, cop.class_Euro_4, cop.engine_capacity_0p8_to_1p4),
+    "pc_diesel": lambda cop, v: cop.HEFDieselPassengerCar(
+        cop.pollutant_NOx, v, cop.class_Euro_5, cop.engine_capacity_1p4_to_2),
+    "ldv": lambda cop, v: cop.HEFLightCommercialVehicle(
+        cop.pollutant_NOx, v, cop.engine_type_diesel, cop.class_Euro_5),
+    "hdv": lambda cop, v: cop.Emission(
+        cop.pollutant_NOx, v, 1., cop.vehicle_type_heavy_duty_vehicle,
+        cop.engine_type_diesel, cop.class_hdv_Euro_VI, None, 20.),
+    "moto_eq56": lambda cop, v: copert.EFMotorcycle(
+        cop, cop.pollutant_NOx, v, cop.engine_type_moto_four_stroke_50_250,
+        cop.class_moto_Euro_3),
+    "cold_start": lambda cop, v: cop.ColdStartEmissionQuotient(
+        cop.vehicle_type_passenger_car, cop.engine_type_gasoline,
+        cop.pollutant_NOx, v, cop.class_Euro_4, cop.engine_capacity_0p8_to_1p4, 20.),
+}
+
+
+def best_time(function, repeat):
+    """
+    Returns the smallest wall time of 'repeat' calls to 'function', in
+    seconds.
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def peak_memory(function):
+    """
+    Returns the peak of the memory allocated by Python (including numpy)
+    during a call to 'function', in MB.
+    """
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1] / 1e6
+    finally:
+        tracemalloc.stop()
+
+
+def bench_copert_init(args, datasets):
+    def parse_tables():
+        # A descriptor stores its table in the class given to it.
+        for table in COPERT_TABLES:
+            table.__get__(None, type("Owner", (), {}))
+    return [{"case": "init", "seconds": best_time(engine.load_copert, args.repeat)},
+            {"case": "class_tables", "seconds": best_time(parse_tables, args.repeat)}]
+
+
+def bench_copert_ef(args, datasets):
+    cop = engine.load_copert()
+    speeds = np.linspace(20., 90., EF_CALLS).tolist()
+    results = []
+    for case, ef in EF_CASES.items():
+        seconds = best_time(lambda: [ef(cop, v) for v in speeds], args.repeat)
+        results.append({"case": case, "calls": EF_CALLS, "seconds": seconds,
+                        "us_per_call": 1e6 * seconds / EF_CALLS})
+    return results
+
+
+def bench_link_ingestion(args, datasets):
+    results = []
+    for size, paths in datasets.items():
+        seconds = best_time(lambda: engine.read_link_data(paths["link_file"]), args.repeat)
+        results.append({"case": "read_link_data", "size": size, "seconds": seconds,
+                        "links_per_second": size / seconds,
+                        "peak_mb": peak_memory(lambda: engine.read_link_data(paths["link_file"]))})
+    return results
+
+
+def bench_retrieve_highway(args, datasets):
+    results = []
+    for size, paths in datasets.items():
+        for case, key in (("xml", "osm_xml"), ("pbf", "osm_pbf")):
+            seconds = best_time(lambda: osm_network.retrieve_highway(
+                paths[key], engine.WHOLE_WORLD, 0.005,
+                highway_tags=osm_network.ROAD_HIGHWAY_TAGS), args.repeat)
+            results.append({"case": case, "size": size, "seconds": seconds,
+                            "ways_per_second": size / seconds,
+                            "file_mb": os.path.getsize(paths[key]) / 1e6})
+    return results
+
+
+def bench_pipeline(args, datasets):
+    results = []
+    for size, paths in datasets.items():
+        if size > args.pipeline_max_links:
+            continue
+        files = {key: paths[key] for key in engine.PROPORTION_FILES}
+
+        def run():
+            engine.run(paths["link_file"], PIPELINE_POLLUTANTS, files)
+        seconds = best_time(run, 1)
+        results.append({"case": "engine_run", "size": size, "seconds": seconds,
+                        "links_per_second": size / seconds,
+                        "peak_mb": peak_memory(run)})
+    return results
+
+
+def bench_queries(args, datasets):
+    results = []
+    for size in datasets:
+        lon, lat = synthetic.road_network(size)
+        bounds = np.array([lon.min(axis=1), lat.min(axis=1), lon.max(axis=1), lat.max(axis=1)])
+        values = np.random.default_rng(0).lognormal(size=size)
+        index = queries.LinkIndex(bounds)
+        lon_min, lat_min, lon_max, lat_max = synthetic.BOUNDING_BOX
+        small = (lon_min, lat_min, lon_min + (lon_max - lon_min) / 10., lat_min + (lat_max - lat_min) / 10.)
+        large = (lon_min, lat_min, (lon_min + lon_max) / 2., (lat_min + lat_max) / 2.)
+        polygon = [large[:2], (large[2], large[1]), (large[0], large[3])]
+        cases = [("top_n", lambda: queries.top_links(values, TOP_LINKS)),
+                 ("index_build", lambda: queries.LinkIndex(bounds)),
+                 ("box_1pct", lambda: index.in_box(*small)),
+                 ("box_25pct", lambda: index.in_box(*large)),
+                 ("polygon_12pct", lambda: index.in_polygon(polygon))]
+        for case, query in cases:
+            results.append({"case": case, "size": size, "seconds": best_time(query, args.repeat)})
+    return results
+
+
+BENCHMARKS = {
+    "copert_init": bench_copert_init,
+    "copert_ef": bench_copert_ef,
+    "link_ingestion": bench_link_ingestion,
+    "retrieve_highway": bench_retrieve_highway,
+    "pipeline": bench_pipeline,
+    "queries": bench_queries,
+}
+
+
+def metadata():
+    """
+    Returns the commit, date and machine of the run.
+    """
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {"commit": commit,
+            "date": datetime.datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(), "numpy": np.__version__,
+            "machine": platform.machine(), "processor": platform.processor(),
+            "cpu_count": os.cpu_count()}
+
+
+def compare(results, reference):
+    """
+    Prints the ratio of the times of 'results' to those of 'reference' (two
+    result files), for the measurements they have in common.
+    """
+    def by_key(report):
+        return {(r["benchmark"], r["case"], r.get("size")): r["seconds"]
+                for r in report["results"]}
+    old, new = by_key(reference), by_key(results)
+    print("\ncompared with {0}:".format(reference["meta"]["commit"]))
+    for key in sorted(set(old) & set(new), key=str):
+        print("{0:<18} {1:<16} {2:>8}  {3:6.2f}x".format(
+            key[0], key[1], key[2] or "", new[key] / old[key]))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Runs the benchmarks on synthetic datasets.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES,
+                        help="numbers of links of the datasets")
+    parser.add_argument("--only", nargs="+", choices=list(BENCHMARKS),
+                        help="benchmarks to run (default: all)")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--pipeline-max-links", type=int, default=PIPELINE_MAX_LINKS)
+    parser.add_argument("--data-dir", help="directory of the datasets, kept between runs "
+                        "(default: a temporary directory)")
+    parser.add_argument("--output", help="JSON file of the results (default: "
+                        "benchmarks/results/COMMIT.json)")
+    parser.add_argument("--compare", help="JSON file of a previous run")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        data_dir = args.data_dir or tmpdir
+        datasets = {size: synthetic.write_dataset(os.path.join(data_dir, str(size)), size)
+                    for size in args.sizes}
+        report = {"meta": metadata(), "results": []}
+        for name in args.only or BENCHMARKS:
+            for result in BENCHMARKS[name](args, datasets):
+                result = dict(benchmark=name, **result)
+                report["results"].append(result)
+                print("{0:<18} {1:<16} {2:>8}  {3:10.4f} s".format(
+                    name, result["case"], result.get("size", ""), result["seconds"]))
+
+    output = args.output or os.path.join(ROOT, "results",
+                                         "{0}.json".format(report["meta"]["commit"] or "run"))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print("results written to {0}".format(output))
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
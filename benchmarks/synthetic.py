@@ -0,0 +1,175 @@
+# This script generates synthetic inputs of the emission calculation for the
+# benchmarks: a road network as OSM XML and PBF files, the link data file of
+# its roads and the proportion files, with one row per link.
+#
+# Usage: python benchmarks/synthetic.py DIRECTORY --links N [--seed S]
+#
+# The roads are random walks in a box around Paris, with NODES_PER_WAY nodes
+# each; the OSM_ID of a link is the ID of its way.
+
+import argparse
+import os
+import sys
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import engine  # noqa: E402
+import osm_network  # noqa: E402
+
+# Box of the start points of the roads (lon_min, lat_min, lon_max, lat_max).
+BOUNDING_BOX = (2.2, 48.8, 2.5, 48.9)
+NODES_PER_WAY = 4
+# Standard deviation of a step of the random walks, in degrees (about 50 m).
+STEP_DEGREES = 5e-4
+# Columns of the class proportion files with non-zero proportions: Euro 1
+# to Euro 6 for the cars, Euro 1 to Euro 5 for the motorcycles.
+CAR_CLASS_COLUMNS = slice(7, 14)
+MOTO_CLASS_COLUMNS = slice(7, 12)
+
+
+def road_network(n, seed=0):
+    """
+    Returns the node coordinates of 'n' roads, as two (n, NODES_PER_WAY)
+    arrays of longitudes and latitudes.
+    """
+    rng = np.random.default_rng(seed)
+    lon_min, lat_min, lon_max, lat_max = BOUNDING_BOX
+    start = rng.uniform((lon_min, lat_min), (lon_max, lat_max), size=(n, 2))
+    steps = rng.normal(0., STEP_DEGREES, size=(n, NODES_PER_WAY - 1, 2))
+    points = np.concatenate([start[:, None], start[:, None] + np.cumsum(steps, axis=1)], axis=1)
+    return points[..., 0], points[..., 1]
+
+
+def road_lengths(lon, lat):
+    """
+    Returns the lengths in km of the roads of 'road_network'.
+    """
+    radius = 6371.
+    dlon = np.radians(np.diff(lon, axis=1)) * np.cos(np.radians(lat[:, :-1]))
+    dlat = np.radians(np.diff(lat, axis=1))
+    return radius * np.hypot(dlon, dlat).sum(axis=1)
+
+
+def link_table(n, seed=0, lengths=None):
+    """
+    Returns a link table with 9 columns (see engine.LINK_COLUMNS) for the
+    roads 1 to 'n'.
+    """
+    rng = np.random.default_rng(seed + 1)
+    if lengths is None:
+        lengths = rng.uniform(0.02, 2., n)
+    pc = rng.uniform(0.6, 0.8, n)
+    return np.column_stack([
+        np.arange(1, n + 1), lengths, rng.uniform(50., 2000., n),
+        rng.uniform(20., 110., n), rng.uniform(0.3, 0.7, n), pc,
+        rng.uniform(0.5, 0.9, n), rng.uniform(0.05, 0.1, n), rng.uniform(0.02, 0.06, n)])
+
+
+def _dirichlet(rng, n, ncolumn, columns):
+    data = np.zeros((n, ncolumn))
+    data[:, columns] = rng.dirichlet(np.ones(len(range(ncolumn)[columns])), size=n)
+    return data
+
+
+def proportions(n, seed=0):
+    """
+    Returns proportion matrices with one row per link, by key of
+    engine.PROPORTION_FILES.
+    """
+    rng = np.random.default_rng(seed + 2)
+    return {
+        "eng_gas": _dirichlet(rng, n, 3, slice(0, 3)),
+        "eng_dsl": _dirichlet(rng, n, 3, slice(0, 3)),
+        "cls_gas": _dirichlet(rng, n, 14, CAR_CLASS_COLUMNS),
+        "cls_dsl": _dirichlet(rng, n, 14, CAR_CLASS_COLUMNS),
+        "moto_2s": _dirichlet(rng, n, 14, MOTO_CLASS_COLUMNS),
+        "moto_4s": _dirichlet(rng, n, 14, MOTO_CLASS_COLUMNS),
+    }
+
+
+def write_osm_xml(path, lon, lat):
+    """
+    Writes the roads of 'road_network' as an OSM XML file.
+    """
+    tags = osm_network.ROAD_HIGHWAY_TAGS
+    with open(path, "w") as f:
+        f.write("<?xml version='1.0' encoding='UTF-8'?>\n<osm version=\"0.6\">\n")
+        for i, (x, y) in enumerate(zip(lon.ravel().tolist(), lat.ravel().tolist())):
+            f.write(" <node id=\"{0}\" version=\"1\" lat=\"{1:.7f}\" lon=\"{2:.7f}\"/>\n"
+                    .format(i + 1, y, x))
+        for i in range(lon.shape[0]):
+            f.write(" <way id=\"{0}\" version=\"1\">\n".format(i + 1))
+            for j in range(NODES_PER_WAY):
+                f.write("  <nd ref=\"{0}\"/>\n".format(i * NODES_PER_WAY + j + 1))
+            f.write("  <tag k=\"highway\" v=\"{0}\"/>\n </way>\n"
+                    .format(tags[i % len(tags)]))
+        f.write("</osm>\n")
+
+
+def write_osm_pbf(path, lon, lat):
+    """
+    Writes the roads of 'road_network' as an OSM PBF file.
+    """
+    import osmium
+    from osmium.osm import mutable
+
+    tags = osm_network.ROAD_HIGHWAY_TAGS
+    if os.path.exists(path):
+        os.remove(path)
+    writer = osmium.SimpleWriter(path)
+    try:
+        for i, (x, y) in enumerate(zip(lon.ravel().tolist(), lat.ravel().tolist())):
+            writer.add_node(mutable.Node(id=i + 1, version=1, location=(x, y)))
+        for i in range(lon.shape[0]):
+            writer.add_way(mutable.Way(
+                id=i + 1, version=1,
+                nodes=list(range(i * NODES_PER_WAY + 1, (i + 1) * NODES_PER_WAY + 1)),
+                tags={"highway": tags[i % len(tags)]}))
+    finally:
+        writer.close()
+
+
+def write_dataset(directory, n, seed=0, osm_formats=("xml", "pbf")):
+    """
+    Writes a synthetic dataset of 'n' links in 'directory' (the files that
+    exist are kept). Returns the paths of its files: 'link_file', 'osm_xml',
+    'osm_pbf' and the keys of engine.PROPORTION_FILES.
+    """
+    os.makedirs(directory, exist_ok=True)
+    paths = {"link_file": os.path.join(directory, "links.txt"),
+             "osm_xml": os.path.join(directory, "network.osm"),
+             "osm_pbf": os.path.join(directory, "network.osm.pbf")}
+    paths.update({key: os.path.join(directory, name)
+                  for key, name in engine.PROPORTION_FILES.items()})
+
+    lon, lat = road_network(n, seed)
+    if not os.path.exists(paths["link_file"]):
+        np.savetxt(paths["link_file"], link_table(n, seed, road_lengths(lon, lat)),
+                   fmt=["%d"] + ["%.6f"] * 8)
+    for key, data in proportions(n, seed).items():
+        if not os.path.exists(paths[key]):
+            np.savetxt(paths[key], data, fmt="%.6f")
+    if "xml" in osm_formats and not os.path.exists(paths["osm_xml"]):
+        write_osm_xml(paths["osm_xml"], lon, lat)
+    if "pbf" in osm_formats and not os.path.exists(paths["osm_pbf"]):
+        write_osm_pbf(paths["osm_pbf"], lon, lat)
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Generates a synthetic dataset for the benchmarks.")
+    parser.add_argument("directory")
+    parser.add_argument("--links", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    for key, path in write_dataset(args.directory, args.links, args.seed).items():
+        print("{0:<10} {1}".format(key, path))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,10 +1,36 @@
 import streamlit as st
-import numpy as np
-import pandas as pd
-import tempfile
-import os
-# Import your existing local copert file
-import copert 
+import datetime
+import uuid
+# The computation itself is in engine.py, shared with the command-line runner,
+# and runs in a background thread (background.py)
+import background
+import instrumentation
+import processing
+import run_store
+import summary
+import ui
+
+# Interval between two updates of the progress of a running calculation, in seconds.
+JOB_POLL_SECONDS = 1.0
+
+def store_results(results_df, selected_pollutants, network=None):
+    """
+    Stores the results table in the session state, with its summary cube (by
+    road class if the road network is given) read by the analysis tab.
+    """
+    st.session_state.results_df = results_df
+    st.session_state.selected_pollutants = selected_pollutants
+    st.session_state.summary_cube = summary.SummaryCube.from_results(results_df, selected_pollutants, network)
+    st.session_state.results_version = uuid.uuid4().hex
+
+def results_version():
+    """
+    Returns the identifier of the stored results, which changes every time
+    results are stored; outputs derived from the results are memoized on it.
+    """
+    if 'results_version' not in st.session_state:
+        st.session_state.results_version = uuid.uuid4().hex
+    return st.session_state.results_version
 
 def run_calculations(inputs):
     st.header("⚙️ Calculate Emissions")
@@ -16,111 +42,186 @@ def run_calculations(inputs):
     accuracy = inputs['accuracy'] # Contains: temp_corr, cold_start, temp, trip, slope
     
     # 2. Validation
-    required_files = [files['pc'], files['ldv'], files['hdv'], files['moto'], link_osm,
-                      files['eng_gas'], files['eng_dsl'], files['cls_gas'], 
-                      files['cls_dsl'], files['moto_2s'], files['moto_4s']]
-                      
     if not selected_pollutants:
         st.warning("⚠️ Please select at least one pollutant from the sidebar")
         return
 
-    if not all(f is not None for f in required_files):
-        st.info("Please ensure all required files (Parameters, Link Data, and Proportions) are uploaded.")
+    # The parameter and proportion files that are not uploaded are read from defaults/
+    if link_osm is None:
+        st.info("Please upload the Link Data file (the Parameters and Proportions default to the files in defaults/).")
         return
 
-    st.success("✅ All required files uploaded!")
+    st.success("✅ All required files available!")
+
+    job = st.session_state.get('calculation_job')
+    running = job is not None and job.running()
+    profile = st.checkbox("Profile the emission loop", key="profile_calculation", disabled=running,
+                          help="Samples where the time goes by vehicle type, equation and pollutant (slower).")
 
     # 3. The Calculation Button
-    if st.button("🚀 Calculate Multi-Pollutant Emissions", type="primary", use_container_width=True):
-        with st.spinner("Computing emissions..."):
-            try:
-                # Create a temp directory to store the parameter CSVs so Copert class can read them
-                with tempfile.TemporaryDirectory() as tmpdir:
-                    pc_path = os.path.join(tmpdir, "PC_parameter.csv")
-                    ldv_path = os.path.join(tmpdir, "LDV_parameter.csv")
-                    hdv_path = os.path.join(tmpdir, "HDV_parameter.csv")
-                    moto_path = os.path.join(tmpdir, "Moto_parameter.csv")
-
-                    # Write uploaded bytes to temp files
-                    files['pc'].seek(0); open(pc_path, 'wb').write(files['pc'].read())
-                    files['ldv'].seek(0); open(ldv_path, 'wb').write(files['ldv'].read())
-                    files['hdv'].seek(0); open(hdv_path, 'wb').write(files['hdv'].read())
-                    files['moto'].seek(0); open(moto_path, 'wb').write(files['moto'].read())
-
-                    # Initialize the existing COPERT logic
-                    cop = copert.Copert(pc_path, ldv_path, hdv_path, moto_path)
-
-                    # Load Data Tables
-                    link_osm.seek(0)
-                    # Reset all file pointers to 0 before reading
-                    for key, file_obj in files.items():
-                        if file_obj: file_obj.seek(0)
-
-                    # Load Link Data
-                    data_link = pd.read_csv(link_osm, sep=r'\s+', header=None, engine='python').values
-                    Nlink = data_link.shape[0]
-
-                    # Load Proportions
-                    d_eng_gas = np.loadtxt(files['eng_gas'])
-                    d_eng_dsl = np.loadtxt(files['eng_dsl'])
-                    d_cls_gas = np.loadtxt(files['cls_gas'])
-                    d_cls_dsl = np.loadtxt(files['cls_dsl'])
-                    d_moto_2s = np.loadtxt(files['moto_2s'])
-                    d_moto_4s = np.loadtxt(files['moto_4s'])
-
-                    # --- LOGIC REPLICATION FROM YOUR ORIGINAL FILE ---
-                    # Handle Link Columns (7 vs 9)
-                    if data_link.shape[1] == 7:
-                        P_ldv, P_hdv = np.zeros(Nlink), np.zeros(Nlink)
-                    elif data_link.shape[1] == 9:
-                        P_ldv, P_hdv = data_link[:, 7], data_link[:, 8]
-                    else:
-                        st.error("Link data must have 7 or 9 columns.")
-                        return
-
-                    # Setup Defaults for LDV/HDV
-                    d_ldv_cls = d_cls_gas # Proxy
-                    # HDV 100% Euro VI (Index 5) / Type 0
-                    d_hdv_reshaped = np.zeros((Nlink, 6, 15))
-                    d_hdv_reshaped[:, 5, 0] = 1.0 
-
-                    # Initialize Emission Arrays
-                    emissions_data = {}
-                    pollutant_mapping = {
-                        "CO": cop.pollutant_CO, "CO2": cop.pollutant_FC, 
-                        "NOx": cop.pollutant_NOx, "PM": cop.pollutant_PM, 
-                        "VOC": cop.pollutant_VOC, "FC": cop.pollutant_FC
-                    }
-
-                    for poll in selected_pollutants:
-                        emissions_data[poll] = {
-                            'pc': np.zeros(Nlink), 'ldv': np.zeros(Nlink),
-                            'hdv': np.zeros(Nlink), 'moto': np.zeros(Nlink),
-                            'total': np.zeros(Nlink)
-                        }
-
-                    # Progress Bar
-                    prog_bar = st.progress(0)
-                    
-                    # --- THE LOOP ---
-                    # (I am summarizing the loop here. In your actual file, 
-                    # copy lines 488 to 644 from your original file exactly)
-                    
-                    # ... [INSERT YOUR ORIGINAL LOOP LOGIC HERE] ...
-                    # Ensure you replace `ambient_temp` with `accuracy['temp']`
-                    # Ensure you replace `include_cold_start` with `accuracy['cold_start']`
-                    
-                    # DUMMY FILLER FOR EXAMPLE (Delete this in production)
-                    for poll in selected_pollutants:
-                        emissions_data[poll]['total'] = np.random.rand(Nlink) * 100
-                    prog_bar.progress(100)
-                    
-                    # --- SAVE RESULTS ---
-                    st.session_state.emissions_data = emissions_data
-                    st.session_state.data_link = data_link
-                    st.session_state.selected_pollutants = selected_pollutants
-                    
-                    st.success("Calculation Finished!")
-
-            except Exception as e:
-                st.error(f"Calculation Error: {e}")
+    # The engine runs in a background thread (see background.py): the other
+    # tabs stay usable, and the job survives the reruns in the session state.
+    if st.button("🚀 Calculate Multi-Pollutant Emissions", type="primary", use_container_width=True,
+                 disabled=running):
+        try:
+            with instrumentation.recording(ui.trace_memory()) as recorder:
+                with instrumentation.span("upload_decoding") as span:
+                    data_link = processing.read_link_table(link_osm)
+                    span.count(links=len(data_link))
+            job = background.CalculationJob(data_link, selected_pollutants, files, accuracy,
+                                            ui.trace_memory(), profile, recorder.to_dict())
+            st.session_state.calculation_job = job.start()
+            running = True
+        except Exception as e:
+            st.error(f"Calculation Error: {e}")
+
+    if job is not None:
+        # The status polls the job while it runs, without rerunning the page.
+        st.fragment(render_job, run_every=JOB_POLL_SECONDS if running else None)(job, inputs)
+
+    ui.render_performance(st.session_state.get('calculation_performance'))
+    render_profile(st.session_state.get('calculation_profile'))
+    render_run_store(inputs)
+
+def render_job(job, inputs):
+    """
+    Renders the progress of the calculation job, with a button to cancel it
+    and one to keep the results of the links done so far. The results are
+    stored once the job ends (the partial ones if it was cancelled).
+    """
+    if job.running():
+        done, total = job.done, job.total
+        speed, remaining = job.links_per_second(), job.remaining_seconds()
+        text = f"Computing emissions: {done:,} / {total:,} links"
+        if speed is not None:
+            text += f" — {speed:,.0f} links/s, about {remaining:,.0f} s left"
+        st.progress(done / max(total, 1), text=text)
+        cancel_col, partial_col = st.columns(2)
+        if cancel_col.button("⏹️ Cancel", key="cancel_calculation", use_container_width=True):
+            job.cancel()
+        if partial_col.button("Use the links done so far", key="partial_results",
+                              use_container_width=True, disabled=done == 0):
+            collect_results(job, inputs, job.partial_results())
+            st.info(f"Results of {done:,} of {total:,} links stored; the calculation goes on.")
+        return
+
+    if not job.collected:
+        job.collected = True
+        if job.state == background.FAILED:
+            st.session_state.calculation_status = ('error', f"Calculation Error: {job.error}")
+        else:
+            collect_results(job, inputs, job.partial_results(), job.performance)
+            st.session_state.calculation_profile = job.profile_data
+            if job.state == background.CANCELLED:
+                st.session_state.calculation_status = (
+                    'warning', f"Calculation cancelled: results of {job.done:,} of {job.total:,} links stored.")
+            else:
+                st.session_state.calculation_status = (
+                    'success', f"Calculation Finished! {job.total:,} links in {job.elapsed():.1f} s.")
+        # Stops the polling and refreshes the performance panels.
+        st.rerun()
+
+    kind, message = st.session_state.get('calculation_status', ('success', "Calculation Finished!"))
+    getattr(st, kind)(message)
+
+def collect_results(job, inputs, results_df, performance=None):
+    """
+    Stores the results of the job, with the road classes of the OSM file if
+    any. 'performance' (the spans of the job) is completed with the stages
+    of the storage for the Performance panel.
+    """
+    with instrumentation.recording(job.trace_memory) as recorder:
+        # The road classes of the links come from the OSM file, if any.
+        network = None
+        if inputs['osm_file'] is not None:
+            with instrumentation.span("load_network"):
+                network = processing.load_network(inputs['osm_file'], inputs['map_params'])
+        with instrumentation.span("store_results", links=len(results_df)):
+            store_results(results_df, job.selected_pollutants, network)
+    # What the run store records with the results, if they are saved.
+    st.session_state.results_source = {
+        'files': job.files, 'accuracy': job.accuracy,
+        'names': run_store.input_names(dict(inputs['files'], link=inputs['link_osm'])),
+        'complete': len(results_df) == job.total, 'run_id': None}
+    if performance is not None:
+        st.session_state.calculation_performance = performance + recorder.to_dict()
+
+def render_profile(profile):
+    """
+    Renders the hot paths of the last profiled calculation, with its samples
+    as collapsed stacks for flame graph tools (flamegraph.pl, speedscope).
+    """
+    if not profile:
+        return
+    hot_paths, collapsed = profile
+    with st.expander("🔥 Emission Loop Profile", expanded=False):
+        st.caption("Time estimated from stack samples; 'other' is the time spent outside the emission factors.")
+        st.dataframe(hot_paths, hide_index=True, use_container_width=True)
+        st.download_button("Download Flame Graph Data (collapsed stacks)", data=collapsed,
+                           file_name="emission_loop.collapsed", mime="text/plain",
+                           key="download_profile")
+
+@st.fragment
+def render_run_store(inputs):
+    """
+    Renders the runs of the local run store (see run_store.py): saves the
+    current results, reloads a run in place of them, and compares the totals
+    and the links of two runs. Its widgets only rerun this fragment.
+    """
+    link_osm = inputs['link_osm']
+    with st.expander("🗄️ Saved Runs", expanded=False):
+        source = st.session_state.get('results_source')
+        if source is not None and source['run_id'] is None:
+            name = st.text_input("Run name", key="run_name",
+                                 value=f"{getattr(link_osm, 'name', 'Run')} {datetime.date.today()}")
+            if st.button("💾 Save the current results", key="save_run"):
+                with st.spinner("Saving the run..."):
+                    settings = {'accuracy': source['accuracy'],
+                                'files': source['names']}
+                    source['run_id'] = run_store.save_run(
+                        st.session_state.results_df, st.session_state.selected_pollutants, name,
+                        settings, run_store.parameters_hash(source['files'], source['accuracy']),
+                        source['complete'])
+                st.success(f"Run {source['run_id']} saved.")
+        elif source is not None:
+            st.caption(f"The current results are run {source['run_id']} of the store.")
+
+        runs = run_store.list_runs()
+        if runs.empty:
+            st.caption(f"No saved runs in {run_store.DEFAULT_PATH}.")
+            return
+        st.dataframe(runs.drop(columns=['settings']), hide_index=True, use_container_width=True)
+        labels = {run_id: f"#{run_id} {name} ({created})"
+                  for run_id, name, created in zip(runs['run_id'], runs['name'], runs['created'])}
+
+        run_id = st.selectbox("Run", list(labels), format_func=labels.get, key="stored_run")
+        reload_col, delete_col = st.columns(2)
+        if reload_col.button("Reload this run", key="reload_run", use_container_width=True):
+            results_df, pollutants = run_store.load_run(run_id)
+            network = None
+            if inputs['osm_file'] is not None:
+                network = processing.load_network(inputs['osm_file'], inputs['map_params'])
+            store_results(results_df, pollutants, network)
+            st.session_state.results_source = {'files': {}, 'accuracy': None, 'names': {},
+                                               'complete': True, 'run_id': run_id}
+            st.success(f"Run {run_id} reloaded: {len(results_df):,} links.")
+        if delete_col.button("Delete this run", key="delete_run", use_container_width=True):
+            run_store.delete_run(run_id)
+            st.rerun(scope="fragment")
+
+        if len(runs) < 2:
+            return
+        st.markdown("**Compare two runs**")
+        col_a, col_b = st.columns(2)
+        run_a = col_a.selectbox("Reference run", list(labels), index=1, format_func=labels.get,
+                                key="compare_run_a")
+        run_b = col_b.selectbox("Scenario run", list(labels), index=0, format_func=labels.get,
+                                key="compare_run_b")
+        totals = run_store.compare_totals([run_a, run_b])
+        st.dataframe(totals, hide_index=True, use_container_width=True)
+        pollutants = sorted(set(totals['pollutant']))
+        if pollutants:
+            pollutant = st.selectbox("Pollutant", pollutants, key="compare_pollutant")
+            links = run_store.compare_links(run_a, run_b, pollutant)
+            st.caption(f"{len(links):,} links in both runs, the largest differences (g) first.")
+            st.dataframe(links.head(100), hide_index=True, use_container_width=True)
@@ -0,0 +1,159 @@
+# Command-line runner of the emission calculation, without Streamlit, e.g. for
+# scheduled runs. It goes through the same engine as the application.
+#
+# Usage: python cli.py LINK_FILE -o OUTPUT [--pollutants CO NOx ...]
+#            [--settings FILE] [--pc FILE] ... [--osm FILE [--zone FILE]]
+#            [--performance FILE] [--profile FILE] [--store [DB]]
+#
+# The output format is given by the suffix of OUTPUT: .csv, .parquet,
+# .feather, .npz, .fgb or .geojson (the last two need --osm). The parameter
+# and proportion files that are not given are read from defaults/. The zone
+# file is a study-area polygon, one "lon, lat" pair per line, at which the
+# roads are clipped.
+#
+# The settings file is a JSON object with the optional keys "pollutants",
+# "accuracy" (keys of engine.DEFAULT_ACCURACY) and "files" (keys of
+# engine.PARAMETER_FILES and engine.PROPORTION_FILES, paths relative to the
+# settings file); the command-line options take precedence.
+#
+# With --store, the results are also saved as a run of the local run store
+# (see run_store.py), named after the link file unless --run-name is given.
+
+import argparse
+import contextlib
+import json
+import os
+import sys
+import time
+
+import engine
+import export
+import instrumentation
+import profiling
+import run_store
+
+
+def load_settings(path):
+    """
+    Reads a settings file. The input paths are made relative to the current
+    directory.
+    """
+    with open(path) as f:
+        settings = json.load(f)
+    directory = os.path.dirname(os.path.abspath(path))
+    settings["files"] = {key: os.path.join(directory, value)
+                         for key, value in settings.get("files", {}).items()}
+    return settings
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Computes the emissions of the links of a link data file.")
+    parser.add_argument("link_file", help="link data file (7 or 9 columns)")
+    parser.add_argument("-o", "--output", required=True,
+                        help="output file; its suffix gives the format")
+    parser.add_argument("--pollutants", nargs="+", choices=list(engine.POLLUTANTS),
+                        help="pollutants to compute (default: all)")
+    parser.add_argument("--settings", help="JSON settings file")
+    parser.add_argument("--compression",
+                        help="compression of the columnar formats")
+    for key in list(engine.PARAMETER_FILES) + list(engine.PROPORTION_FILES):
+        parser.add_argument("--" + key.replace("_", "-"), dest=key,
+                            help="'{0}' input file".format(key))
+    accuracy = parser.add_argument_group("accuracy settings")
+    accuracy.add_argument("--temperature", type=float, dest="ambient_temp",
+                          help="ambient temperature in Celsius degrees")
+    accuracy.add_argument("--no-temperature-correction", action="store_false",
+                          dest="include_temperature_correction", default=None)
+    accuracy.add_argument("--cold-start", action="store_true",
+                          dest="include_cold_start", default=None)
+    accuracy.add_argument("--trip-length", type=float, dest="trip_length",
+                          help="average trip length in km (cold start)")
+    network = parser.add_argument_group("road network (GIS formats)")
+    network.add_argument("--osm", help="OSM file of the links")
+    network.add_argument("--zone",
+                         help="study-area polygon file, one 'lon, lat' pair per line "
+                         "(default: the whole OSM file)")
+    network.add_argument("--tolerance", type=float, default=0.005,
+                         help="margin in degrees around the --zone polygon within which "
+                         "the OSM nodes are kept (extraction window, not a simplification)")
+    network.add_argument("--ncore", type=int, default=1)
+    parser.add_argument("--performance",
+                        help="JSON file of the timing and memory of every stage")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="measure the peak memory of the stages (slower)")
+    parser.add_argument("--profile",
+                        help="profile the emission loop and write its samples as "
+                        "collapsed stacks (flame graph input) to this file")
+    parser.add_argument("--store", nargs="?", const=run_store.DEFAULT_PATH, metavar="DB",
+                        help="save the run in the run store (default: {0})".format(
+                            run_store.DEFAULT_PATH))
+    parser.add_argument("--run-name", help="name of the run in the store")
+    parser.add_argument("--quiet", action="store_true")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    settings = load_settings(args.settings) if args.settings else {}
+
+    selected_pollutants = args.pollutants or settings.get("pollutants") or list(engine.POLLUTANTS)
+    files = dict(settings.get("files", {}))
+    files.update({key: getattr(args, key)
+                  for key in list(engine.PARAMETER_FILES) + list(engine.PROPORTION_FILES)
+                  if getattr(args, key) is not None})
+    accuracy = dict(engine.DEFAULT_ACCURACY, **settings.get("accuracy", {}))
+    accuracy.update({key: getattr(args, key) for key in engine.DEFAULT_ACCURACY
+                     if getattr(args, key, None) is not None})
+
+    def progress(done, total):
+        if not args.quiet:
+            print("\r{0}/{1} links".format(done, total), end="", file=sys.stderr)
+
+    try:
+        file_format = export.file_format_of(args.output)
+        if file_format in export.GIS_FORMATS and args.osm is None:
+            raise ValueError("The {0} format needs --osm.".format(file_format))
+        selected_zone = None
+        if args.zone:
+            with open(args.zone) as f:
+                selected_zone = engine.parse_polygon(f.read())
+        start = time.perf_counter()
+        with instrumentation.recording(args.trace_memory) as recorder:
+            with profiling.profiling() if args.profile else contextlib.nullcontext() as profiler:
+                results_df = engine.run(args.link_file, selected_pollutants, files, accuracy, progress)
+            network = None
+            if file_format in export.GIS_FORMATS:
+                network = engine.load_network(args.osm, selected_zone, args.tolerance, args.ncore)
+            export.write_results(results_df, args.output, file_format, args.compression, network)
+        if args.performance:
+            recorder.write_json(args.performance, link_file=args.link_file, output=args.output)
+        if profiler is not None:
+            profiler.write_collapsed(args.profile)
+        if args.store:
+            run_id = run_store.save_run(
+                results_df, selected_pollutants, args.run_name or os.path.basename(args.link_file),
+                {"accuracy": accuracy, "files": run_store.input_names(dict(files, link=args.link_file))},
+                run_store.parameters_hash(files, accuracy), path=args.store)
+            if not args.quiet:
+                print("\nrun {0} saved in {1}".format(run_id, args.store), file=sys.stderr)
+    except Exception as e:
+        # Copert raises bare Exceptions (e.g., speed out of range), and a bad
+        # settings key a KeyError: a scheduled run reports them all the same way.
+        print("\nerror: {0}".format(e), file=sys.stderr)
+        return 1
+    if profiler is not None and not args.quiet:
+        print("\n{0:<6} {1:<26} {2:<9} {3:>9} {4:>8} {5:>7}".format(
+            "Type", "Equation", "Pollutant", "Calls", "Time (s)", "Share"), file=sys.stderr)
+        for row in profiler.hot_paths(10):
+            print("{0:<6} {1:<26} {2:<9} {3:>9} {4:>8.3f} {5:>6.1f}%".format(
+                *(row[key] for key in ("Vehicle Type", "Equation", "Pollutant", "Calls",
+                                       "Time (s)", "Share (%)"))), file=sys.stderr)
+    if not args.quiet:
+        print("\n{0} links written to {1} in {2:.1f} s".format(
+            len(results_df), args.output, time.perf_counter() - start), file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
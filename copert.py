@@ -22,6 +22,26 @@ import numpy
 import math
 
 
+class _Table:
+    """
+    Data table of the class Copert, parsed from its text on first use and
+    then stored as a class attribute, so that importing the module does not
+    build the tables.
+    """
+    def __init__(self, string, shape):
+        self.string = string
+        self.shape = shape
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, instance, owner):
+        table = numpy.fromstring(self.string, sep = ' ')
+        table.shape = self.shape
+        setattr(owner, self.name, table)
+        return table
+
+
 class Copert:
     """
     This class implements COPERT formulae for road transport emissions.
@@ -337,9 +357,7 @@ NAN       NAN      NAN       NAN       NAN       NAN
 2.65e-13  -4.07e-11 1.55e-9    1.43e-7   -2.5e-5   2.45e-3
 """
     # Hot emission factor coefficient ("efc"), for gasoline passenger cars.
-    efc_gasoline_passenger_car \
-        = numpy.fromstring(emission_factor_string, sep = ' ')
-    efc_gasoline_passenger_car.shape = (4, 7, 6)
+    efc_gasoline_passenger_car = _Table(emission_factor_string, (4, 7, 6))
 
     # Data table (ref. EEA emission inventory guidebook 2013, part 1.A.3.b,
     # Road transportation, version updated in Sept. 2014, page 61, Table 3-41,
@@ -360,9 +378,7 @@ NAN       NAN      NAN       NAN       NAN       NAN
 1.74e2    6.85e-2   3.64e-1  -2.47e-4  8.74e-3   NAN
 2.85e2    7.28e-2   -1.37e-1 -4.16e-4  NAN       NAN
 """
-    efc_gasoline_passenger_car_fc \
-        = numpy.fromstring(emission_factor_string, sep = ' ')
-    efc_gasoline_passenger_car_fc.shape = (1, 13, 6)
+    efc_gasoline_passenger_car_fc = _Table(emission_factor_string, (1, 13, 6))
 
 
     # Data table for over-emission e_cold / e_hot for Euro 1 and later
@@ -399,9 +415,7 @@ NAN         NAN         NAN
 0.116       -0.229      5.739
 1.75e-2     -0.346      10.462
 """
-    cold_start_emission_quotient \
-        = numpy.fromstring(cold_start_emission_quotient_string, sep = ' ')
-    cold_start_emission_quotient.shape = (3, 3, 3, 3)
+    cold_start_emission_quotient = _Table(cold_start_emission_quotient_string, (3, 3, 3, 3))
 
     # Data table to compute hot emission factor for diesel passenger cars from
     # copert_class Euro 1 to Euro 6c, except for FC.  (Ref. EEA emission
@@ -501,9 +515,7 @@ NAN        NAN        NAN        NAN        NAN        NAN
 """
 
     # Hot emission factor coefficient ("efc"), for diesel passenger cars.
-    efc_diesel_passenger_car\
-        = numpy.fromstring (emission_factor_string, sep = ' ')
-    efc_diesel_passenger_car.shape = (4, 7, 3, 6)
+    efc_diesel_passenger_car = _Table(emission_factor_string, (4, 7, 3, 6))
 
 
     # Data table of the hot emission factor parameters for light commercial
@@ -533,9 +545,7 @@ NAN     NAN      NAN        NAN        NAN
 10.0    110.0    0.02113    -2.65      148.91
 10.0    110.0    0.0198     -2.506     137.42
 """
-    ldv_parameter_pre_euro_1 \
-        = numpy.fromstring(ldv_parameter_pre_euro_1_string, sep = ' ')
-    ldv_parameter_pre_euro_1.shape = (2, 5, 2, 5)
+    ldv_parameter_pre_euro_1 = _Table(ldv_parameter_pre_euro_1_string, (2, 5, 2, 5))
 
     # Emission reduction percentage Euro 2 to Euro 4 light commercial vehicles
     # ("ldv" for "light duty vehicles") applied to vehicles of Euro 1. (data
@@ -549,9 +559,7 @@ NAN     NAN      NAN        NAN        NAN
 18.0    16.0    38.0    33.0
 35.0    32.0    77.0    65.0
 """
-    ldv_reduction_percentage \
-        = numpy.fromstring(ldv_reduction_percentage_string, sep = ' ')
-    ldv_reduction_percentage.shape = (2, 3, 4)
+    ldv_reduction_percentage = _Table(ldv_reduction_percentage_string, (2, 3, 4))
 
 
     def __init__(self, pc_parameter_file, ldv_parameter_file,
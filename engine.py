@@ -0,0 +1,439 @@
+# Computation of the emissions of a road network, without user interface. The
+# Streamlit application (calculator.py) and the command-line runner (cli.py)
+# both go through 'run', so that the same inputs give the same results.
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+import copert
+import instrumentation
+import profiling
+
+DEFAULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "defaults")
+
+# Default files of the inputs, under DEFAULTS_DIR, with the keys of the
+# sidebar inputs (ui.render_sidebar). There is no HDV parameter file: the HDV
+# emission factors do not read it.
+PARAMETER_FILES = {
+    "pc": "PC_parameter.csv",
+    "ldv": "LDV_parameter.csv",
+    "hdv": None,
+    "moto": "Moto_parameter.csv",
+}
+PROPORTION_FILES = {
+    "eng_gas": "engine_capacity_gasoline.dat",
+    "eng_dsl": "engine_capacity_diesel.dat",
+    "cls_gas": "copert_class_proportion_gasoline.dat",
+    "cls_dsl": "copert_class_proportion_diesel.dat",
+    "moto_2s": "copert_class_proportion_2_stroke_motorcycle_more_50.dat",
+    "moto_4s": "copert_class_proportion_4_stroke_motorcycle_50_250.dat",
+}
+
+# Pollutants of the application and the Copert pollutant they are computed
+# with.
+POLLUTANTS = {
+    "CO": copert.Copert.pollutant_CO,
+    "CO2": copert.Copert.pollutant_FC,
+    "NOx": copert.Copert.pollutant_NOx,
+    "PM": copert.Copert.pollutant_PM,
+    "VOC": copert.Copert.pollutant_VOC,
+    "FC": copert.Copert.pollutant_FC,
+}
+
+# Accuracy settings used when none are given (same as the sidebar defaults).
+DEFAULT_ACCURACY = {
+    "include_temperature_correction": True,
+    "include_cold_start": False,
+    "include_slope_correction": False,
+    "ambient_temp": 20.0,
+    "trip_length": 7.0,
+    "road_slope": 0.0,
+}
+
+# Column names of the link tables with 7 and 9 columns.
+LINK_COLUMNS = {
+    7: ['OSM_ID', 'Length_km', 'Flow', 'Speed', 'Gasoline_Prop', 'PC_Prop', '4Stroke_Prop'],
+    9: ['OSM_ID', 'Length_km', 'Flow', 'Speed', 'Gasoline_Prop', 'PC_Prop', '4Stroke_Prop', 'LDV_Prop', 'HDV_Prop'],
+}
+
+# Vehicle categories of 'emissions_data' and their prefix in the results table.
+VEHICLE_CATEGORIES = [('pc', 'PC'), ('ldv', 'LDV'), ('hdv', 'HDV'), ('moto', 'Moto')]
+
+# Polygon covering the whole world, used when no study area is given.
+WHOLE_WORLD = [(-180., -90.), (180., -90.), (180., 90.), (-180., 90.)]
+
+# Speed range of the hot emission factors of gasoline passenger cars up to
+# Euro 4, in km/h.
+PC_GASOLINE_SPEED_RANGE = (10., 130.)
+# Equations of the hot emission factors, as reported by the profiler (see
+# profiling.py): the Copert method evaluated for each vehicle type and fuel.
+EQUATIONS = {
+    ('PC', copert.Copert.engine_type_gasoline): "HEFGasolinePassengerCar",
+    ('PC', copert.Copert.engine_type_diesel): "HEFDieselPassengerCar",
+    ('LDV', None): "HEFLightCommercialVehicle",
+    ('HDV', None): "Emission",
+    ('Moto', None): "Eq_56",
+}
+# Number of links between two calls to the progress callback.
+PROGRESS_LINKS = 100
+
+
+class Cancelled(Exception):
+    """
+    Raised by 'compute_emissions' when it is cancelled; 'links' is the
+    number of links done.
+    """
+    def __init__(self, links):
+        Exception.__init__(self, "Cancelled after {0} links.".format(links))
+        self.links = links
+
+
+def _rewind(source):
+    if hasattr(source, "seek"):
+        source.seek(0)
+    return source
+
+
+def _input_path(source, default, directory, name):
+    """
+    Returns a path to the content of 'source': 'source' itself if it is a
+    path, the default file if it is None, or a copy in 'directory' of a file
+    object (e.g., an upload).
+    """
+    if source is None:
+        return None if default is None else os.path.join(DEFAULTS_DIR, default)
+    if isinstance(source, (str, os.PathLike)):
+        return os.fspath(source)
+    path = os.path.join(directory, name)
+    with open(path, "wb") as f:
+        shutil.copyfileobj(_rewind(source), f)
+    return path
+
+
+def load_copert(pc=None, ldv=None, hdv=None, moto=None):
+    """
+    Initializes Copert with the parameter files, given as paths or file
+    objects. The default files are used for the missing ones.
+    """
+    with tempfile.TemporaryDirectory() as tmpdir:
+        return copert.Copert(
+            _input_path(pc, PARAMETER_FILES["pc"], tmpdir, "PC_parameter.csv"),
+            _input_path(ldv, PARAMETER_FILES["ldv"], tmpdir, "LDV_parameter.csv"),
+            _input_path(hdv, PARAMETER_FILES["hdv"], tmpdir, "HDV_parameter.csv"),
+            _input_path(moto, PARAMETER_FILES["moto"], tmpdir, "Moto_parameter.csv"))
+
+
+def load_proportions(files, nlink):
+    """
+    Loads the proportion files (keys of PROPORTION_FILES; paths or file
+    objects, the default files being used for the missing ones). They have
+    one row per link.
+    """
+    proportions = {}
+    for key, default in PROPORTION_FILES.items():
+        source = files.get(key)
+        if source is None:
+            source = os.path.join(DEFAULTS_DIR, default)
+        data = np.loadtxt(_rewind(source), dtype=np.float64, ndmin=2)
+        if data.shape[0] != nlink:
+            raise ValueError("The proportion file '{0}' has {1} rows, but the link data has {2} links."
+                             .format(key, data.shape[0], nlink))
+        proportions[key] = data
+    return proportions
+
+
+def read_link_data(source):
+    """
+    Parses a link data file (path or file object; space-separated, without
+    header), naming its columns after their number.
+    """
+    # The C parser handles whitespace separators.
+    data_link = pd.read_csv(_rewind(source), sep=r'\s+', header=None)
+    data_link.columns = LINK_COLUMNS.get(data_link.shape[1],
+                                         [f'Column_{i}' for i in range(data_link.shape[1])])
+    return data_link
+
+
+def load_network(osm_file, selected_zone=None, tolerance=0.005, ncore=1):
+    """
+    Extracts the road network of an OSM file (path or file object), going
+    through the on-disk network cache. The roads are clipped at the study
+    area 'selected_zone' when one is given.
+    """
+    import network_cache
+    import osm_network
+    with instrumentation.span("retrieve_highway") as span:
+        network = network_cache.retrieve_highway_cached(
+            osm_file, selected_zone or WHOLE_WORLD, tolerance, ncore,
+            highway_tags=osm_network.ROAD_HIGHWAY_TAGS, clip=selected_zone is not None)
+        span.count(ways=len(network))
+    return network
+
+
+def parse_polygon(text):
+    """
+    Parses a study-area polygon written as one "lon, lat" pair per line.
+    Returns None for an empty text, or raises ValueError.
+    """
+    points = []
+    for line in text.strip().splitlines():
+        if not line.strip():
+            continue
+        lon, lat = [float(v) for v in line.replace(";", ",").split(",")]
+        points.append((lon, lat))
+    if not points:
+        return None
+    if len(points) < 3:
+        raise ValueError("A polygon needs at least 3 points.")
+    return points
+
+
+def moto_copert_class(column):
+    """
+    Returns the motorcycle class of a column of the motorcycle class
+    proportion files, which have the 14 columns of the passenger car classes:
+    the classes before Euro 1 are conventional, and Euro 5 and later are Euro
+    5.
+    """
+    return min(max(column - copert.Copert.class_Euro_1 + 1, 0),
+               copert.Copert.class_moto_Euro_5)
+
+
+def _shares(proportions):
+    # Indices and values of the non-zero proportions.
+    index = np.flatnonzero(proportions > 0.)
+    return list(zip(index.tolist(), proportions[index].tolist()))
+
+
+def _evaluate(profiler, vehicle, equation, function, *args):
+    # Calls 'function', reporting it to the profiler if any.
+    if profiler is None:
+        return function(*args)
+    profiler.enter(vehicle, equation)
+    try:
+        return function(*args)
+    finally:
+        profiler.exit()
+
+
+def _cold_start_factor(cop, accuracy, vehicle_type, engine_type, pollutant,
+                       speed, copert_class, engine_capacity, temperature,
+                       profiler=None):
+    """
+    Returns the ratio of the total (hot and cold) emissions to the hot
+    emissions: 1 + beta (e_cold / e_hot - 1).
+    """
+    if not accuracy["include_cold_start"]:
+        return 1.
+    if profiler is not None:
+        # Evaluated again without the profiler, as one call.
+        vehicle = 'PC' if vehicle_type == cop.vehicle_type_passenger_car else 'LDV'
+        return _evaluate(profiler, vehicle, "ColdStart", _cold_start_factor, cop, accuracy,
+                         vehicle_type, engine_type, pollutant, speed, copert_class,
+                         engine_capacity, temperature)
+    beta = cop.ColdStartMileagePercentage(vehicle_type, engine_type, pollutant,
+                                          copert_class, engine_capacity, temperature,
+                                          accuracy["trip_length"])
+    quotient = cop.ColdStartEmissionQuotient(vehicle_type, engine_type, pollutant,
+                                             speed, copert_class, engine_capacity,
+                                             temperature)
+    return 1. + beta * (quotient - 1.)
+
+
+def link_emissions(cop, pollutant, accuracy, distance, speed, shares, classes,
+                   profiler=None):
+    """
+    Returns the emissions in g of one pollutant on one link, per vehicle
+    category. 'distance' is the distance covered by all the vehicles (km),
+    'shares' the shares of the traffic (keys 'pc', 'ldv', 'hdv', 'moto',
+    'gasoline', '4stroke') and 'classes' the rows of the proportion files for
+    the link. The emission factors are reported to 'profiler' if given.
+    """
+    temperature = accuracy["ambient_temp"] if accuracy["include_temperature_correction"] \
+        else DEFAULT_ACCURACY["ambient_temp"]
+    emissions = dict.fromkeys(('pc', 'ldv', 'hdv', 'moto'), 0.)
+
+    # Passenger cars, by fuel, class and engine capacity.
+    for engine_type, fuel_share, class_key, capacity_key in (
+            (cop.engine_type_gasoline, shares['gasoline'], 'cls_gas', 'eng_gas'),
+            (cop.engine_type_diesel, 1. - shares['gasoline'], 'cls_dsl', 'eng_dsl')):
+        pc_distance = distance * shares['pc'] * fuel_share
+        if pc_distance <= 0.:
+            continue
+        for copert_class, class_share in _shares(classes[class_key]):
+            v = speed
+            if engine_type == cop.engine_type_gasoline and copert_class <= cop.class_Euro_4:
+                v = min(max(speed, PC_GASOLINE_SPEED_RANGE[0]), PC_GASOLINE_SPEED_RANGE[1])
+            for engine_capacity, capacity_share in _shares(classes[capacity_key]):
+                emissions['pc'] += _evaluate(
+                    profiler, 'PC', EQUATIONS['PC', engine_type], cop.Emission,
+                    pollutant, v, pc_distance * class_share * capacity_share,
+                    cop.vehicle_type_passenger_car, engine_type, copert_class,
+                    engine_capacity, temperature) \
+                    * _cold_start_factor(cop, accuracy, cop.vehicle_type_passenger_car,
+                                         engine_type, pollutant, v, copert_class,
+                                         engine_capacity, temperature, profiler)
+
+    # Light commercial vehicles, with the class proportions of the gasoline
+    # passenger cars.
+    ldv_distance = distance * shares['ldv']
+    if ldv_distance > 0.:
+        for engine_type, fuel_share in ((cop.engine_type_gasoline, shares['gasoline']),
+                                        (cop.engine_type_diesel, 1. - shares['gasoline'])):
+            for copert_class, class_share in _shares(classes['cls_gas']):
+                emissions['ldv'] += _evaluate(
+                    profiler, 'LDV', EQUATIONS['LDV', None], cop.Emission,
+                    pollutant, speed, ldv_distance * fuel_share * class_share,
+                    cop.vehicle_type_light_commercial_vehicle, engine_type,
+                    copert_class, None, temperature) \
+                    * _cold_start_factor(cop, accuracy, cop.vehicle_type_light_commercial_vehicle,
+                                         engine_type, pollutant, speed, copert_class,
+                                         None, temperature, profiler)
+
+    # Heavy duty vehicles: all diesel Euro VI.
+    hdv_distance = distance * shares['hdv']
+    if hdv_distance > 0.:
+        emissions['hdv'] = _evaluate(profiler, 'HDV', EQUATIONS['HDV', None], cop.Emission,
+                                     pollutant, speed, hdv_distance,
+                                     cop.vehicle_type_heavy_duty_vehicle,
+                                     cop.engine_type_diesel, cop.class_hdv_Euro_VI,
+                                     None, temperature)
+
+    # Motorcycles, by engine type and class. The speed is brought into the
+    # validity range of the emission factor.
+    moto_distance = distance * shares['moto']
+    if moto_distance > 0.:
+        i_pollutant = cop.index_pollutant[pollutant]
+        for engine_type, engine_share, class_key in (
+                (cop.engine_type_moto_two_stroke_more_50, 1. - shares['4stroke'], 'moto_2s'),
+                (cop.engine_type_moto_four_stroke_50_250, shares['4stroke'], 'moto_4s')):
+            i_engine_type = cop.index_moto_engine_type[engine_type]
+            for column, class_share in _shares(classes[class_key]):
+                copert_class = moto_copert_class(column)
+                vmin, vmax = cop.motorcycle_parameter[
+                    i_engine_type, i_pollutant,
+                    cop.index_copert_class_motorcycle[copert_class], :2]
+                if np.isnan(vmin) or np.isnan(vmax):
+                    continue
+                emissions['moto'] += moto_distance * engine_share * class_share \
+                    * _evaluate(profiler, 'Moto', EQUATIONS['Moto', None], copert.EFMotorcycle,
+                                cop, pollutant, min(max(speed, vmin), vmax),
+                                engine_type, copert_class)
+    return emissions
+
+
+def allocate_emissions(selected_pollutants, nlink):
+    """
+    Returns the zero emission arrays filled by 'compute_emissions', by
+    pollutant and vehicle category (and 'total').
+    """
+    return {poll: {category: np.zeros(nlink)
+                   for category in ('pc', 'ldv', 'hdv', 'moto', 'total')}
+            for poll in selected_pollutants}
+
+
+def compute_emissions(cop, data_link, proportions, selected_pollutants,
+                      accuracy=None, progress=None, cancel=None, emissions_data=None):
+    """
+    Computes the emissions in g of every link of 'data_link' (array with the
+    LINK_COLUMNS), for each pollutant and vehicle category. 'progress', if
+    given, is called with the number of links done and the number of links
+    every PROGRESS_LINKS links. If 'cancel' (a threading.Event) is set, the
+    loop stops at the next of these calls and raises Cancelled. The
+    emissions are written link after link into 'emissions_data' (see
+    'allocate_emissions'), if given, so that the finished links can be read
+    during the loop.
+    The emission factors are reported to the profiler of the context, if any
+    (see profiling.py). The slope correction is not applied: Copert has no
+    slope factor.
+    """
+    accuracy = dict(DEFAULT_ACCURACY, **(accuracy or {}))
+    data_link = np.asarray(data_link, dtype=np.float64)
+    Nlink = data_link.shape[0]
+    if data_link.shape[1] not in LINK_COLUMNS:
+        raise ValueError("Link data must have 7 or 9 columns.")
+    unknown = [poll for poll in selected_pollutants if poll not in POLLUTANTS]
+    if unknown:
+        raise ValueError("Unknown pollutants: {0}.".format(", ".join(unknown)))
+    if data_link.shape[1] == 9:
+        P_ldv, P_hdv = data_link[:, 7], data_link[:, 8]
+    else:
+        P_ldv, P_hdv = np.zeros(Nlink), np.zeros(Nlink)
+
+    if emissions_data is None:
+        emissions_data = allocate_emissions(selected_pollutants, Nlink)
+    profiler = profiling.active()
+    for i in range(Nlink):
+        length, flow, speed, p_gasoline, p_pc, p_4stroke = data_link[i, 1:7]
+        shares = {'pc': p_pc, 'ldv': P_ldv[i], 'hdv': P_hdv[i],
+                  'moto': max(1. - p_pc - P_ldv[i] - P_hdv[i], 0.),
+                  'gasoline': p_gasoline, '4stroke': p_4stroke}
+        classes = {key: data[i] for key, data in proportions.items()}
+        for poll in selected_pollutants:
+            if profiler is not None:
+                profiler.pollutant = poll
+            emissions = link_emissions(cop, POLLUTANTS[poll], accuracy,
+                                       length * flow, speed, shares, classes, profiler)
+            for category, value in emissions.items():
+                emissions_data[poll][category][i] = value
+            emissions_data[poll]['total'][i] = sum(emissions.values())
+        if (i + 1) % PROGRESS_LINKS == 0:
+            if progress is not None:
+                progress(i + 1, Nlink)
+            if cancel is not None and cancel.is_set():
+                raise Cancelled(i + 1)
+
+    if progress is not None:
+        progress(Nlink, Nlink)
+    return emissions_data
+
+
+def build_results_frame(data_link, emissions_data, selected_pollutants):
+    """
+    Assembles the per-link results table read by the analysis, map and
+    download tabs: OSM_ID, Length_km, then for each pollutant one column per
+    vehicle category (e.g., 'PC_Total_CO') and the total ('Total_CO').
+    """
+    results = {'OSM_ID': data_link[:, 0].astype(np.int64),
+               'Length_km': data_link[:, 1].astype(np.float64)}
+    for poll in selected_pollutants:
+        for category, prefix in VEHICLE_CATEGORIES:
+            results[f'{prefix}_Total_{poll}'] = emissions_data[poll][category]
+        results[f'Total_{poll}'] = emissions_data[poll]['total']
+    return pd.DataFrame(results)
+
+
+def run(link_data, selected_pollutants, files=None, accuracy=None, progress=None,
+        cop=None, cancel=None, emissions_data=None):
+    """
+    Computes the results table of a link data file (path, file object or
+    table from 'read_link_data'). 'files' holds the parameter and proportion
+    files with the keys of PARAMETER_FILES and PROPORTION_FILES (paths or
+    file objects); the default files are used for the missing ones. The
+    parameter files are not read if a Copert instance 'cop' is given.
+    'progress', 'cancel' and 'emissions_data' are passed to
+    'compute_emissions'.
+    """
+    files = files or {}
+    if not isinstance(link_data, pd.DataFrame):
+        with instrumentation.span("read_link_data") as span:
+            link_data = read_link_data(link_data)
+            span.count(links=len(link_data))
+    data_link = link_data.to_numpy(dtype=np.float64)
+    if cop is None:
+        with instrumentation.span("load_copert"):
+            cop = load_copert(files.get("pc"), files.get("ldv"), files.get("hdv"), files.get("moto"))
+    with instrumentation.span("load_proportions", files=len(PROPORTION_FILES), links=data_link.shape[0]):
+        proportions = load_proportions(files, data_link.shape[0])
+    with instrumentation.span("emission_loop", links=data_link.shape[0],
+                              pollutants=len(selected_pollutants)):
+        emissions_data = compute_emissions(cop, data_link, proportions, selected_pollutants,
+                                           accuracy, progress, cancel, emissions_data)
+    with instrumentation.span("build_results", links=data_link.shape[0]) as span:
+        results_df = build_results_frame(data_link, emissions_data, selected_pollutants)
+        span.count(columns=results_df.shape[1])
+    return results_df
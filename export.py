@@ -0,0 +1,259 @@
+# This file writes the per-link results to files for download. Exports are
+# written in chunks to files on disk, only when a download is requested, and
+# are kept for later requests of the same results.
+
+import hashlib
+import importlib.util
+import io
+import os
+import tempfile
+import zipfile
+
+import numpy as np
+import pandas as pd
+
+import instrumentation
+import vector_export
+
+EXPORT_DIR = os.path.join(tempfile.gettempdir(), "emission_exports")
+# Number of rows formatted at once; bounds the memory used by the CSV text.
+CSV_CHUNK_ROWS = 20_000
+# Number of export files kept in EXPORT_DIR.
+MAX_EXPORT_FILES = 8
+
+# Typed columnar formats: file suffix, MIME type and available compressions
+# (the first one is the default). Parquet and Feather need pyarrow; NPZ only
+# needs numpy.
+COLUMNAR_FORMATS = {
+    "Parquet": (".parquet", "application/vnd.apache.parquet",
+                ["zstd", "snappy", "gzip", "none"]),
+    "Feather": (".feather", "application/vnd.apache.arrow.file",
+                ["zstd", "lz4", "none"]),
+    "NPZ": (".npz", "application/octet-stream", ["deflate", "none"]),
+}
+
+# Vector layers of the links with their results, for GIS software: file
+# suffix, MIME type and writer.
+GIS_FORMATS = {
+    "FlatGeobuf": (".fgb", "application/octet-stream",
+                   vector_export.write_flatgeobuf),
+    "GeoJSON": (".geojson", "application/geo+json",
+                vector_export.write_geojson),
+}
+
+
+def results_digest(df, *extra):
+    """
+    Returns a digest of the results table (and of the other values 'extra'
+    written in the export), computed from vectorized row hashes.
+    """
+    digest = hashlib.sha256()
+    digest.update(repr((list(df.columns), extra)).encode("utf-8"))
+    digest.update(pd.util.hash_pandas_object(df, index=False).values.data)
+    return digest.hexdigest()
+
+
+def write_csv(df, stream, chunk_rows=CSV_CHUNK_ROWS):
+    """
+    Writes the results table as CSV text to a binary stream, 'chunk_rows'
+    rows at a time, so that the whole table is never formatted in memory.
+    """
+    for start in range(0, max(len(df), 1), chunk_rows):
+        chunk = df.iloc[start:start + chunk_rows].to_csv(header=start == 0,
+                                                         index=False)
+        stream.write(chunk.encode("utf-8"))
+
+
+def _cached_export(name, digest, writer):
+    """
+    Returns the path of the export file 'digest'_'name', written with
+    'writer(stream)' if it does not exist yet.
+    """
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    path = os.path.join(EXPORT_DIR, "{0}_{1}".format(digest[:32], name))
+    if not os.path.exists(path):
+        tmp_path = "{0}.{1}.tmp".format(path, os.getpid())
+        with instrumentation.span("export", file=name) as span:
+            with open(tmp_path, "wb") as stream:
+                writer(stream)
+            span.count(bytes=os.path.getsize(tmp_path))
+        os.replace(tmp_path, path)
+    # The modification time records the last use; the oldest files are
+    # removed.
+    os.utime(path)
+    files = sorted((os.path.join(EXPORT_DIR, f) for f in os.listdir(EXPORT_DIR)
+                    if not f.endswith(".tmp")), key=os.path.getmtime)
+    for old in files[:-MAX_EXPORT_FILES]:
+        try:
+            os.remove(old)
+        except OSError:
+            pass
+    return path
+
+
+def read_export(path):
+    """
+    Returns the content of an export file. The file is closed at once: the
+    download buttons that call the exports would otherwise leave it open.
+    """
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def csv_export(df):
+    """
+    Returns the results table as CSV bytes.
+    """
+    path = _cached_export("emission_results.csv", results_digest(df),
+                          lambda stream: write_csv(df, stream))
+    return read_export(path)
+
+
+def zip_export(df, report):
+    """
+    Returns the bytes of a ZIP package holding the results table as
+    CSV, streamed into the archive chunk by chunk, and the report text with
+    the date and time of the download. Only the CSV part is cached: the
+    report is appended to a copy of it on every call.
+    """
+    def writer(stream):
+        with zipfile.ZipFile(stream, "w", zipfile.ZIP_DEFLATED) as zf:
+            with zf.open("emission_results.csv", "w", force_zip64=True) as f:
+                write_csv(df, f)
+
+    path = _cached_export("traffic_emission_analysis.zip", results_digest(df), writer)
+    package = io.BytesIO(read_export(path))
+    with zipfile.ZipFile(package, "a", zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr("report_metadata.txt",
+                    (report + "Date Generated: {0}\n".format(
+                        pd.Timestamp.now().strftime("%Y-%m-%d %H:%M:%S"))).encode("utf-8"))
+    return package.getvalue()
+
+
+def available_columnar_formats():
+    """
+    Returns the columnar formats whose dependencies are installed.
+    """
+    if importlib.util.find_spec("pyarrow") is None:
+        return ["NPZ"]
+    return list(COLUMNAR_FORMATS)
+
+
+def write_columnar(df, stream, file_format, compression="none"):
+    """
+    Writes the results table, with its column types, to a binary stream in
+    one of the COLUMNAR_FORMATS.
+    """
+    if file_format == "Parquet":
+        df.to_parquet(stream, index=False,
+                      compression=None if compression == "none"
+                      else compression)
+    elif file_format == "Feather":
+        df.reset_index(drop=True).to_feather(
+            stream, compression="uncompressed" if compression == "none"
+            else compression)
+    elif file_format == "NPZ":
+        # One array per column; '__columns__' keeps their order.
+        arrays = {"__columns__": np.array(df.columns, dtype=str)}
+        for i, column in enumerate(df.columns):
+            arrays["c{0}".format(i)] = df[column].to_numpy()
+        save = np.savez if compression == "none" else np.savez_compressed
+        save(stream, **arrays)
+    else:
+        raise ValueError("Unknown format: {0}.".format(file_format))
+
+
+def columnar_export(df, file_format, compression="none"):
+    """
+    Returns the results table in a columnar format, as bytes.
+    """
+    suffix = COLUMNAR_FORMATS[file_format][0]
+    path = _cached_export(
+        "emission_results" + suffix,
+        results_digest(df, file_format, compression),
+        lambda stream: write_columnar(df, stream, file_format, compression))
+    return read_export(path)
+
+
+def file_format_of(path):
+    """
+    Returns the format ("CSV", one of the COLUMNAR_FORMATS or of the
+    GIS_FORMATS) of an output file, from its suffix.
+    """
+    suffix = os.path.splitext(path)[1].lower()
+    if suffix == ".csv":
+        return "CSV"
+    for formats in (COLUMNAR_FORMATS, GIS_FORMATS):
+        for file_format, (format_suffix, _, _) in formats.items():
+            if suffix == format_suffix:
+                return file_format
+    raise ValueError("Unknown output format: '{0}'.".format(suffix))
+
+
+def write_results(df, path, file_format=None, compression=None, network=None):
+    """
+    Writes the results table to a file, in the format given by its suffix if
+    'file_format' is None. The GIS_FORMATS need the HighwayGeometry 'network'
+    of the links. The default compression of the format is used if
+    'compression' is None.
+    """
+    file_format = file_format or file_format_of(path)
+    if file_format in GIS_FORMATS and network is None:
+        raise ValueError("The {0} format needs the OSM file of the links."
+                         .format(file_format))
+    with instrumentation.span("export", format=file_format, rows=len(df)), \
+            open(path, "wb") as stream:
+        if file_format == "CSV":
+            write_csv(df, stream)
+        elif file_format in GIS_FORMATS:
+            GIS_FORMATS[file_format][2](stream, network, df)
+        elif file_format in COLUMNAR_FORMATS:
+            write_columnar(df, stream, file_format,
+                           compression or COLUMNAR_FORMATS[file_format][2][0])
+        else:
+            raise ValueError("Unknown format: {0}.".format(file_format))
+
+
+def load_results(source):
+    """
+    Loads a results table written by 'write_columnar' or as CSV, from a path
+    or a file object. The format is recognized from the first bytes.
+    """
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, "rb") as f:
+            return load_results(f)
+    source.seek(0)
+    head = source.read(8)
+    source.seek(0)
+    if head.startswith(b"PAR1"):
+        return pd.read_parquet(source)
+    if head.startswith(b"ARROW1"):
+        return pd.read_feather(source)
+    if head.startswith(b"PK"):
+        # The CSV packages of 'zip_export' are ZIP files too.
+        with zipfile.ZipFile(source) as zf:
+            if "emission_results.csv" in zf.namelist():
+                with zf.open("emission_results.csv") as f:
+                    return pd.read_csv(f)
+        source.seek(0)
+        with np.load(source, allow_pickle=False) as data:
+            columns = data["__columns__"].tolist()
+            return pd.DataFrame({column: data["c{0}".format(i)]
+                                 for i, column in enumerate(columns)})
+    return pd.read_csv(source)
+
+
+def gis_export(df, network, file_format):
+    """
+    Returns the links of the HighwayGeometry 'network' and their results
+    as a vector layer in one of the GIS_FORMATS, as bytes.
+    """
+    suffix, _, writer = GIS_FORMATS[file_format]
+    network_digest = hashlib.sha256()
+    for array in (network.offsets, network.lon, network.lat, network.osmid):
+        network_digest.update(np.ascontiguousarray(array).data)
+    path = _cached_export(
+        "emission_links" + suffix,
+        results_digest(df, file_format, network_digest.hexdigest()),
+        lambda stream: writer(stream, network, df))
+    return read_export(path)
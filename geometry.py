@@ -0,0 +1,293 @@
+# This file gathers vectorized computations on polylines stored in compressed
+# sparse row (CSR) form: the nodes of polyline 'i' are x[offsets[i]:offsets[i
+# + 1]] and y[offsets[i]:offsets[i + 1]]. Coordinates are longitudes and
+# latitudes in degrees.
+
+import numpy as np
+
+# Mean Earth radius, in kilometers.
+EARTH_RADIUS_KM = 6371.0088
+
+# Maximum number of (segment, polygon edge) pairs tested at once when
+# clipping, in order to bound the memory used by the broadcast arrays.
+_CLIP_BLOCK_SIZE = 1 << 22
+
+
+def points_inside_polygon(x, y, poly):
+    """
+    Determines which points (x[i], y[i]) are inside a polygon defined by a
+    list of (x, y) tuples/lists using the Ray Casting Algorithm. The loop
+    runs over the edges of the polygon only, never over the points.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    poly = np.asarray(poly, dtype=np.float64)
+    inside = np.zeros(x.shape, dtype=bool)
+    p1x, p1y = poly[-1]
+    for p2x, p2y in poly:
+        if p1y != p2y:
+            crossing = (y > min(p1y, p2y)) & (y <= max(p1y, p2y)) \
+                & (x <= max(p1x, p2x))
+            if p1x != p2x:
+                xinters = (y - p1y) * (p2x - p1x) / (p2y - p1y) + p1x
+                crossing &= x <= xinters
+            inside ^= crossing
+        p1x, p1y = p2x, p2y
+    return inside
+
+
+def haversine(lon1, lat1, lon2, lat2):
+    """
+    Returns the great-circle distance, in kilometers, between the points
+    (lon1, lat1) and (lon2, lat2), given in degrees.
+    """
+    lon1, lat1, lon2, lat2 = map(np.radians, (lon1, lat1, lon2, lat2))
+    a = np.sin((lat2 - lat1) / 2.) ** 2 \
+        + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2.) ** 2
+    return 2. * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.)))
+
+
+def polyline_lengths(offsets, x, y):
+    """
+    Returns the great-circle length, in kilometers, of every polyline. The
+    lengths of all segments are computed at once and summed per polyline
+    with 'np.add.reduceat'.
+    """
+    offsets = np.asarray(offsets, dtype=np.int64)
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    count = np.diff(offsets)
+    # Length of the segment starting at every node; zero for the last node of
+    # each polyline, which starts no segment.
+    segment_length = np.zeros(len(x))
+    segment_length[:-1] = haversine(x[:-1], y[:-1], x[1:], y[1:])
+    segment_length[offsets[1:][count > 0] - 1] = 0.
+    length = np.zeros(len(count))
+    non_empty = count > 0
+    if non_empty.any():
+        length[non_empty] = np.add.reduceat(segment_length,
+                                            offsets[:-1][non_empty])
+    return length
+
+
+def lengths_by_id(ids, length):
+    """
+    Sums the lengths of the polylines that share the same ID (e.g., the
+    parts of a clipped OSM way). Returns the sorted unique IDs and their
+    total lengths.
+    """
+    unique_id, inverse = np.unique(np.asarray(ids), return_inverse=True)
+    return unique_id, np.bincount(inverse, weights=length,
+                                  minlength=len(unique_id))
+
+
+def segment_starts(offsets):
+    """
+    Returns the indices of the first node of every segment of the polylines,
+    and the index of the polyline each segment belongs to.
+    """
+    offsets = np.asarray(offsets, dtype=np.int64)
+    count = np.diff(offsets)
+    is_start = np.ones(offsets[-1], dtype=bool)
+    # The last node of a polyline starts no segment.
+    is_start[offsets[1:][count > 0] - 1] = False
+    start = np.flatnonzero(is_start)
+    polyline = np.repeat(np.arange(len(count)), count)[start]
+    return start, polyline
+
+
+def _segment_polygon_intersections(x0, y0, x1, y1, poly):
+    """
+    Returns the index of the segments that cross an edge of the polygon, and
+    the position (between 0 and 1) of the crossing along the segment.
+    """
+    qx0, qy0 = poly[:, 0], poly[:, 1]
+    qx1, qy1 = np.roll(qx0, -1), np.roll(qy0, -1)
+    ex, ey = qx1 - qx0, qy1 - qy0
+    block = max(1, _CLIP_BLOCK_SIZE // len(poly))
+    index = [np.zeros(0, dtype=np.int64)]
+    position = [np.zeros(0)]
+    for first in range(0, len(x0), block):
+        sl = slice(first, first + block)
+        dx = (x1[sl] - x0[sl])[:, None]
+        dy = (y1[sl] - y0[sl])[:, None]
+        wx = qx0[None, :] - x0[sl][:, None]
+        wy = qy0[None, :] - y0[sl][:, None]
+        denom = dx * ey - dy * ex
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t = (wx * ey - wy * ex) / denom
+            u = (wx * dy - wy * dx) / denom
+        hit = (denom != 0) & (t > 0) & (t < 1) & (u >= 0) & (u <= 1)
+        i_segment, i_edge = np.nonzero(hit)
+        index.append(i_segment + first)
+        position.append(t[i_segment, i_edge])
+    return np.concatenate(index), np.concatenate(position)
+
+
+def clip_polylines(offsets, x, y, poly):
+    """
+    Clips polylines at the boundary of a polygon and keeps their parts
+    inside it.
+
+    Every segment is cut at its crossings with the polygon edges, and each
+    resulting piece is kept if its middle lies inside the polygon. Kept
+    pieces that follow each other along a polyline are joined again.
+
+    Returns the CSR offsets and coordinates of the clipped parts, the index
+    of the input polyline each part comes from, and the length of each part
+    in kilometers. A polyline that leaves and re-enters the polygon gives
+    several parts.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    poly = np.asarray(poly, dtype=np.float64)
+    start, polyline = segment_starts(offsets)
+    x0, y0, x1, y1 = x[start], y[start], x[start + 1], y[start + 1]
+
+    # Cut positions along every segment: both ends, plus the crossings with
+    # the polygon, sorted by segment then by position.
+    crossing, t_crossing = _segment_polygon_intersections(x0, y0, x1, y1,
+                                                          poly)
+    n_segment = len(start)
+    cut_segment = np.concatenate([np.arange(n_segment), np.arange(n_segment),
+                                  crossing])
+    cut_t = np.concatenate([np.zeros(n_segment), np.ones(n_segment),
+                            t_crossing])
+    order = np.lexsort((cut_t, cut_segment))
+    cut_segment, cut_t = cut_segment[order], cut_t[order]
+
+    # Pieces between consecutive cuts of the same segment.
+    valid = (cut_segment[:-1] == cut_segment[1:]) & (cut_t[:-1] < cut_t[1:])
+    segment = cut_segment[:-1][valid]
+    t0, t1 = cut_t[:-1][valid], cut_t[1:][valid]
+    dx, dy = x1[segment] - x0[segment], y1[segment] - y0[segment]
+    xs, ys = x0[segment] + t0 * dx, y0[segment] + t0 * dy
+    xe, ye = x0[segment] + t1 * dx, y0[segment] + t1 * dy
+    inside = points_inside_polygon((xs + xe) / 2., (ys + ye) / 2., poly)
+
+    # A clipped part starts at every kept piece whose predecessor is dropped
+    # or belongs to another polyline.
+    kept_polyline = polyline[segment]
+    follows = np.zeros(len(segment), dtype=bool)
+    follows[1:] = inside[:-1] & (kept_polyline[1:] == kept_polyline[:-1])
+    first = ~follows[inside]
+    xs, ys, xe, ye = xs[inside], ys[inside], xe[inside], ye[inside]
+    kept_polyline = kept_polyline[inside]
+
+    # Nodes of the parts: the start of the first piece, then the end of every
+    # piece.
+    emit = np.column_stack([first, np.ones(len(first), dtype=bool)]).ravel()
+    x_out = np.column_stack([xs, xe]).ravel()[emit]
+    y_out = np.column_stack([ys, ye]).ravel()[emit]
+    part_first = np.flatnonzero(first)
+    part_count = np.diff(np.append(part_first, len(first))) + 1
+    part_offsets = np.zeros(len(part_first) + 1, dtype=np.int64)
+    np.cumsum(part_count, out=part_offsets[1:])
+
+    return part_offsets, x_out, y_out, kept_polyline[part_first], \
+        polyline_lengths(part_offsets, x_out, y_out)
+
+
+def polyline_bounds(offsets, x, y):
+    """
+    Returns the bounding box (x_min, y_min, x_max, y_max) of every polyline.
+    Empty polylines get NaN bounds.
+    """
+    offsets = np.asarray(offsets, dtype=np.int64)
+    count = np.diff(offsets)
+    non_empty = count > 0
+    bounds = np.full((4, len(count)), np.nan)
+    if non_empty.any():
+        first = offsets[:-1][non_empty]
+        bounds[0, non_empty] = np.minimum.reduceat(x, first)
+        bounds[1, non_empty] = np.minimum.reduceat(y, first)
+        bounds[2, non_empty] = np.maximum.reduceat(x, first)
+        bounds[3, non_empty] = np.maximum.reduceat(y, first)
+    return bounds
+
+
+def simplify_polylines(offsets, x, y, tolerance):
+    """
+    Simplifies all polylines at once with the Douglas-Peucker algorithm.
+
+    Every iteration handles all the ranges still to be examined, of all
+    polylines together: the node farthest from the chord of each range is
+    found with 'np.maximum.reduceat', and the range is split there if the
+    distance exceeds 'tolerance'. The number of iterations is the depth of
+    the recursion, not the number of polylines. Distances are measured in
+    degrees of latitude, the longitudes being scaled by the cosine of the
+    latitude.
+
+    Returns the CSR offsets and coordinates of the simplified polylines. The
+    first and last nodes of every polyline are always kept.
+    """
+    offsets = np.asarray(offsets, dtype=np.int64)
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    count = np.diff(offsets)
+    keep = np.zeros(len(x), dtype=bool)
+    keep[offsets[:-1][count > 0]] = True
+    keep[offsets[1:][count > 0] - 1] = True
+    x_scaled = x * np.cos(np.radians(y))
+
+    start = offsets[:-1][count > 2]
+    end = offsets[1:][count > 2] - 1
+    while len(start) > 0:
+        # Interior nodes of every range, range after range.
+        n_inner = end - start - 1
+        first = np.cumsum(n_inner) - n_inner
+        owner = np.repeat(np.arange(len(start)), n_inner)
+        node = np.arange(n_inner.sum()) - first[owner] + start[owner] + 1
+        ax, ay = x_scaled[start][owner], y[start][owner]
+        dx, dy = x_scaled[end][owner] - ax, y[end][owner] - ay
+        px, py = x_scaled[node] - ax, y[node] - ay
+        chord = np.hypot(dx, dy)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            distance = np.where(chord > 0, np.abs(dx * py - dy * px) / chord,
+                                np.hypot(px, py))
+        distance_max = np.maximum.reduceat(distance, first)
+        # First node reaching the maximum in every range.
+        at_max = np.flatnonzero(distance == distance_max[owner])
+        _, first_at_max = np.unique(owner[at_max], return_index=True)
+        farthest = node[at_max[first_at_max]]
+
+        split = distance_max > tolerance
+        farthest = farthest[split]
+        keep[farthest] = True
+        start, end = np.concatenate([start[split], farthest]), \
+            np.concatenate([farthest, end[split]])
+        longer = end - start > 1
+        start, end = start[longer], end[longer]
+
+    polyline = np.repeat(np.arange(len(count)), count)
+    new_offsets = np.zeros(len(count) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(polyline[keep], minlength=len(count)),
+              out=new_offsets[1:])
+    return new_offsets, x[keep], y[keep]
+
+
+def pixel_size(zoom, latitude=0.):
+    """
+    Returns the size, in degrees of latitude, of a pixel of a 256-pixel tile
+    map at the given zoom level. It is the simplification tolerance that
+    leaves no visible difference at this zoom level.
+    """
+    return 360. / (256. * 2. ** zoom) * np.cos(np.radians(latitude))
+
+
+def nan_separated(offsets, x, y):
+    """
+    Returns the coordinates of all polylines concatenated, with a NaN after
+    every polyline, as expected by plotting libraries to draw many lines
+    with a single trace.
+    """
+    offsets = np.asarray(offsets, dtype=np.int64)
+    count = np.diff(offsets)
+    polyline = np.repeat(np.arange(len(count)), count)
+    x_out = np.full(len(x) + len(count), np.nan)
+    y_out = np.full(len(y) + len(count), np.nan)
+    # Node 'i' of polyline 'j' moves 'j' places to the right.
+    position = np.arange(len(x)) + polyline
+    x_out[position] = x
+    y_out[position] = y
+    return x_out, y_out
@@ -0,0 +1,211 @@
+# This file distributes the emissions of the road links onto a regular grid,
+# e.g. as input of a dispersion model. The emissions of a link are split
+# along its segments in proportion to the length inside every cell.
+
+import io
+import zipfile
+
+import numpy as np
+
+import geometry
+
+# Spherical Earth radius, in meters, used by the metric projection.
+EARTH_RADIUS_M = geometry.EARTH_RADIUS_KM * 1000.
+
+
+# Regular grid of 'nx' x 'ny' cells of size 'dx' x 'dy' whose lower left
+# corner is (x_min, y_min). The grid is either in longitude/latitude degrees,
+# or metric: in meters, in the equirectangular projection of standard parallel
+# 'lat0' and central meridian 'lon0' on a spherical Earth (PROJ "+proj=eqc
+# +lat_ts=lat0 +lon_0=lon0 +R=6371008.8"), which is close to conformal around
+# the study area.
+class Grid(object):
+    def __init__(self, x_min, y_min, dx, dy, nx, ny, metric=False, lon0=0.,
+                 lat0=0.):
+        self.x_min, self.y_min = float(x_min), float(y_min)
+        self.dx, self.dy = float(dx), float(dy)
+        self.nx, self.ny = int(nx), int(ny)
+        self.metric = metric
+        self.lon0, self.lat0 = float(lon0), float(lat0)
+
+    @classmethod
+    def from_bounds(cls, lon_min, lat_min, lon_max, lat_max, cell_size,
+                    metric=False):
+        """
+        Returns the grid of cells of size 'cell_size' (in degrees, or in
+        meters if 'metric') covering the given longitude/latitude bounds.
+        """
+        lon0, lat0 = (lon_min + lon_max) / 2., (lat_min + lat_max) / 2.
+        grid = cls(0., 0., cell_size, cell_size, 1, 1, metric, lon0, lat0)
+        x, y = grid.project(np.array([lon_min, lon_max]),
+                            np.array([lat_min, lat_max]))
+        grid.x_min, grid.y_min = x[0], y[0]
+        grid.nx = max(1, int(np.ceil((x[1] - x[0]) / cell_size)))
+        grid.ny = max(1, int(np.ceil((y[1] - y[0]) / cell_size)))
+        return grid
+
+    @property
+    def x_max(self):
+        return self.x_min + self.nx * self.dx
+
+    @property
+    def y_max(self):
+        return self.y_min + self.ny * self.dy
+
+    def project(self, lon, lat):
+        """
+        Returns the coordinates of the points in the grid system.
+        """
+        lon = np.asarray(lon, dtype=np.float64)
+        lat = np.asarray(lat, dtype=np.float64)
+        if not self.metric:
+            return lon, lat
+        return EARTH_RADIUS_M * np.radians(lon - self.lon0) \
+            * np.cos(np.radians(self.lat0)), EARTH_RADIUS_M * np.radians(lat)
+
+    def cell_centers(self):
+        """
+        Returns the coordinates of the cell centers along x and along y.
+        """
+        return self.x_min + (np.arange(self.nx) + 0.5) * self.dx, \
+            self.y_min + (np.arange(self.ny) + 0.5) * self.dy
+
+
+def _grid_line_crossings(u0, u1):
+    """
+    Returns the index of the segments that cross an integer value of 'u'
+    (a grid line), and the position (between 0 and 1) of every crossing
+    along its segment.
+    """
+    low = np.floor(np.minimum(u0, u1))
+    high = np.ceil(np.maximum(u0, u1))
+    count = np.maximum(high - low - 1, 0).astype(np.int64)
+    segment = np.repeat(np.arange(len(u0)), count)
+    first = np.cumsum(count) - count
+    line = low[segment] + 1 + np.arange(count.sum()) - first[segment]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = (line - u0[segment]) / (u1[segment] - u0[segment])
+    return segment, t
+
+
+def grid_emissions(offsets, lon, lat, emission, grid):
+    """
+    Distributes the emissions of polylines on a grid.
+
+    'emission' has one row per polyline and one column per pollutant. The
+    emission of a polyline is split along its segments in proportion to the
+    great-circle length in every cell. Every segment is cut at the grid lines
+    it crosses, and the pieces are accumulated in their cells with a single
+    'np.bincount' for all pollutants. Emissions on pieces outside the grid,
+    and rows with NaN, are ignored.
+
+    Returns an array of shape (number of pollutants, ny, nx).
+    """
+    emission = np.asarray(emission, dtype=np.float64)
+    if emission.ndim == 1:
+        emission = emission[:, None]
+    n_pollutant = emission.shape[1]
+    lon = np.asarray(lon, dtype=np.float64)
+    lat = np.asarray(lat, dtype=np.float64)
+    start, polyline = geometry.segment_starts(offsets)
+    x, y = grid.project(lon, lat)
+    # Coordinates in cell units.
+    u, v = (x - grid.x_min) / grid.dx, (y - grid.y_min) / grid.dy
+    u0, v0, u1, v1 = u[start], v[start], u[start + 1], v[start + 1]
+
+    segment_length = geometry.haversine(lon[start], lat[start],
+                                        lon[start + 1], lat[start + 1])
+    polyline_length = np.bincount(polyline, weights=segment_length,
+                                  minlength=len(emission))
+
+    # Cut positions: segment ends and crossings with the grid lines, sorted
+    # by segment then by position.
+    n_segment = len(start)
+    cross_u, t_u = _grid_line_crossings(u0, u1)
+    cross_v, t_v = _grid_line_crossings(v0, v1)
+    cut_segment = np.concatenate([np.arange(n_segment), np.arange(n_segment),
+                                  cross_u, cross_v])
+    cut_t = np.concatenate([np.zeros(n_segment), np.ones(n_segment), t_u,
+                            t_v])
+    order = np.lexsort((cut_t, cut_segment))
+    cut_segment, cut_t = cut_segment[order], cut_t[order]
+    valid = (cut_segment[:-1] == cut_segment[1:]) & (cut_t[:-1] < cut_t[1:])
+    segment = cut_segment[:-1][valid]
+    t0, t1 = cut_t[:-1][valid], cut_t[1:][valid]
+
+    # Cell of every piece, from its middle. A piece along the upper edge of
+    # the grid (which 'from_bounds' puts on the extreme nodes when the
+    # extent is a multiple of the cell size) goes to the last cell.
+    t_mid = (t0 + t1) / 2.
+    u_mid = u0[segment] + t_mid * (u1[segment] - u0[segment])
+    v_mid = v0[segment] + t_mid * (v1[segment] - v0[segment])
+    i = np.where(u_mid == grid.nx, grid.nx - 1, np.floor(u_mid))
+    j = np.where(v_mid == grid.ny, grid.ny - 1, np.floor(v_mid))
+    owner = polyline[segment]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        fraction = segment_length[segment] * (t1 - t0) \
+            / polyline_length[owner]
+    inside = (i >= 0) & (i < grid.nx) & (j >= 0) & (j < grid.ny) \
+        & np.isfinite(fraction)
+    cell = (j[inside] * grid.nx + i[inside]).astype(np.int64)
+    weight = emission[owner[inside]] * fraction[inside][:, None]
+    valid_weight = np.isfinite(weight)
+
+    n_cell = grid.nx * grid.ny
+    index = cell[:, None] + n_cell * np.arange(n_pollutant)[None, :]
+    total = np.bincount(index[valid_weight], weights=weight[valid_weight],
+                        minlength=n_cell * n_pollutant)
+    return total.reshape(n_pollutant, grid.ny, grid.nx)
+
+
+def raster_projection_wkt(grid):
+    """
+    Returns the WKT description of the coordinate system of the grid.
+    """
+    if not grid.metric:
+        return ('GEOGCS["WGS 84",DATUM["WGS_1984",SPHEROID["WGS 84",6378137,'
+                '298.257223563]],PRIMEM["Greenwich",0],'
+                'UNIT["degree",0.0174532925199433]]')
+    return ('PROJCS["Equirectangular",GEOGCS["Sphere",DATUM["Sphere",'
+            'SPHEROID["Sphere",{0},0]],PRIMEM["Greenwich",0],'
+            'UNIT["degree",0.0174532925199433]],'
+            'PROJECTION["Equirectangular"],'
+            'PARAMETER["standard_parallel_1",{1}],'
+            'PARAMETER["central_meridian",{2}],'
+            'PARAMETER["false_easting",0],PARAMETER["false_northing",0],'
+            'UNIT["metre",1]]').format(EARTH_RADIUS_M, grid.lat0, grid.lon0)
+
+
+def write_raster(grid, values, names, name="emission_grid"):
+    """
+    Returns a ZIP archive with the gridded emissions as an ESRI BIL raster:
+    'name'.bil holds one float32 band per pollutant (little-endian, rows
+    from north to south), 'name'.hdr its header, 'name'.prj its coordinate
+    system and 'name'.txt the names of the bands.
+    """
+    values = np.asarray(values, dtype=np.float32)
+    # Band interleaved by line: for every row, from the north, all bands.
+    data = np.ascontiguousarray(values[:, ::-1, :].transpose(1, 0, 2))
+    header = "\n".join([
+        "BYTEORDER I",
+        "LAYOUT BIL",
+        "NROWS {0}".format(grid.ny),
+        "NCOLS {0}".format(grid.nx),
+        "NBANDS {0}".format(values.shape[0]),
+        "NBITS 32",
+        "PIXELTYPE FLOAT",
+        "ULXMAP {0!r}".format(grid.x_min + grid.dx / 2.),
+        "ULYMAP {0!r}".format(grid.y_max - grid.dy / 2.),
+        "XDIM {0!r}".format(grid.dx),
+        "YDIM {0!r}".format(grid.dy),
+        ""])
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr(name + ".bil", data.astype("<f4").tobytes())
+        zf.writestr(name + ".hdr", header)
+        zf.writestr(name + ".prj", raster_projection_wkt(grid))
+        zf.writestr(name + ".txt", "\n".join(
+            "Band {0}: {1}".format(i + 1, n) for i, n in enumerate(names))
+            + "\n")
+    buffer.seek(0)
+    return buffer
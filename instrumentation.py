@@ -0,0 +1,163 @@
+# Timing and memory spans around the stages of the calculation, the road
+# extraction, the exports and the plots. The spans are only measured inside
+# 'recording'; elsewhere 'span' costs one context variable lookup.
+
+import contextlib
+import contextvars
+import json
+import threading
+import time
+import tracemalloc
+
+# Recorder of the current context (None: the spans are not measured).
+_recorder = contextvars.ContextVar("instrumentation_recorder", default=None)
+
+# tracemalloc is process-wide: the recordings tracing memory (e.g., a
+# background job and the script thread) share it. It is started by the first
+# of them (unless it is already tracing) and stopped by the last one, and a
+# span only resets its peak while its recording is the only one tracing;
+# 'generation' counts the recordings started, so that a span knows whether
+# another one traced memory during it.
+_tracing = {"lock": threading.Lock(), "users": 0, "started": False, "generation": 0}
+
+
+class Span(object):
+    """
+    Measurements of one stage: wall time and CPU time of its thread (the
+    other threads are not counted) in seconds, peak of the memory traced
+    during the stage in MB (None if the memory is not traced, or if another
+    recording traced memory at the same time) and item
+    counts (e.g., number of links).
+    """
+    def __init__(self, name, depth, counts):
+        self.name = name
+        self.depth = depth
+        self.counts = dict(counts)
+        self.wall = 0.
+        self.cpu = 0.
+        self.peak_mb = None
+
+    def count(self, **counts):
+        """
+        Sets item counts of the span.
+        """
+        self.counts.update(counts)
+
+    def to_dict(self):
+        return {"name": self.name, "depth": self.depth,
+                "wall_s": round(self.wall, 6), "cpu_s": round(self.cpu, 6),
+                "peak_mb": None if self.peak_mb is None else round(self.peak_mb, 3),
+                "counts": self.counts}
+
+
+class _NullSpan(object):
+    # Span returned when nothing is recorded.
+    def count(self, **counts):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Recorder(object):
+    """
+    Spans measured in a 'recording' block, in the order they started.
+    """
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.spans = []
+        # Peaks of the open spans, including those of their finished children
+        # (the tracemalloc peak is reset by every span).
+        self._peaks = []
+
+    def to_dict(self):
+        return [span.to_dict() for span in self.spans]
+
+    def write_json(self, path, **metadata):
+        """
+        Writes the spans to a JSON file, with 'metadata' (e.g., the job).
+        """
+        with open(path, "w") as f:
+            json.dump(dict(metadata, spans=self.to_dict()), f, indent=2)
+
+    def totals(self):
+        """
+        Returns the wall time of the top-level spans, by name.
+        """
+        totals = {}
+        for span in self.spans:
+            if span.depth == 0:
+                totals[span.name] = totals.get(span.name, 0.) + span.wall
+        return totals
+
+
+@contextlib.contextmanager
+def recording(trace_memory=False):
+    """
+    Records the spans of the block in a new Recorder, which is returned. If
+    'trace_memory' is True, the peak memory of the spans is measured with
+    tracemalloc, which slows down the allocations.
+    """
+    recorder = Recorder(trace_memory)
+    if trace_memory:
+        with _tracing["lock"]:
+            _tracing["users"] += 1
+            _tracing["generation"] += 1
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                _tracing["started"] = True
+    token = _recorder.set(recorder)
+    try:
+        yield recorder
+    finally:
+        _recorder.reset(token)
+        if trace_memory:
+            with _tracing["lock"]:
+                _tracing["users"] -= 1
+                if _tracing["users"] == 0 and _tracing["started"]:
+                    tracemalloc.stop()
+                    _tracing["started"] = False
+
+
+def recorder():
+    """
+    Returns the Recorder of the current context, or None.
+    """
+    return _recorder.get()
+
+
+@contextlib.contextmanager
+def span(name, **counts):
+    """
+    Measures the block as a stage named 'name' with the item counts
+    'counts'. Yields the Span, whose 'count' method sets other counts.
+    """
+    recorder = _recorder.get()
+    if recorder is None:
+        yield _NULL_SPAN
+        return
+    span = Span(name, len(recorder._peaks), counts)
+    recorder.spans.append(span)
+    trace_memory = False
+    if recorder.trace_memory:
+        with _tracing["lock"]:
+            trace_memory = _tracing["users"] == 1
+            if trace_memory:
+                generation = _tracing["generation"]
+                start_memory, outer_peak = tracemalloc.get_traced_memory()
+                tracemalloc.reset_peak()
+    recorder._peaks.append(0)
+    wall, cpu = time.perf_counter(), time.thread_time()
+    try:
+        yield span
+    finally:
+        span.wall = time.perf_counter() - wall
+        span.cpu = time.thread_time() - cpu
+        child_peak = recorder._peaks.pop()
+        if trace_memory and generation == _tracing["generation"]:
+            peak = max(tracemalloc.get_traced_memory()[1], child_peak)
+            span.peak_mb = (peak - start_memory) / 1e6
+            # The peak of the enclosing span includes this one.
+            if recorder._peaks:
+                recorder._peaks[-1] = max(recorder._peaks[-1], peak, outer_peak)
+
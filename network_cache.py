@@ -0,0 +1,161 @@
+# This file keeps the road networks extracted by 'osm_network.retrieve_highway'
+# in an on-disk cache, so that the same OSM file is parsed only once.
+
+import hashlib
+import json
+import os
+
+import numpy as np
+
+import osm_network
+
+# The cache directory can be moved with the environment variable
+# EMISSION_NETWORK_CACHE_DIR.
+DEFAULT_CACHE_DIR = os.environ.get(
+    "EMISSION_NETWORK_CACHE_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "emission_calculator",
+                 "networks"))
+# Total size of the cache, in bytes, above which the least recently used
+# networks are removed.
+DEFAULT_MAX_BYTES = 1024 ** 3
+
+# Digests of the files already hashed by this process, keyed by (path, size,
+# modification time), so that a large file is not read again on every rerun.
+_digest_memo = {}
+
+
+def file_digest(osm_file):
+    """
+    Returns the SHA-256 hex digest of the content of an OSM file given by
+    its path, as a bytes buffer or as a file object.
+    """
+    if isinstance(osm_file, (str, os.PathLike)):
+        stat = os.stat(osm_file)
+        memo_key = (os.path.abspath(osm_file), stat.st_size, stat.st_mtime_ns)
+    else:
+        # Streamlit uploads have an ID that changes with the content.
+        file_id = getattr(osm_file, "file_id", None)
+        memo_key = None if file_id is None else ("upload", file_id)
+    if memo_key is not None and memo_key in _digest_memo:
+        return _digest_memo[memo_key]
+    digest = hashlib.sha256()
+    source, file_format = osm_network.open_osm_source(osm_file)
+    if file_format is None:
+        with open(source, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+    else:
+        digest.update(source)
+    if memo_key is not None:
+        _digest_memo[memo_key] = digest.hexdigest()
+    return digest.hexdigest()
+
+
+def cache_key(digest, selected_zone, tolerance, highway_tags=None,
+              clip=False):
+    """
+    Returns the cache key of a network extracted from the file of digest
+    'digest' with the given polygon, tolerance, tag filter and clipping.
+    """
+    description = {
+        "file": digest,
+        "zone": [[float(x), float(y)] for x, y in selected_zone],
+        "tolerance": float(tolerance),
+        "highway_tags": None if highway_tags is None
+        else sorted(highway_tags),
+        "clip": bool(clip),
+    }
+    return hashlib.sha256(json.dumps(description, sort_keys=True)
+                          .encode("utf-8")).hexdigest()
+
+
+def load_network(key, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Returns the cached network of key 'key', or None if it is not in the
+    cache.
+    """
+    path = os.path.join(cache_dir, key + ".npz")
+    try:
+        with np.load(path, allow_pickle=False) as data:
+            geometry = osm_network.HighwayGeometry(
+                data["offsets"], data["lon"], data["lat"], data["osmid"],
+                data["road_class"], data["road_class_names"].tolist())
+    except (OSError, KeyError, ValueError):
+        return None
+    # The modification time records the last use, for the eviction. The
+    # network is returned even if the file was evicted meanwhile, or if the
+    # cache is read-only.
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+    return geometry
+
+
+def store_network(key, geometry, cache_dir=DEFAULT_CACHE_DIR,
+                  max_bytes=DEFAULT_MAX_BYTES):
+    """
+    Saves a network in the cache, then evicts the least recently used
+    networks if the cache is larger than 'max_bytes'.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, key + ".npz")
+    # Written under a temporary name and renamed, so that a concurrent reader
+    # never sees a partial file.
+    tmp_path = "{0}.{1}.tmp".format(path, os.getpid())
+    with open(tmp_path, "wb") as f:
+        np.savez(f, offsets=geometry.offsets, lon=geometry.lon,
+                 lat=geometry.lat, osmid=geometry.osmid,
+                 road_class=geometry.road_class,
+                 road_class_names=np.array(geometry.road_class_names,
+                                           dtype=str))
+    os.replace(tmp_path, path)
+    evict(cache_dir, max_bytes, keep=path)
+
+
+def evict(cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES, keep=None):
+    """
+    Removes the least recently used networks until the total size of the
+    cache is at most 'max_bytes'. The file 'keep' is never removed.
+    """
+    entries = []
+    for name in os.listdir(cache_dir):
+        if not name.endswith(".npz"):
+            continue
+        path = os.path.join(cache_dir, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+
+
+def retrieve_highway_cached(osm_file, selected_zone, tolerance, Ncore=1,
+                            highway_tags=None, clip=False,
+                            cache_dir=DEFAULT_CACHE_DIR,
+                            max_bytes=DEFAULT_MAX_BYTES):
+    """
+    Same as 'osm_network.retrieve_highway', but the result is read from the
+    cache when the same file was already extracted with the same polygon,
+    tolerance, tag filter and clipping.
+    """
+    key = cache_key(file_digest(osm_file), selected_zone, tolerance,
+                    highway_tags, clip)
+    geometry = load_network(key, cache_dir)
+    if geometry is None:
+        geometry = osm_network.retrieve_highway(osm_file, selected_zone,
+                                                tolerance, Ncore,
+                                                highway_tags, clip)
+        store_network(key, geometry, cache_dir, max_bytes)
+    return geometry
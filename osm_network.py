@@ -20,9 +20,74 @@
 # This files retrieves the coordinates of the streets in the domain.
 
 
+from array import array
+import os
+
 import osmium
 import numpy as np
 
+from geometry import clip_polylines, points_inside_polygon, polyline_lengths
+import instrumentation
+
+# Formats understood by libosmium, as given to 'apply_buffer', and the file
+# name suffixes used to guess them when the content is not conclusive.
+OSM_FORMAT_SUFFIXES = [(".osm.pbf", "pbf"), (".pbf", "pbf"),
+                     (".osm.bz2", "osm.bz2"), (".osm.gz", "osm.gz"),
+                     (".osm", "osm"), (".xml", "osm")]
+
+def detect_osm_format(buffer, name=None):
+    """
+    Returns the libosmium format ("pbf", "osm.bz2", "osm.gz" or "osm") of
+    the OSM data in 'buffer', from its first bytes or else from 'name'.
+    """
+    head = bytes(buffer[:64])
+    # A PBF file starts with the length of the first blob header, followed by
+    # the header itself, whose type is "OSMHeader".
+    if b"OSMHeader" in head[4:20]:
+        return "pbf"
+    if head.startswith(b"BZh"):
+        return "osm.bz2"
+    if head.startswith(b"\x1f\x8b"):
+        return "osm.gz"
+    if head.lstrip(b"\xef\xbb\xbf \t\r\n").startswith(b"<"):
+        return "osm"
+    if name is not None:
+        for suffix, file_format in OSM_FORMAT_SUFFIXES:
+            if name.lower().endswith(suffix):
+                return file_format
+    raise ValueError("Unrecognized OSM data format; expected an .osm.pbf, "
+                     ".osm, .osm.bz2 or .osm.gz file.")
+
+def open_osm_source(osm_file):
+    """
+    Returns the source to give to an Osmium handler and its format. 'osm_file'
+    can be a path, in which case the format is None and libosmium reads the
+    file itself, a bytes-like object, or a file object such as a Streamlit
+    upload. In-memory data is passed as a memoryview, without any copy.
+    """
+    if isinstance(osm_file, (str, os.PathLike)):
+        return os.fspath(osm_file), None
+    if isinstance(osm_file, (bytes, bytearray, memoryview)):
+        buffer = memoryview(osm_file)
+        return buffer, detect_osm_format(buffer)
+    name = getattr(osm_file, "name", None)
+    if hasattr(osm_file, "getbuffer"):
+        buffer = osm_file.getbuffer()
+    else:
+        if hasattr(osm_file, "seek"):
+            osm_file.seek(0)
+        buffer = memoryview(osm_file.read())
+    return buffer, detect_osm_format(buffer, name)
+
+def apply_osm_source(handler, source, file_format, **kwargs):
+    """
+    Applies an Osmium handler to a source returned by 'open_osm_source'.
+    """
+    if file_format is None:
+        handler.apply_file(source, **kwargs)
+    else:
+        handler.apply_buffer(source, file_format, **kwargs)
+
 # Determines whether a point is inside a given polygon or not.
 # (This definition needs to be outside any class to be accessed globally)
 def point_inside_polygon(x, y, poly):
@@ -45,15 +110,160 @@ def point_inside_polygon(x, y, poly):
         p1x, p1y = p2x, p2y
     return inside
 
+# Values of the 'highway' tag that describe roads open to motor vehicles. It
+# can be passed as 'highway_tags' to 'retrieve_highway' to skip footways,
+# cycleways, building outlines and other ways.
+ROAD_HIGHWAY_TAGS = ("motorway", "motorway_link", "trunk", "trunk_link",
+                     "primary", "primary_link", "secondary", "secondary_link",
+                     "tertiary", "tertiary_link", "unclassified",
+                     "residential", "living_street", "service", "road")
+
+# Index from OSM way IDs to the highways of a HighwayGeometry, built once per
+# extracted network. 'way_id' holds the sorted unique IDs and 'part_way' the
+# position in 'way_id' of every highway (several highways share an ID when a
+# way was clipped into several parts).
+class WayIndex(object):
+    def __init__(self, osmid):
+        self.way_id, self.part_way = np.unique(np.asarray(osmid, dtype=np.int64),
+                                               return_inverse=True)
+
+    def locate(self, osm_id):
+        """
+        Returns the positions of the IDs 'osm_id' in 'way_id', and a boolean
+        array telling which IDs were found.
+        """
+        osm_id = np.asarray(osm_id, dtype=np.int64)
+        if len(self.way_id) == 0:
+            return np.zeros(osm_id.shape, dtype=np.int64), \
+                np.zeros(osm_id.shape, dtype=bool)
+        index = np.minimum(np.searchsorted(self.way_id, osm_id),
+                           len(self.way_id) - 1)
+        return index, self.way_id[index] == osm_id
+
+    def align(self, osm_id, values):
+        """
+        Aligns per-link values with the highways: returns an array whose row
+        'i' holds the values of the link with the OSM ID of highway 'i' (NaN
+        if there is no such link), and the IDs of the links that have no
+        geometry. 'values' has one row per ID of 'osm_id', and may have
+        several columns (e.g., one per pollutant). If an ID appears several
+        times, its last row is used.
+        """
+        values = np.asarray(values, dtype=np.float64)
+        index, found = self.locate(osm_id)
+        way_values = np.full((len(self.way_id),) + values.shape[1:], np.nan)
+        way_values[index[found]] = values[found]
+        return way_values[self.part_way], \
+            np.asarray(osm_id, dtype=np.int64)[~found]
+
+# Highways stored in compressed sparse row (CSR) form: the nodes of highway
+# 'i' are lon[offsets[i]:offsets[i + 1]] and lat[offsets[i]:offsets[i + 1]],
+# and its OSM ID is osmid[i]. The flat arrays can be handed to numpy or
+# plotting code as they are, without building one Python object per node.
+# The road class of highway 'i' is road_class_names[road_class[i]], or
+# unknown if road_class[i] is -1.
+class HighwayGeometry(object):
+    def __init__(self, offsets, lon, lat, osmid, road_class=None,
+                 road_class_names=()):
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.lon = np.asarray(lon, dtype=np.float64)
+        self.lat = np.asarray(lat, dtype=np.float64)
+        self.osmid = np.asarray(osmid, dtype=np.int64)
+        if road_class is None:
+            road_class = np.full(len(self.osmid), -1, dtype=np.int16)
+        self.road_class = np.asarray(road_class, dtype=np.int16)
+        self.road_class_names = list(road_class_names)
+        self._way_index = None
+
+    def __len__(self):
+        return len(self.osmid)
+
+    def coordinates(self, i):
+        """
+        Returns views on the longitudes and latitudes of highway 'i'.
+        """
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return self.lon[start:end], self.lat[start:end]
+
+    @property
+    def way_index(self):
+        """
+        The WayIndex of the highways, built on first use.
+        """
+        if self._way_index is None:
+            self._way_index = WayIndex(self.osmid)
+        return self._way_index
+
+    def align(self, osm_id, values):
+        """
+        Same as WayIndex.align, with the index of this network.
+        """
+        return self.way_index.align(osm_id, values)
+
+    def link_road_class(self, osm_id):
+        """
+        Returns the road class of the links 'osm_id' (-1 if unknown, or if
+        there is no highway with that ID).
+        """
+        way_class = np.full(len(self.way_index.way_id), -1, dtype=np.int16)
+        way_class[self.way_index.part_way] = self.road_class
+        index, found = self.way_index.locate(osm_id)
+        return np.where(found, way_class[index], -1).astype(np.int16)
+
+    @property
+    def nbytes(self):
+        return self.offsets.nbytes + self.lon.nbytes + self.lat.nbytes \
+            + self.osmid.nbytes + self.road_class.nbytes
+
+    def subset(self, index):
+        """
+        Returns a HighwayGeometry with the highways 'index' (integer indices
+        or boolean mask) only.
+        """
+        index = np.arange(len(self))[index]
+        count = self.offsets[index + 1] - self.offsets[index]
+        offsets = np.zeros(len(index) + 1, dtype=np.int64)
+        np.cumsum(count, out=offsets[1:])
+        node = np.arange(offsets[-1]) - np.repeat(offsets[:-1], count) \
+            + np.repeat(self.offsets[index], count)
+        return HighwayGeometry(offsets, self.lon[node], self.lat[node],
+                               self.osmid[index], self.road_class[index],
+                               self.road_class_names)
+
+    def lengths(self):
+        """
+        Returns the great-circle length of every highway, in km.
+        """
+        return polyline_lengths(self.offsets, self.lon, self.lat)
+
+    def clip(self, selected_zone):
+        """
+        Returns the parts of the highways inside the polygon 'selected_zone',
+        as a new HighwayGeometry, and the length of each part in km. A highway
+        that leaves and re-enters the polygon gives several parts with the
+        same OSM ID.
+        """
+        offsets, lon, lat, parent, length \
+            = clip_polylines(self.offsets, self.lon, self.lat, selected_zone)
+        return HighwayGeometry(offsets, lon, lat, self.osmid[parent],
+                               self.road_class[parent],
+                               self.road_class_names), length
+
 # Simple class that handles the parsed OSM data in order to select the points
 # inside the domain and the coordinates of the points around the domain. The
 # domain is defined as a closed N-point polygon in 'selected_zone'
-# (dimensions: N x 2).
+# (dimensions: N x 2). The points are accumulated in flat buffers while
+# parsing; 'finalize' turns them into an array of node IDs sorted in
+# increasing order ('node_id') and the matching N x 2 array of coordinates
+# ('coordinate').
 class PointCollection(object): # Renamed class to avoid confusion
     def __init__(self, selected_zone, tolerance):
         self.selected_zone = selected_zone
-        self.inside_zone = []
-        self.coordinate = {}
+        self.inside_zone = np.empty(0, dtype=np.int64)
+        self.node_id = np.empty(0, dtype=np.int64)
+        self.coordinate = np.empty((0, 2), dtype=np.float64)
+        self._id_buffer = array('q')
+        self._coordinate_buffer = array('d')
 
         self.x_min = min([x[0] for x in selected_zone]) - tolerance
         self.x_max = max([x[0] for x in selected_zone]) + tolerance
@@ -62,40 +272,98 @@ class PointCollection(object): # Renamed class to avoid confusion
 
     def select(self, coord):
         for osmid, x, y in coord:
-            # Selection of the points that are inside the domain.
-            if point_inside_polygon(x, y, self.selected_zone):
-                self.inside_zone.append(osmid)
             # Getting the ids of the coordinates inside the domain or in the
             # vicinity of the domain.
             if x < self.x_max and x > self.x_min \
                     and  y < self.y_max and y > self.y_min:
-                self.coordinate[osmid] = (x, y)
+                self.add(osmid, x, y)
+
+    def add(self, osmid, x, y):
+        self._id_buffer.append(osmid)
+        self._coordinate_buffer.append(x)
+        self._coordinate_buffer.append(y)
+
+    def finalize(self):
+        # The points added since the last call are merged with the sorted
+        # arrays.
+        node_id = np.concatenate(
+            [self.node_id, np.frombuffer(self._id_buffer, dtype=np.int64)])
+        coordinate = np.concatenate(
+            [self.coordinate, np.frombuffer(self._coordinate_buffer,
+                                            dtype=np.float64).reshape(-1, 2)])
+        order = np.argsort(node_id, kind="stable")
+        self.node_id = node_id[order]
+        self.coordinate = coordinate[order]
+        self._id_buffer = array('q')
+        self._coordinate_buffer = array('d')
+        # Selection of the points that are inside the domain.
+        self.inside_zone = self.node_id[
+            points_inside_polygon(self.coordinate[:, 0], self.coordinate[:, 1],
+                                  self.selected_zone)]
+
+    def lookup(self, refs):
+        """
+        Returns the rows of 'coordinate' for the node IDs 'refs', and a
+        boolean array telling which IDs were found.
+        """
+        refs = np.asarray(refs, dtype=np.int64)
+        index = np.searchsorted(self.node_id, refs)
+        index[index == len(self.node_id)] = 0
+        if len(self.node_id) == 0:
+            return index, np.zeros(refs.shape, dtype=bool)
+        return index, self.node_id[index] == refs
 
 # Simple class that handles the parsed OSM data in order to identify all
-# streets that cross the domain.
+# streets that cross the domain. The node references of all ways are stored
+# one after the other in 'point', and 'point_count' holds the number of nodes
+# of each way. If 'highway_tags' is given, only the ways whose 'highway' tag
+# is in it are kept.
 class HighwayCollection(object): # Renamed class to match previous use
-    def __init__(self, point_collection): # Takes the point object
-        # Set of all nodes inside the zone.
-        self.point_inside_zone = set(point_collection.inside_zone)
+    def __init__(self, point_collection, highway_tags=None): # Takes the point object
+        # Nodes inside the zone.
+        self.point_inside_zone = point_collection.inside_zone
         # Points that describe the highways.
-        self.point = []
-        # Unsorted points that describe the highways, in a set.
-        self.point_set = set()
+        self.point = array('q')
+        # Number of points of each highway.
+        self.point_count = array('q')
         # Stores the OSM ID.
-        self.osmid = []
+        self.osmid = array('q')
+        # Road class of each highway, as an index in 'road_class_names'.
+        self.road_class = array('h')
+        self.road_class_names = []
+        self._road_class_index = {}
+        self.highway_tags = None if highway_tags is None \
+            else frozenset(highway_tags)
 
     def select(self, way_obj): 
         # Access properties directly from the single way object
         osmid = way_obj.id
-        # tags = way_obj.tags # tags variable seems unused in original logic
+        highway = way_obj.tags.get("highway")
+        if self.highway_tags is not None and highway not in self.highway_tags:
+            return
         refs = [n.ref for n in way_obj.nodes] 
 
         # Add logic to store the references and osmid if needed for later processing
         self.osmid.append(osmid)
-        self.point.append(refs)
+        self.point.extend(refs)
+        self.point_count.append(len(refs))
+        if highway is None:
+            self.road_class.append(-1)
+        else:
+            if highway not in self._road_class_index:
+                self._road_class_index[highway] = len(self.road_class_names)
+                self.road_class_names.append(highway)
+            self.road_class.append(self._road_class_index[highway])
 
 
-def retrieve_highway(osm_file, selected_zone, tolerance, Ncore=1):
+def retrieve_highway(osm_file, selected_zone, tolerance, Ncore=1,
+                     highway_tags=None, clip=False):
+    # 'osm_file' may be a path, a bytes buffer or an uploaded file object, in
+    # PBF (preferred), XML or bzip2-compressed XML format. If 'clip' is True,
+    # the highways crossing the boundary of 'selected_zone' are cut there and
+    # only their parts inside the zone are returned; otherwise a highway is
+    # returned whole if all its nodes are in the vicinity of the zone.
+    source, file_format = open_osm_source(osm_file)
     
     # --- PHASE 1: Collect Points ---
     # Create the Point collection object
@@ -111,14 +379,18 @@ def retrieve_highway(osm_file, selected_zone, tolerance, Ncore=1):
             # Use the stored collection object
             self.point_collection.select([(n.id, n.location.lon, n.location.lat)])
             
-    # Instantiate Point handler and apply the file for coordinate extraction
+    # Instantiate Point handler and apply the file for coordinate extraction.
+    # The nodes carry their own location, so no location index is needed.
     point_handler = PointHandler(point_collection)
-    point_handler.apply_file(osm_file, locations=True)
+    with instrumentation.span("osm_nodes") as span:
+        apply_osm_source(point_handler, source, file_format)
+        point_collection.finalize()
+        span.count(nodes=len(point_collection.node_id))
 
     
     # --- PHASE 2: Collect Highways/Ways ---
     # Create the Highway collection object, passing the point data it needs
-    highway_collection = HighwayCollection(point_collection)
+    highway_collection = HighwayCollection(point_collection, highway_tags)
 
     # Osmium handler for ways (highways)
     class HighwayHandler(osmium.simple_handler.SimpleHandler):
@@ -132,31 +404,60 @@ def retrieve_highway(osm_file, selected_zone, tolerance, Ncore=1):
 
     # Instantiate Highway handler and apply the file for way extraction
     highway_handler = HighwayHandler(highway_collection) 
-    highway_handler.apply_file(osm_file)
+    with instrumentation.span("osm_ways") as span:
+        apply_osm_source(highway_handler, source, file_format)
+        span.count(ways=len(highway_collection.osmid))
 
     
     # --- PHASE 3: Process results ---
-    # Flatten the set of point references for highways
-    highway_collection.point_set = set([item for refs in highway_collection.point for item in refs])
-
-    # Collect the coordinates for the highway points
-    point_coordinate = []
-    for way in highway_collection.point_set:
-        try:
-            point_coordinate.append(point_collection.coordinate[way])
-        except KeyError: # Use KeyError instead of bare except
-            pass
-
-    # Collect the highway coordinates and OSM IDs
-    highway_coordinate = []
-    highway_osmid = []
-    for refs, osmid in zip(highway_collection.point, highway_collection.osmid):
-        try:
-            highway_coordinate.append([point_collection.coordinate[n] for n in refs])
-            highway_osmid.append(osmid)
-        except KeyError: # Use KeyError instead of bare except
-            pass
-
-    return highway_coordinate, highway_osmid
+    with instrumentation.span("osm_assemble") as span:
+        refs = np.frombuffer(highway_collection.point, dtype=np.int64)
+        count = np.frombuffer(highway_collection.point_count, dtype=np.int64)
+        osmid = np.frombuffer(highway_collection.osmid, dtype=np.int64)
+        road_class = np.frombuffer(highway_collection.road_class,
+                                   dtype=np.int16)
+
+        # Resolve all node references at once. A highway is kept only if all
+        # its nodes have coordinates (i.e., are in the vicinity of the
+        # domain).
+        index, found = point_collection.lookup(refs)
+        way_of_ref = np.repeat(np.arange(len(count)), count)
+        missing = np.bincount(way_of_ref[~found], minlength=len(count))
+
+        if clip:
+            # The highways with some nodes in the vicinity of the domain may
+            # cross its boundary: the coordinates of their other nodes are
+            # read in an extra pass, so that they can be cut at the right
+            # place.
+            partial = (missing > 0) & (missing < count)
+            wanted = set(
+                np.unique(refs[~found & partial[way_of_ref]]).tolist())
+            if wanted:
+                class MissingPointHandler(osmium.simple_handler.SimpleHandler):
+                    def node(self, n):
+                        if n.id in wanted:
+                            point_collection.add(n.id, n.location.lon,
+                                                 n.location.lat)
+
+                apply_osm_source(MissingPointHandler(), source, file_format)
+                point_collection.finalize()
+                index, found = point_collection.lookup(refs)
+                missing = np.bincount(way_of_ref[~found], minlength=len(count))
+
+        keep = (missing == 0) & (count > 0)
 
+        keep_ref = np.repeat(keep, count)
+        kept_count = count[keep]
+        offsets = np.zeros(len(kept_count) + 1, dtype=np.int64)
+        np.cumsum(kept_count, out=offsets[1:])
+        index = index[keep_ref]
 
+        geometry = HighwayGeometry(offsets,
+                                   point_collection.coordinate[index, 0],
+                                   point_collection.coordinate[index, 1],
+                                   osmid[keep], road_class[keep],
+                                   highway_collection.road_class_names)
+        if clip:
+            geometry = geometry.clip(selected_zone)[0]
+        span.count(ways=len(geometry))
+    return geometry
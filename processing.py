@@ -1,47 +1,230 @@
+import hashlib
+
 import streamlit as st
+import numpy as np
 import pandas as pd
-import plotly.express as px
+import plotly.graph_objects as go
+
+import engine
+import geometry
+import network_cache
+# Above this number of links, the preview plots the flow against the length
+# as a density instead of one point per link.
+PREVIEW_SCATTER_POINTS = 5000
+# Number of bins of the preview histograms, per axis.
+PREVIEW_BINS = 30
+
+def network_key(osm_file, map_params):
+    """
+    Returns the key of the road network of an OSM file with the sidebar
+    settings (the content digest of the file is computed once per upload).
+    """
+    selected_zone = map_params.get('selected_zone')
+    return (network_cache.file_digest(osm_file),
+            None if selected_zone is None else tuple(map(tuple, selected_zone)),
+            float(map_params['tolerance']))
+
+@st.cache_resource(max_entries=2, show_spinner=False)
+def _load_network(key, _osm_file, _ncore):
+    digest, selected_zone, tolerance = key
+    return engine.load_network(_osm_file, selected_zone, tolerance, _ncore)
+
+def load_network(osm_file, map_params):
+    """
+    Extracts the road network of the uploaded OSM file with the sidebar
+    settings, going through the on-disk network cache. The roads are clipped
+    at the study area when one is given. The last networks are also kept in
+    memory, shared by the reruns and the sessions, and must not be modified.
+    """
+    return _load_network(network_key(osm_file, map_params), osm_file, map_params['ncore'])
+
+def upload_key(uploaded_file):
+    """
+    Returns a key of the content of an uploaded file: its upload ID, or the
+    digest of its content for other file objects.
+    """
+    file_id = getattr(uploaded_file, 'file_id', None)
+    if file_id is not None:
+        return file_id
+    return hashlib.sha256(uploaded_file.getvalue()).hexdigest()
+
+@st.cache_resource(max_entries=2, show_spinner=False)
+def _read_link_table(key, _link_osm):
+    return engine.read_link_data(_link_osm)
+
+def read_link_table(link_osm):
+    """
+    Parses the uploaded link data file, naming its columns after their
+    number. The last tables are kept in memory and must not be modified.
+    """
+    return _read_link_table(upload_key(link_osm), link_osm)
+
+@st.cache_resource(max_entries=2, show_spinner=False)
+def _preview_figures(key, _data_link):
+    stats = link_statistics(_data_link)
+    return stats, \
+        speed_histogram(_data_link['Speed'].to_numpy(dtype=np.float64), stats.loc['Speed']), \
+        flow_length_figure(_data_link['Length_km'].to_numpy(dtype=np.float64),
+                           _data_link['Flow'].to_numpy(dtype=np.float64), stats)
 
-def preview_data(link_osm):
+def build_link_table(network):
+    """
+    Returns the OSM_ID and Length_km columns of a link table for all the
+    roads of the network, the lengths being the great-circle lengths of the
+    (clipped) geometry.
+    """
+    osm_id, length = geometry.lengths_by_id(network.osmid, network.lengths())
+    return pd.DataFrame({'OSM_ID': osm_id, 'Length_km': length})
+
+def validate_link_lengths(osm_id, length_km, network, rtol=0.1):
+    """
+    Compares the lengths of a link table with the lengths computed from the
+    OSM geometry, matching the links by OSM_ID. Returns one row per link with
+    the status "ok", "mismatch" (relative difference above 'rtol') or
+    "missing" (no geometry for this OSM_ID).
+    """
+    reference = build_link_table(network)
+    reference_id = reference['OSM_ID'].values
+    osm_id = np.asarray(osm_id, dtype=np.int64)
+    length_km = np.asarray(length_km, dtype=np.float64)
+    osm_length = np.full(len(osm_id), np.nan)
+    if len(reference_id) > 0:
+        index = np.minimum(np.searchsorted(reference_id, osm_id), len(reference_id) - 1)
+        found = reference_id[index] == osm_id
+        osm_length[found] = reference['Length_km'].values[index[found]]
+    else:
+        found = np.zeros(len(osm_id), dtype=bool)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        relative = np.abs(length_km - osm_length) / osm_length
+    status = np.where(~found, 'missing', np.where(relative > rtol, 'mismatch', 'ok'))
+    return pd.DataFrame({'OSM_ID': osm_id, 'Length_km': length_km, 'OSM_Length_km': osm_length,
+                         'Relative_Difference': relative, 'Status': status})
+
+@st.fragment
+def preview_link_lengths(data_link, osm_file, map_params):
+    """
+    Renders the check of the link lengths against the OSM geometry, and the
+    generation of a link table from the OSM file. Its widgets only rerun this
+    fragment.
+    """
+    with st.expander("📏 Link Lengths from OSM Geometry", expanded=False):
+        if not st.checkbox("Compute link lengths from the OSM file", key="link_length_check"):
+            return
+        with st.spinner("Extracting road network..."):
+            network = load_network(osm_file, map_params)
+        if data_link is not None and 'Length_km' in data_link.columns:
+            rtol = st.slider("Tolerance on the relative difference", 0.01, 0.5, 0.1, 0.01)
+            check = validate_link_lengths(data_link['OSM_ID'].values, data_link['Length_km'].values, network, rtol)
+            counts = check['Status'].value_counts()
+            c1, c2, c3 = st.columns(3)
+            c1.metric("Matching Lengths", int(counts.get('ok', 0)))
+            c2.metric("Mismatching Lengths", int(counts.get('mismatch', 0)))
+            c3.metric("Links Without Geometry", int(counts.get('missing', 0)))
+            st.dataframe(check[check['Status'] != 'ok'].head(200), use_container_width=True)
+        st.download_button(
+            label=f"Download OSM_ID / Length_km Table ({len(np.unique(network.osmid))} roads)",
+            data=lambda: build_link_table(network).to_csv(sep=' ', header=False, index=False).encode('utf-8'),
+            file_name="link_lengths.txt",
+            mime="text/plain",
+            key='download_link_lengths'
+        )
+
+def link_statistics(data_link, columns=('Length_km', 'Speed', 'Flow')):
+    """
+    Computes the sum, mean, minimum and maximum of the given columns of the
+    link table at once, on one array. NaN values are ignored.
+    """
+    values = data_link[list(columns)].to_numpy(dtype=np.float64)
+    valid = np.isfinite(values)
+    count = valid.sum(axis=0)
+    total = np.where(valid, values, 0.).sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = total / count
+    minimum = np.where(valid, values, np.inf).min(axis=0, initial=np.inf)
+    maximum = np.where(valid, values, -np.inf).max(axis=0, initial=-np.inf)
+    return pd.DataFrame({'sum': total, 'mean': mean, 'min': minimum, 'max': maximum,
+                         'count': count}, index=list(columns))
+
+def speed_histogram(speed, stats, nbins=PREVIEW_BINS):
+    """
+    Returns the speed distribution as a bar chart of pre-binned counts, so
+    that only the bins are sent to the browser.
+    """
+    speed = speed[np.isfinite(speed)]
+    low, high = (stats['min'], stats['max']) if len(speed) else (0., 1.)
+    counts, edges = np.histogram(speed, bins=nbins, range=(low, high if high > low else low + 1.))
+    fig = go.Figure(go.Bar(x=(edges[:-1] + edges[1:]) / 2., y=counts, width=np.diff(edges),
+                           hovertemplate="Speed %{x:.1f} km/h: %{y} links<extra></extra>"))
+    fig.update_layout(title="Speed Distribution", xaxis_title="Speed", yaxis_title="count", bargap=0)
+    return fig
+
+def flow_length_figure(length, flow, stats, nbins=PREVIEW_BINS):
+    """
+    Returns the flow against the link length: a scatter plot of the links up
+    to PREVIEW_SCATTER_POINTS links, and otherwise a 2D histogram with
+    logarithmic flow bins (the flow axis is logarithmic).
+    """
+    keep = np.isfinite(length) & (flow > 0)
+    length, flow = length[keep], flow[keep]
+    if len(length) <= PREVIEW_SCATTER_POINTS:
+        import plotly.express as px
+        return px.scatter(x=length, y=flow, log_y=True, title="Flow vs. Link Length",
+                          labels={'x': 'Length_km', 'y': 'Flow'})
+    length_max = stats.loc['Length_km', 'max']
+    log_flow = np.log10(flow)
+    counts, x_edges, y_edges = np.histogram2d(
+        length, log_flow, bins=nbins,
+        range=[(0., length_max if length_max > 0 else 1.),
+               (log_flow.min(), max(log_flow.max(), log_flow.min() + 1e-6))])
+    fig = go.Figure(go.Heatmap(
+        x=x_edges, y=10. ** y_edges, z=np.where(counts > 0, counts, np.nan).T,
+        colorscale='Viridis', colorbar=dict(title='Links'),
+        hovertemplate="Length %{x:.2f} km, flow %{y:.0f}: %{z} links<extra></extra>"))
+    fig.update_layout(title=f"Flow vs. Link Length (density of {len(length):,} links)",
+                      xaxis_title="Length_km", yaxis_title="Flow", yaxis_type="log")
+    return fig
+
+def preview_data(link_osm, osm_file=None, map_params=None):
     st.header("📊 Data Preview & Validation")
 
     if link_osm is not None:
         st.subheader("🔗 Link OSM Data")
         try:
-            link_osm.seek(0)
-            # Read space-separated file, assuming no header
-            data_link = pd.read_csv(link_osm, sep=r'\s+', header=None, engine='python')
-            
-            # Logic for column naming based on column count
+            data_link = read_link_table(link_osm)
+
+            # Structure detected from the column count
             if data_link.shape[1] == 7:
-                data_link.columns = ['OSM_ID', 'Length_km', 'Flow', 'Speed', 'Gasoline_Prop', 'PC_Prop', '4Stroke_Prop']
                 st.info("Detected 7 columns: Assumed a simplified structure (PC/Moto only).")
             elif data_link.shape[1] == 9:
-                data_link.columns = ['OSM_ID', 'Length_km', 'Flow', 'Speed', 'Gasoline_Prop', 'PC_Prop', '4Stroke_Prop', 'LDV_Prop', 'HDV_Prop']
                 st.success("Detected 9 columns: Assumed full structure (PC, LDV, HDV, Moto).")
             else:
-                data_link.columns = [f'Column_{i}' for i in range(data_link.shape[1])]
                 st.warning(f"Detected {data_link.shape[1]} columns. Defaulting to generic column names.")
 
             st.dataframe(data_link.head(20), use_container_width=True)
 
-            # Statistics
+            # Statistics and plots, computed once per file
+            stats, speed_figure, flow_figure = _preview_figures(upload_key(link_osm), data_link)
             col1, col2, col3, col4 = st.columns(4)
             col1.metric("Total Links", len(data_link))
-            col2.metric("Total Length (km)", f"{data_link['Length_km'].sum():.2f}")
-            col3.metric("Avg Speed (km/h)", f"{data_link['Speed'].mean():.2f}")
-            col4.metric("Avg Flow (veh)", f"{data_link['Flow'].mean():.0f}")
+            col2.metric("Total Length (km)", f"{stats.loc['Length_km', 'sum']:.2f}")
+            col3.metric("Avg Speed (km/h)", f"{stats.loc['Speed', 'mean']:.2f}")
+            col4.metric("Avg Flow (veh)", f"{stats.loc['Flow', 'mean']:.0f}")
 
-            # Plots
+            # Plots, of binned data for large tables
             c1, c2 = st.columns(2)
             with c1:
-                st.plotly_chart(px.histogram(data_link, x='Speed', nbins=30, title="Speed Distribution"), use_container_width=True)
+                st.plotly_chart(speed_figure, use_container_width=True)
             with c2:
-                st.plotly_chart(px.scatter(data_link, x='Length_km', y='Flow', log_y=True, title="Flow vs. Link Length"), use_container_width=True)
+                st.plotly_chart(flow_figure, use_container_width=True)
 
 
         except Exception as e:
             st.error(f"Error reading or processing link data file: {e}")
             st.warning("Please ensure the file is a space-separated (.txt or .csv) file with no header.")
+            data_link = None
     else:
         st.info("Upload the Link Data file in the sidebar to view the preview and validation statistics.")
+        data_link = None
+
+    if osm_file is not None and map_params is not None:
+        preview_link_lengths(data_link, osm_file, map_params)
@@ -0,0 +1,147 @@
+# Sampling profiler of the emission loop. While 'profiling' is active, the
+# loop of engine.compute_emissions tells the profiler which emission factor it
+# evaluates (vehicle type, equation, pollutant), and a thread samples the
+# stack of the profiled thread at a fixed interval. The time of a key is
+# estimated from its number of samples; its calls are counted exactly.
+#
+# The samples are also written as collapsed stacks ("frame;frame;... count"
+# lines), the input format of flame graph tools such as flamegraph.pl and
+# speedscope.
+
+import collections
+import contextlib
+import contextvars
+import os
+import sys
+import threading
+import time
+
+# Profiler of the current context (None: no profiling).
+_profiler = contextvars.ContextVar("profiling_profiler", default=None)
+
+# Default sampling interval in seconds. The sampler gets the GIL at most once
+# per sys.getswitchinterval() (5 ms by default) while the loop runs.
+SAMPLE_INTERVAL = 0.001
+# Maximum number of frames of a collapsed stack.
+MAX_STACK_DEPTH = 64
+# Key of the samples taken outside the emission factors.
+OTHER = ("-", "other", "-")
+
+
+class SamplingProfiler(object):
+    """
+    Samples of the profiled thread and calls of the emission factors, by
+    (vehicle type, equation, pollutant).
+    """
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.pollutant = "-"
+        self.current = None
+        self.calls = collections.Counter()
+        self.samples = collections.Counter()
+        self.stacks = collections.Counter()
+        self.duration = 0.
+        self._thread_id = None
+        self._stop = threading.Event()
+        self._sampler = None
+        self._start = None
+
+    def enter(self, vehicle_type, equation):
+        """
+        Marks the start of the evaluation of an emission factor, for the
+        current pollutant.
+        """
+        self.current = (vehicle_type, equation, self.pollutant)
+        self.calls[self.current] += 1
+
+    def exit(self):
+        """
+        Marks the end of the evaluation of an emission factor.
+        """
+        self.current = None
+
+    def start(self):
+        """
+        Starts sampling the calling thread.
+        """
+        self._thread_id = threading.get_ident()
+        self._stop.clear()
+        self._start = time.perf_counter()
+        self._sampler = threading.Thread(target=self._sample, name="emission-profiler",
+                                         daemon=True)
+        self._sampler.start()
+
+    def stop(self):
+        self._stop.set()
+        self._sampler.join()
+        self.duration += time.perf_counter() - self._start
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)
+            if frame is None:
+                continue
+            key = self.current or OTHER
+            self.samples[key] += 1
+            stack = []
+            while frame is not None and len(stack) < MAX_STACK_DEPTH:
+                code = frame.f_code
+                stack.append("{0}:{1}".format(
+                    os.path.splitext(os.path.basename(code.co_filename))[0], code.co_name))
+                frame = frame.f_back
+            stack.reverse()
+            if key is not OTHER:
+                stack.append("[{0} {1} {2}]".format(*key))
+            self.stacks[";".join(stack)] += 1
+
+    def hot_paths(self, count=20):
+        """
+        Returns the 'count' keys with the most samples, as rows: vehicle
+        type, equation, pollutant, calls, samples, estimated time (s) and
+        share of the samples (%).
+        """
+        total = sum(self.samples.values()) or 1
+        seconds_per_sample = self.duration / total
+        keys = set(self.samples) | set(self.calls)
+        rows = [{"Vehicle Type": key[0], "Equation": key[1], "Pollutant": key[2],
+                 "Calls": self.calls.get(key, 0), "Samples": self.samples.get(key, 0),
+                 "Time (s)": round(self.samples.get(key, 0) * seconds_per_sample, 4),
+                 "Share (%)": round(100. * self.samples.get(key, 0) / total, 1)}
+                for key in keys]
+        rows.sort(key=lambda row: (-row["Samples"], -row["Calls"]))
+        return rows[:count]
+
+    def collapsed(self):
+        """
+        Returns the samples as collapsed stacks, one "frame;...;frame count"
+        line per stack.
+        """
+        return "".join("{0} {1}\n".format(stack, n)
+                       for stack, n in sorted(self.stacks.items()))
+
+    def write_collapsed(self, path):
+        with open(path, "w") as f:
+            f.write(self.collapsed())
+
+
+@contextlib.contextmanager
+def profiling(interval=SAMPLE_INTERVAL):
+    """
+    Profiles the emission loops run by the calling thread in the block.
+    Yields the SamplingProfiler.
+    """
+    profiler = SamplingProfiler(interval)
+    token = _profiler.set(profiler)
+    profiler.start()
+    try:
+        yield profiler
+    finally:
+        profiler.stop()
+        _profiler.reset(token)
+
+
+def active():
+    """
+    Returns the SamplingProfiler of the current context, or None.
+    """
+    return _profiler.get()
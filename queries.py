@@ -0,0 +1,187 @@
+# This file answers the usual questions on the per-link results without a
+# pass over the whole table in Python: the N links with the highest values of
+# a column (np.argpartition, linear in the number of links), and the links and
+# totals inside a bounding box or a polygon, through a uniform grid index
+# over the bounding boxes of the link geometries.
+
+import numpy as np
+
+import geometry
+
+# Mean number of links per cell of a LinkIndex.
+LINKS_PER_CELL = 4
+
+
+def top_links(values, n):
+    """
+    Returns the indices of the 'n' largest values, the largest first. NaN
+    values are never returned.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    candidates = np.flatnonzero(~np.isnan(values))
+    n = min(int(n), len(candidates))
+    if n <= 0:
+        return np.zeros(0, dtype=np.int64)
+    if n < len(candidates):
+        candidates = candidates[np.argpartition(-values[candidates], n - 1)[:n]]
+    return candidates[np.argsort(-values[candidates], kind='stable')]
+
+
+def top_table(df, column, n, per_km=False):
+    """
+    Returns the rows of the results table 'df' with the 'n' highest values
+    of 'column' (per km of link if 'per_km'), the highest first.
+    """
+    values = df[column].to_numpy(dtype=np.float64)
+    if per_km:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            values = values / df['Length_km'].to_numpy(dtype=np.float64)
+    index = top_links(values, n)
+    table = df.iloc[index].reset_index(drop=True)
+    if per_km:
+        table.insert(2, f'{column} per km', values[index])
+    table.insert(0, 'Rank', np.arange(1, len(index) + 1))
+    return table
+
+
+def link_bounds(network, osm_id):
+    """
+    Returns the bounding boxes (x_min, y_min, x_max, y_max rows) of the links
+    'osm_id' in the HighwayGeometry 'network', covering all the parts of
+    their way; NaN for the links without geometry.
+    """
+    part_bounds = geometry.polyline_bounds(network.offsets, network.lon, network.lat)
+    way_index = network.way_index
+    way_bounds = np.full((4, len(way_index.way_id)), np.nan)
+    if len(network):
+        # fmin/fmax ignore the NaN bounds of the empty parts.
+        for row, ufunc, start in ((0, np.fmin, np.inf), (1, np.fmin, np.inf),
+                                  (2, np.fmax, -np.inf), (3, np.fmax, -np.inf)):
+            reduced = np.full(len(way_index.way_id), start)
+            ufunc.at(reduced, way_index.part_way, part_bounds[row])
+            way_bounds[row] = np.where(np.isfinite(reduced), reduced, np.nan)
+    index, found = way_index.locate(osm_id)
+    bounds = np.full((4, len(index)), np.nan)
+    bounds[:, found] = way_bounds[:, index[found]]
+    return bounds
+
+
+# Uniform grid over the bounding boxes of links (x_min, y_min, x_max, y_max
+# rows, NaN for the links without geometry). A link is listed in every cell
+# its box overlaps; the links of cell 'c' are cell_links[cell_start[c]:
+# cell_start[c + 1]]. The cell size is chosen for LINKS_PER_CELL links per
+# cell, but not smaller than the median box, so that a link is in few cells.
+class LinkIndex(object):
+    def __init__(self, bounds, links_per_cell=LINKS_PER_CELL):
+        self.bounds = np.asarray(bounds, dtype=np.float64)
+        located = np.flatnonzero(np.isfinite(self.bounds).all(axis=0))
+        self.located = len(located)
+        if self.located == 0:
+            self.x_min = self.y_min = 0.
+            self.dx = self.dy = 1.
+            self.nx = self.ny = 1
+            self.cell_start = np.zeros(2, dtype=np.int64)
+            self.cell_links = np.zeros(0, dtype=np.int64)
+            return
+        x_min, y_min, x_max, y_max = self.bounds[:, located]
+        self.x_min, self.y_min = x_min.min(), y_min.min()
+        width = max(x_max.max() - self.x_min, 1e-9)
+        height = max(y_max.max() - self.y_min, 1e-9)
+        n_cells = max(self.located / float(links_per_cell), 1.)
+        size = max(np.sqrt(width * height / n_cells),
+                   np.median(x_max - x_min), np.median(y_max - y_min), 1e-9)
+        self.nx = int(min(np.ceil(width / size), n_cells)) or 1
+        self.ny = int(min(np.ceil(height / size), n_cells)) or 1
+        self.dx, self.dy = width / self.nx, height / self.ny
+
+        ix0, iy0 = self._cell(x_min, y_min)
+        ix1, iy1 = self._cell(x_max, y_max)
+        count_x, count_y = ix1 - ix0 + 1, iy1 - iy0 + 1
+        count = count_x * count_y
+        # One entry per (link, cell) pair: 'k' numbers the cells of a link.
+        link = np.repeat(located, count)
+        k = np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count)
+        cell = (np.repeat(iy0, count) + k // np.repeat(count_x, count)) * self.nx \
+            + np.repeat(ix0, count) + k % np.repeat(count_x, count)
+        order = np.argsort(cell, kind='stable')
+        self.cell_links = link[order]
+        self.cell_start = np.zeros(self.nx * self.ny + 1, dtype=np.int64)
+        np.cumsum(np.bincount(cell, minlength=self.nx * self.ny), out=self.cell_start[1:])
+
+    @classmethod
+    def from_network(cls, network, osm_id, links_per_cell=LINKS_PER_CELL):
+        """
+        Builds the index of the links 'osm_id' (e.g., the OSM_ID column of
+        the results) with their geometry in the HighwayGeometry 'network'.
+        """
+        return cls(link_bounds(network, osm_id), links_per_cell)
+
+    def __len__(self):
+        return self.bounds.shape[1]
+
+    def _cell(self, x, y):
+        ix = np.clip(((np.asarray(x) - self.x_min) // self.dx).astype(np.int64), 0, self.nx - 1)
+        iy = np.clip(((np.asarray(y) - self.y_min) // self.dy).astype(np.int64), 0, self.ny - 1)
+        return ix, iy
+
+    def candidates(self, x_min, y_min, x_max, y_max):
+        """
+        Returns the sorted indices of the links listed in the cells that the
+        box overlaps, a superset of the links whose box overlaps it.
+        """
+        if self.located == 0 or x_max < x_min or y_max < y_min:
+            return np.zeros(0, dtype=np.int64)
+        (ix0, ix1), (iy0, iy1) = self._cell([x_min, x_max], [y_min, y_max])
+        rows = np.arange(iy0, iy1 + 1) * self.nx
+        start = self.cell_start[rows + ix0]
+        end = self.cell_start[rows + ix1 + 1]
+        # The cells of a row of the grid are contiguous in cell_links.
+        count = end - start
+        entries = np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count) \
+            + np.repeat(start, count)
+        links = self.cell_links[entries]
+        if len(links) * 16 < len(self):
+            return np.unique(links)
+        # A mask is faster than sorting for large queries.
+        mask = np.zeros(len(self), dtype=bool)
+        mask[links] = True
+        return np.flatnonzero(mask)
+
+    def in_box(self, x_min, y_min, x_max, y_max, within=False):
+        """
+        Returns the sorted indices of the links whose box overlaps the box
+        (x_min, y_min, x_max, y_max), or lies inside it if 'within'.
+        """
+        index = self.candidates(x_min, y_min, x_max, y_max)
+        bx_min, by_min, bx_max, by_max = self.bounds[:, index]
+        if within:
+            keep = (bx_min >= x_min) & (bx_max <= x_max) & (by_min >= y_min) & (by_max <= y_max)
+        else:
+            keep = (bx_max >= x_min) & (bx_min <= x_max) & (by_max >= y_min) & (by_min <= y_max)
+        return index[keep]
+
+    def in_polygon(self, polygon):
+        """
+        Returns the sorted indices of the links whose box center is inside
+        the polygon (list of (x, y) points), so that the links of adjacent
+        districts are counted once.
+        """
+        polygon = np.asarray(polygon, dtype=np.float64)
+        x_min, y_min = polygon.min(axis=0)
+        x_max, y_max = polygon.max(axis=0)
+        index = self.candidates(x_min, y_min, x_max, y_max)
+        x = (self.bounds[0, index] + self.bounds[2, index]) / 2.
+        y = (self.bounds[1, index] + self.bounds[3, index]) / 2.
+        return index[geometry.points_inside_polygon(x, y, polygon)]
+
+
+def region_totals(df, index, columns):
+    """
+    Returns the number of links, their length in km and the sums of
+    'columns' over the rows 'index' of the results table 'df', by name.
+    """
+    totals = {'Links': len(index),
+              'Length (km)': float(df['Length_km'].to_numpy(dtype=np.float64)[index].sum())}
+    for column in columns:
+        totals[column] = float(np.nansum(df[column].to_numpy(dtype=np.float64)[index]))
+    return totals
@@ -0,0 +1,254 @@
+# Local store of the calculation runs, in an SQLite file: the per-link results
+# of every saved run with its settings and the hash of its parameter and
+# proportion files, so that an inventory is reloaded, or two scenarios are
+# compared, by an indexed query instead of a new calculation.
+#
+# Tables:
+#   runs          one row per run: name, date, parameters hash, settings
+#                 (JSON: pollutants, accuracy, input names), number of links
+#                 and whether all the links were computed
+#   link_results  one row per run, pollutant and link: OSM_ID, length and the
+#                 emissions in g by vehicle category and in total
+#
+# The results of a run and pollutant are contiguous in the primary key of
+# link_results, which serves the reload and the comparison of runs (by
+# OSM_ID, the links of a split way being summed), and a second index on
+# (osm_id, pollutant, run_id) serves the queries by link.
+
+import contextlib
+import datetime
+import hashlib
+import json
+import os
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+import engine
+
+# The store can be moved with the environment variable EMISSION_RUN_STORE.
+DEFAULT_PATH = os.environ.get(
+    "EMISSION_RUN_STORE",
+    os.path.join(os.path.expanduser("~"), ".local", "share", "emission_calculator",
+                 "runs.sqlite"))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    created TEXT NOT NULL,
+    parameters_hash TEXT NOT NULL,
+    settings TEXT NOT NULL,
+    links INTEGER NOT NULL,
+    complete INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS runs_parameters_hash ON runs (parameters_hash);
+CREATE TABLE IF NOT EXISTS link_results (
+    run_id INTEGER NOT NULL REFERENCES runs (run_id) ON DELETE CASCADE,
+    pollutant TEXT NOT NULL,
+    link INTEGER NOT NULL,
+    osm_id INTEGER NOT NULL,
+    length_km REAL NOT NULL,
+    pc REAL NOT NULL,
+    ldv REAL NOT NULL,
+    hdv REAL NOT NULL,
+    moto REAL NOT NULL,
+    total REAL NOT NULL,
+    PRIMARY KEY (run_id, pollutant, link)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS link_results_osm_id ON link_results (osm_id, pollutant, run_id);
+"""
+# Columns of the emissions in link_results, and the vehicle category of the
+# results table of each (None: the total).
+EMISSION_COLUMNS = list(engine.VEHICLE_CATEGORIES) + [("total", None)]
+
+
+@contextlib.contextmanager
+def connect(path=DEFAULT_PATH):
+    """
+    Opens the store at 'path', creating it if needed. The block is one
+    transaction, committed at its end.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    connection = sqlite3.connect(path)
+    try:
+        connection.execute("PRAGMA foreign_keys = ON")
+        connection.executescript(SCHEMA)
+        with connection:
+            yield connection
+    finally:
+        connection.close()
+
+
+def _content(source, default):
+    # Bytes of an input file (path, file object, or None for the default file).
+    if source is None:
+        if default is None:
+            return b""
+        source = os.path.join(engine.DEFAULTS_DIR, default)
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, "rb") as f:
+            return f.read()
+    if hasattr(source, "getvalue"):
+        return source.getvalue()
+    data = engine._rewind(source).read()
+    engine._rewind(source)
+    return data
+
+
+def parameters_hash(files=None, accuracy=None):
+    """
+    Returns the SHA-256 hex digest of the parameter and proportion files of
+    a run (as given to engine.run, the default files being used for the
+    missing ones) and of its accuracy settings.
+    """
+    files = files or {}
+    digest = hashlib.sha256()
+    for key, default in list(engine.PARAMETER_FILES.items()) + list(engine.PROPORTION_FILES.items()):
+        digest.update(key.encode("utf-8"))
+        digest.update(hashlib.sha256(_content(files.get(key), default)).digest())
+    digest.update(json.dumps(dict(engine.DEFAULT_ACCURACY, **(accuracy or {})),
+                             sort_keys=True).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def input_names(files):
+    """
+    Returns the names of the input files (upload names or paths), by key,
+    for the settings of a run.
+    """
+    return {key: os.fspath(source) if isinstance(source, (str, os.PathLike))
+            else getattr(source, "name", None) or "upload"
+            for key, source in (files or {}).items()
+            if source is not None}
+
+
+def save_run(results_df, selected_pollutants, name, settings=None, parameters=None,
+             complete=True, path=DEFAULT_PATH):
+    """
+    Stores the results table of a run (see engine.build_results_frame) with
+    its name, settings (JSON-serializable) and parameters hash. Returns the
+    run ID.
+    """
+    settings = dict(settings or {}, pollutants=list(selected_pollutants))
+    osm_id = results_df['OSM_ID'].to_numpy(dtype=np.int64).tolist()
+    length_km = results_df['Length_km'].to_numpy(dtype=np.float64).tolist()
+    link = range(len(results_df))
+    with connect(path) as connection:
+        run_id = connection.execute(
+            "INSERT INTO runs (name, created, parameters_hash, settings, links, complete)"
+            " VALUES (?, ?, ?, ?, ?, ?)",
+            (name, datetime.datetime.now().isoformat(timespec="seconds"), parameters or "",
+             json.dumps(settings, sort_keys=True), len(results_df), int(complete))).lastrowid
+        for poll in selected_pollutants:
+            columns = [results_df[f'{prefix}_Total_{poll}' if prefix else f'Total_{poll}']
+                       .to_numpy(dtype=np.float64).tolist()
+                       for _, prefix in EMISSION_COLUMNS]
+            connection.executemany(
+                "INSERT INTO link_results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                zip([run_id] * len(osm_id), [poll] * len(osm_id), link, osm_id, length_km,
+                    *columns))
+    return run_id
+
+
+def list_runs(path=DEFAULT_PATH):
+    """
+    Returns the stored runs, the last one first, with their pollutants.
+    """
+    with connect(path) as connection:
+        runs = pd.read_sql_query(
+            "SELECT run_id, name, created, links, complete, parameters_hash, settings"
+            " FROM runs ORDER BY run_id DESC", connection)
+    runs['pollutants'] = [", ".join(json.loads(s).get("pollutants", [])) for s in runs['settings']]
+    runs['complete'] = runs['complete'].astype(bool)
+    return runs
+
+
+def run_settings(run_id, path=DEFAULT_PATH):
+    """
+    Returns the settings of a run, or None if there is no such run.
+    """
+    with connect(path) as connection:
+        row = connection.execute("SELECT settings FROM runs WHERE run_id = ?",
+                                 (int(run_id),)).fetchone()
+    return None if row is None else json.loads(row[0])
+
+
+def load_run(run_id, path=DEFAULT_PATH):
+    """
+    Returns the results table of a run, as built by engine.build_results_frame,
+    and its pollutants.
+    """
+    settings = run_settings(run_id, path)
+    if settings is None:
+        raise ValueError("There is no run {0} in the store.".format(run_id))
+    with connect(path) as connection:
+        rows = pd.read_sql_query(
+            "SELECT pollutant, osm_id, length_km, pc, ldv, hdv, moto, total FROM link_results"
+            " WHERE run_id = ? ORDER BY pollutant, link", connection, params=(int(run_id),))
+    pollutants = settings["pollutants"]
+    groups = {poll: group for poll, group in rows.groupby('pollutant', sort=False)}
+    first = groups[pollutants[0]] if pollutants and pollutants[0] in groups \
+        else rows.iloc[:0]
+    results = {'OSM_ID': first['osm_id'].to_numpy(dtype=np.int64),
+               'Length_km': first['length_km'].to_numpy(dtype=np.float64)}
+    for poll in pollutants:
+        group = groups.get(poll, rows.iloc[:0])
+        for category, prefix in EMISSION_COLUMNS:
+            results[f'{prefix}_Total_{poll}' if prefix else f'Total_{poll}'] = \
+                group[category].to_numpy(dtype=np.float64)
+    return pd.DataFrame(results), pollutants
+
+
+def compare_totals(run_ids, path=DEFAULT_PATH):
+    """
+    Returns the total emissions in g of the runs, by run, pollutant and
+    vehicle category.
+    """
+    run_ids = [int(run_id) for run_id in run_ids]
+    with connect(path) as connection:
+        return pd.read_sql_query(
+            "SELECT runs.run_id, runs.name, pollutant, SUM(pc) AS pc, SUM(ldv) AS ldv,"
+            " SUM(hdv) AS hdv, SUM(moto) AS moto, SUM(total) AS total"
+            " FROM link_results JOIN runs USING (run_id)"
+            " WHERE run_id IN ({0}) GROUP BY run_id, pollutant ORDER BY pollutant, run_id"
+            .format(", ".join("?" * len(run_ids))), connection, params=run_ids)
+
+
+def compare_links(run_a, run_b, pollutant, path=DEFAULT_PATH):
+    """
+    Returns the total emissions of a pollutant in g on the links of both runs
+    (matched by OSM_ID), with the difference of run 'run_b' to run 'run_a',
+    the largest absolute differences first. The links of a way split into
+    several links (same OSM_ID) are summed before matching.
+    """
+    with connect(path) as connection:
+        return pd.read_sql_query(
+            "WITH a AS (SELECT osm_id, SUM(length_km) AS length_km, SUM(total) AS total"
+            "           FROM link_results WHERE run_id = ? AND pollutant = ? GROUP BY osm_id),"
+            " b AS (SELECT osm_id, SUM(total) AS total"
+            "       FROM link_results WHERE run_id = ? AND pollutant = ? GROUP BY osm_id)"
+            " SELECT a.osm_id AS OSM_ID, a.length_km AS Length_km, a.total AS total_a,"
+            " b.total AS total_b, b.total - a.total AS difference"
+            " FROM a JOIN b USING (osm_id)"
+            " ORDER BY ABS(b.total - a.total) DESC",
+            connection, params=(int(run_a), pollutant, int(run_b), pollutant))
+
+
+def link_history(osm_id, pollutant, path=DEFAULT_PATH):
+    """
+    Returns the total emissions of a pollutant on a link in every stored run
+    (summed over the links with this OSM_ID).
+    """
+    with connect(path) as connection:
+        return pd.read_sql_query(
+            "SELECT runs.run_id, runs.name, runs.created, SUM(total) AS total FROM link_results"
+            " JOIN runs USING (run_id) WHERE osm_id = ? AND pollutant = ?"
+            " GROUP BY run_id ORDER BY run_id", connection, params=(int(osm_id), pollutant))
+
+
+def delete_run(run_id, path=DEFAULT_PATH):
+    with connect(path) as connection:
+        connection.execute("DELETE FROM runs WHERE run_id = ?", (int(run_id),))
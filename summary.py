@@ -0,0 +1,90 @@
+# This file aggregates the per-link results table once per calculation into a
+# small cube of totals, read by the analysis tab instead of the full table.
+
+import numpy as np
+import pandas as pd
+
+# Vehicle categories of the results table (column prefixes), then the total
+# of all categories.
+CATEGORIES = ['PC', 'LDV', 'HDV', 'Moto', 'Total']
+
+
+# Totals of the results table: totals[p, c, r] is the emission of pollutant
+# pollutants[p] by the vehicle category CATEGORIES[c] on the links of road
+# class road_classes[r]. length_km[r] and link_count[r] are the length and
+# number of links of road class r. Without a road network, there is a single
+# road class, 'All roads'.
+class SummaryCube(object):
+    def __init__(self, pollutants, road_classes, totals, length_km,
+                 link_count):
+        self.pollutants = list(pollutants)
+        self.road_classes = list(road_classes)
+        self.totals = totals
+        self.length_km = length_km
+        self.link_count = link_count
+
+    @classmethod
+    def from_results(cls, df, pollutants, network=None):
+        """
+        Aggregates the results table 'df' (see engine.build_results_frame)
+        by pollutant, vehicle category and, if the HighwayGeometry 'network'
+        is given, road class of the links. Missing columns give zero totals.
+        """
+        if network is None:
+            road_class = np.zeros(len(df), dtype=np.int64)
+            road_classes = ['All roads']
+        else:
+            # The links of unknown class are put in a last class.
+            road_class = network.link_road_class(df['OSM_ID'].values) \
+                .astype(np.int64)
+            road_classes = list(network.road_class_names) + ['unknown']
+            road_class[road_class < 0] = len(road_classes) - 1
+        n_class = len(road_classes)
+        totals = np.zeros((len(pollutants), len(CATEGORIES), n_class))
+        for p, poll in enumerate(pollutants):
+            for c, category in enumerate(CATEGORIES):
+                column = f'{category}_Total_{poll}' if category != 'Total' \
+                    else f'Total_{poll}'
+                if column in df.columns:
+                    totals[p, c] = np.bincount(
+                        road_class, weights=np.nan_to_num(df[column].values),
+                        minlength=n_class)
+        length_km = np.bincount(road_class, weights=df['Length_km'].values,
+                                minlength=n_class)
+        link_count = np.bincount(road_class, minlength=n_class)
+        if network is not None:
+            # Classes without links are dropped.
+            used = link_count > 0
+            road_classes = [r for r, u in zip(road_classes, used) if u]
+            totals, length_km = totals[:, :, used], length_km[used]
+            link_count = link_count[used]
+        return cls(pollutants, road_classes, totals, length_km, link_count)
+
+    def total(self, pollutant):
+        """
+        Returns the total emission of 'pollutant', all vehicles and roads.
+        """
+        return self.totals[self.pollutants.index(pollutant), -1].sum()
+
+    def by_category(self):
+        """
+        Returns the totals by pollutant and vehicle category (without the
+        total of all categories) as a long table.
+        """
+        values = self.totals[:, :-1].sum(axis=2)
+        return pd.DataFrame({
+            'Pollutant': np.repeat(self.pollutants, len(CATEGORIES) - 1),
+            'Vehicle Type': np.tile(CATEGORIES[:-1], len(self.pollutants)),
+            'Value': values.ravel()})
+
+    def by_road_class(self, pollutant):
+        """
+        Returns the totals of 'pollutant' by road class and vehicle category
+        as a long table.
+        """
+        values = self.totals[self.pollutants.index(pollutant), :-1]
+        return pd.DataFrame({
+            'Road Class': np.tile(self.road_classes, len(CATEGORIES) - 1),
+            'Vehicle Type': np.repeat(CATEGORIES[:-1],
+                                      len(self.road_classes)),
+            'Value': values.ravel()})
@@ -0,0 +1,246 @@
+# This file renders emission-colored road maps as a pyramid of 256 x 256 PNG
+# tiles in the Web Mercator "XYZ" scheme, and keeps them on disk. The map tab
+# shows them as a raster layer, so that a large network is rasterized once
+# and not on every rerun of the app.
+
+import hashlib
+import os
+import shutil
+import struct
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import geometry
+
+# Tiles are written under STATIC_DIR/tiles/<key>/<z>/<x>/<y>.png. With
+# 'server.enableStaticServing' (see .streamlit/config.toml), Streamlit serves
+# the directory 'static' next to the app at the URL path 'app/static'.
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+TILE_DIR = os.path.join(STATIC_DIR, "tiles")
+TILE_URL = "app/static/tiles/{key}/{{z}}/{{x}}/{{y}}.png"
+TILE_SIZE = 256
+# Total size of the tile cache, in bytes, above which the least recently
+# used pyramids are removed.
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+# Largest number of tiles of a pyramid rendered for the map tab.
+MAX_TILES = 4096
+
+# Largest latitude of the Web Mercator projection.
+MAX_LATITUDE = 85.0511287798
+
+
+def _png_chunk(kind, data):
+    return struct.pack(">I", len(data)) + kind + data \
+        + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+
+
+# A fully transparent tile (8-bit RGBA), written for the tiles that no road
+# crosses, so that they are cached like the others and not rendered again.
+EMPTY_TILE = b"\x89PNG\r\n\x1a\n" \
+    + _png_chunk(b"IHDR", struct.pack(">IIBBBBB", TILE_SIZE, TILE_SIZE, 8, 6, 0, 0, 0)) \
+    + _png_chunk(b"IDAT", zlib.compress(bytes((TILE_SIZE * 4 + 1) * TILE_SIZE), 9)) \
+    + _png_chunk(b"IEND", b"")
+
+
+def lonlat_to_world(lon, lat, zoom):
+    """
+    Returns the Web Mercator coordinates of the points, in tiles at the given
+    zoom level: tile (x, y) covers [x, x + 1) x [y, y + 1).
+    """
+    n = 2. ** zoom
+    lat = np.radians(np.clip(lat, -MAX_LATITUDE, MAX_LATITUDE))
+    x = (np.asarray(lon) + 180.) / 360. * n
+    y = (1. - np.log(np.tan(lat) + 1. / np.cos(lat)) / np.pi) / 2. * n
+    return x, y
+
+
+def tile_range(bounds, zoom):
+    """
+    Returns the range of tile columns and rows covering the longitude and
+    latitude bounds (lon_min, lat_min, lon_max, lat_max).
+    """
+    x, y = lonlat_to_world(np.array([bounds[0], bounds[2]]),
+                           np.array([bounds[3], bounds[1]]), zoom)
+    n = 2 ** zoom
+    return range(max(int(x[0]), 0), min(int(x[1]), n - 1) + 1), \
+        range(max(int(y[0]), 0), min(int(y[1]), n - 1) + 1)
+
+
+def tile_key(network, values, metric, edges, palette):
+    """
+    Returns the key of a tile pyramid: a digest of the geometry, of the
+    values drawn, of the metric name and of the color scale.
+    """
+    digest = hashlib.sha256()
+    for array in (network.offsets, network.lon, network.lat,
+                  np.asarray(values, dtype=np.float64),
+                  np.asarray(edges, dtype=np.float64)):
+        digest.update(np.ascontiguousarray(array).data)
+    digest.update(repr((metric, list(palette))).encode("utf-8"))
+    return digest.hexdigest()[:32]
+
+
+# State of a rendering worker, set once per process by '_init_worker'.
+_worker = {}
+
+
+def _init_worker(offsets, lon, lat, color_index, palette):
+    import matplotlib
+    matplotlib.use("Agg")
+    _worker.update(offsets=offsets, lon=lon, lat=lat,
+                   color_index=color_index, palette=palette,
+                   bounds=geometry.polyline_bounds(offsets, lon, lat))
+
+
+def _render_tile(task):
+    """
+    Renders tile (z, x, y) to 'path'. Returns False if no road crosses the
+    tile, in which case EMPTY_TILE is written.
+    """
+    from matplotlib.figure import Figure
+    from matplotlib.collections import LineCollection
+
+    z, x, y, path = task
+    offsets, lon, lat = _worker["offsets"], _worker["lon"], _worker["lat"]
+    x_min, y_min, x_max, y_max = _worker["bounds"]
+    n = 2. ** z
+    # Tile extent in degrees, with a margin of a few pixels for line widths.
+    margin = 4. / TILE_SIZE
+    lon_west = (x - margin) / n * 360. - 180.
+    lon_east = (x + 1 + margin) / n * 360. - 180.
+    lat_north = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * (y - margin) / n))))
+    lat_south = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * (y + 1 + margin) / n))))
+    visible = np.flatnonzero((x_max >= lon_west) & (x_min <= lon_east)
+                             & (y_max >= lat_south) & (y_min <= lat_north))
+    if len(visible) == 0:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "wb") as f:
+            f.write(EMPTY_TILE)
+        os.replace(path + ".tmp", path)
+        return False
+
+    count = offsets[visible + 1] - offsets[visible]
+    sub_offsets = np.zeros(len(visible) + 1, dtype=np.int64)
+    np.cumsum(count, out=sub_offsets[1:])
+    node = np.arange(sub_offsets[-1]) - np.repeat(sub_offsets[:-1], count) \
+        + np.repeat(offsets[visible], count)
+    sub_offsets, sub_lon, sub_lat = geometry.simplify_polylines(
+        sub_offsets, lon[node], lat[node],
+        geometry.pixel_size(z, (lat_north + lat_south) / 2.) / 2.)
+    px, py = lonlat_to_world(sub_lon, sub_lat, z)
+    points = np.column_stack([(px - x) * TILE_SIZE, (py - y) * TILE_SIZE])
+
+    fig = Figure(figsize=(1, 1), dpi=TILE_SIZE)
+    fig.patch.set_alpha(0.)
+    ax = fig.add_axes([0, 0, 1, 1])
+    ax.set_axis_off()
+    ax.set_xlim(0, TILE_SIZE)
+    ax.set_ylim(TILE_SIZE, 0)
+    colors = np.asarray(_worker["palette"])[_worker["color_index"][visible]]
+    ax.add_collection(LineCollection(np.split(points, sub_offsets[1:-1]),
+                                     colors=colors,
+                                     linewidths=max(0.5, min(z - 8, 6) / 2.),
+                                     capstyle="round"))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fig.savefig(path + ".tmp", format="png", transparent=True)
+    os.replace(path + ".tmp", path)
+    return True
+
+
+def render_pyramid(key, network, color_index, palette, min_zoom, max_zoom,
+                   workers=1, progress=None):
+    """
+    Renders the tiles of zoom levels 'min_zoom' to 'max_zoom' that are not
+    already in the cache, in a pool of 'workers' processes. The road 'i' is
+    drawn with the color palette[color_index[i]] (a matplotlib color). The
+    pool is only started if some tiles are missing, the empty tiles being
+    cached too. 'progress', if given, is called with the fraction of tiles done.
+    """
+    directory = os.path.join(TILE_DIR, key)
+    bounds = (np.min(network.lon), np.min(network.lat),
+              np.max(network.lon), np.max(network.lat))
+    tasks = []
+    for z in range(min_zoom, max_zoom + 1):
+        columns, rows = tile_range(bounds, z)
+        for x in columns:
+            for y in rows:
+                path = os.path.join(directory, str(z), str(x),
+                                    "{0}.png".format(y))
+                if not os.path.exists(path):
+                    tasks.append((z, x, y, path))
+    if tasks:
+        initargs = (network.offsets, network.lon, network.lat,
+                    np.asarray(color_index), list(palette))
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=initargs) as executor:
+            chunksize = max(1, len(tasks) // (workers * 16))
+            for i, _ in enumerate(executor.map(_render_tile, tasks,
+                                               chunksize=chunksize)):
+                if progress is not None and i % 64 == 0:
+                    progress(i / len(tasks))
+    os.makedirs(directory, exist_ok=True)
+    # The modification time records the last use, for the eviction.
+    os.utime(directory)
+    evict(keep=directory)
+    if progress is not None:
+        progress(1.)
+    return TILE_URL.format(key=key)
+
+
+def count_tiles(network, min_zoom, max_zoom):
+    """
+    Returns the number of tiles of a pyramid covering the network.
+    """
+    bounds = (np.min(network.lon), np.min(network.lat),
+              np.max(network.lon), np.max(network.lat))
+    total = 0
+    for z in range(min_zoom, max_zoom + 1):
+        columns, rows = tile_range(bounds, z)
+        total += len(columns) * len(rows)
+    return total
+
+
+def budget_zoom(network, min_zoom, max_zoom, max_tiles=MAX_TILES):
+    """
+    Returns the highest zoom level, at most 'max_zoom', up to which the
+    pyramid covering the network from 'min_zoom' has at most 'max_tiles'
+    tiles (min_zoom - 1 if even the level 'min_zoom' has more).
+    """
+    bounds = (np.min(network.lon), np.min(network.lat),
+              np.max(network.lon), np.max(network.lat))
+    total = 0
+    for z in range(min_zoom, max_zoom + 1):
+        columns, rows = tile_range(bounds, z)
+        total += len(columns) * len(rows)
+        if total > max_tiles:
+            return z - 1
+    return max_zoom
+
+
+def evict(max_bytes=DEFAULT_MAX_BYTES, keep=None):
+    """
+    Removes the least recently used tile pyramids until the total size of
+    the tile cache is at most 'max_bytes'. The directory 'keep' is never
+    removed.
+    """
+    if not os.path.isdir(TILE_DIR):
+        return
+    entries = []
+    for name in os.listdir(TILE_DIR):
+        path = os.path.join(TILE_DIR, name)
+        if not os.path.isdir(path):
+            continue
+        size = 0
+        for root, _, files in os.walk(path):
+            size += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+        entries.append((os.path.getmtime(path), size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if path == keep:
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
@@ -1,7 +1,7 @@
 import streamlit as st
-import os
-from io import BytesIO
-import pandas as pd
+
+import engine
+
 
 def load_css():
     """
@@ -83,7 +83,10 @@ def render_sidebar():
     # --- 2. Traffic Data Uploads (COLLAPSIBLE) ---
     with st.sidebar.expander("2. Traffic and Link Data (.txt/.osm)", expanded=True): # Keep this section open by default
         link_osm = st.sidebar.file_uploader("Upload Link Data (OSM_ID, Length, Flow...)", key="link_data_key")
-        osm_file = st.sidebar.file_uploader("Upload OSM Map File (.osm)", key="osm_map_key")
+        # Read directly from the upload buffer by osm_network; PBF is much smaller
+        # and faster to decode than XML.
+        osm_file = st.sidebar.file_uploader("Upload OSM Map File (.osm.pbf, .osm, .osm.bz2, .osm.gz)", key="osm_map_key",
+                                            type=["pbf", "osm", "bz2", "gz"])
 
     st.sidebar.markdown("---")
 
@@ -133,6 +136,18 @@ def render_sidebar():
         tolerance = st.sidebar.number_input("Tolerance", value=0.005, format="%.3f")
         ncore = st.sidebar.number_input("Number of Cores", min_value=1, max_value=16, value=8)
 
+        zone_text = st.sidebar.text_area("Study Area Polygon (one 'lon, lat' per line)", value="",
+                                         help="Roads are clipped at this polygon. Leave empty to use the whole OSM file.")
+        try:
+            selected_zone = engine.parse_polygon(zone_text)
+        except ValueError as e:
+            st.sidebar.error(f"Invalid study area polygon: {e}")
+            selected_zone = None
+
+        # Read by the Performance panels (see render_performance)
+        st.sidebar.checkbox("Trace Memory in Performance Panels", key="trace_memory",
+                            help="Measures the peak memory of every stage, which slows down the computations.")
+
     # Return all gathered inputs as a dictionary
     return {
         "pollutants_available": pollutants_available,
@@ -162,6 +177,31 @@ def render_sidebar():
         "osm_file": osm_file,
         "map_params": {
             "ncore": ncore,
-            "tolerance": tolerance
+            "tolerance": tolerance,
+            "selected_zone": selected_zone
         }
     }
+
+def trace_memory():
+    """
+    Returns whether the Performance panels measure the peak memory (sidebar
+    setting).
+    """
+    return st.session_state.get("trace_memory", False)
+
+def render_performance(spans, title="⏱️ Performance"):
+    """
+    Renders the spans of an instrumentation.Recorder (as given by its
+    'to_dict' method) in a collapsed panel: one row per stage, indented by
+    nesting level.
+    """
+    if not spans:
+        return
+    with st.expander(title, expanded=False):
+        st.dataframe([{
+            "Stage": "\u2003" * span["depth"] + span["name"],
+            "Wall (ms)": round(1000. * span["wall_s"], 1),
+            "CPU (ms)": round(1000. * span["cpu_s"], 1),
+            "Peak Memory (MB)": span["peak_mb"],
+            "Counts": ", ".join(f"{k}={v}" for k, v in span["counts"].items()),
+        } for span in spans], hide_index=True, use_container_width=True)
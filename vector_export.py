@@ -0,0 +1,421 @@
+# This file writes the road links with their results as vector layers for GIS
+# software: GeoJSON, and FlatGeobuf with its packed Hilbert R-tree spatial
+# index. The writers walk the CSR geometry of the network and the columns of
+# the results together, and write the features a chunk at a time.
+#
+# FlatGeobuf (https://flatgeobuf.org) stores a FlatBuffers header, the index
+# and then the features. The FlatBuffers tables are encoded here directly,
+# without the flatbuffers package: the features use a fixed layout whose
+# size is known in advance, so that the byte offsets stored in the index can
+# be computed before the features are written.
+
+import struct
+
+import numpy as np
+
+import geometry
+
+# Number of features formatted at once; bounds the memory used by the output.
+FEATURE_CHUNK = 2000
+# Number of children of the nodes of the FlatGeobuf spatial index.
+INDEX_NODE_SIZE = 16
+
+FLATGEOBUF_MAGIC = b"fgb\x03fgb\x00"
+# FlatGeobuf geometry and column type codes.
+_MULTILINESTRING = 5
+_LONG, _DOUBLE = 7, 10
+# Size prefix, root offset, Feature vtable and table, Geometry vtable and
+# table, and length of the coordinates of the features, as laid out by
+# 'write_flatgeobuf'.
+_FEATURE_HEAD = np.dtype([
+    ("size", "<u4"), ("root", "<u4"), ("feature_vtable", "<u2", 4),
+    ("feature_table", "<i4"), ("geometry", "<u4"), ("properties", "<u4"),
+    ("geometry_vtable", "<u2", 4), ("geometry_table", "<i4"), ("ends", "<u4"),
+    ("xy", "<u4"), ("xy_length", "<u4")])
+# Node of the packed R-tree: bounding box, then the byte offset of the
+# feature (leaves) or the index of the first child node.
+NODE_ITEM = np.dtype([("min_x", "<f8"), ("min_y", "<f8"), ("max_x", "<f8"),
+                      ("max_y", "<f8"), ("offset", "<u8")])
+
+
+def link_geometry(network, osm_id):
+    """
+    Matches the links 'osm_id' with the highways of 'network'. Returns the
+    positions in 'osm_id' of the links that have a (non-empty) geometry, the offsets
+    'link_offsets' of their polylines, and a HighwayGeometry holding these
+    polylines: link 'k' is made of the polylines
+    link_offsets[k]:link_offsets[k + 1] (several if it was clipped).
+    """
+    way_index = network.way_index
+    count = np.bincount(way_index.part_way, minlength=len(way_index.way_id))
+    vertex_count = np.bincount(way_index.part_way,
+                               weights=np.diff(network.offsets),
+                               minlength=len(way_index.way_id))
+    index, found = way_index.locate(osm_id)
+    rows = np.flatnonzero(found & (vertex_count[index] > 0))
+    way = index[rows]
+    way_offsets = np.zeros(len(count) + 1, dtype=np.int64)
+    np.cumsum(count, out=way_offsets[1:])
+    order = np.argsort(way_index.part_way, kind="stable")
+    link_count = count[way]
+    link_offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum(link_count, out=link_offsets[1:])
+    part = order[np.repeat(way_offsets[way] - link_offsets[:-1], link_count)
+                 + np.arange(link_offsets[-1])]
+    return rows, link_offsets, network.subset(part)
+
+
+def property_columns(df):
+    """
+    Returns the names and values of the columns written as feature
+    properties: the OSM ID, as integer, and the numeric result columns.
+    """
+    names = [c for c in df.columns
+             if c == "OSM_ID" or np.issubdtype(df[c].dtype, np.number)]
+    values = [df[c].to_numpy(np.int64 if c == "OSM_ID" else np.float64)
+              for c in names]
+    return names, values
+
+
+def _json_numbers(values):
+    """
+    Formats numbers as JSON text: the shortest repr, and null for NaN and
+    infinite values.
+    """
+    text = ("%r\n" * len(values) % tuple(values.tolist())).split("\n")[:-1]
+    if values.dtype.kind == "f":
+        for i in np.flatnonzero(~np.isfinite(values)):
+            text[i] = "null"
+    return text
+
+
+def write_geojson(stream, network, df, name="emission_links",
+                  chunk_features=FEATURE_CHUNK):
+    """
+    Writes the links of 'df' that have a geometry in 'network' as a GeoJSON
+    FeatureCollection of MultiLineString features to a binary stream.
+    """
+    rows, link_offsets, links = link_geometry(network, df["OSM_ID"].values)
+    names, values = property_columns(df)
+    feature_template = ('{"type":"Feature","properties":{'
+                        + ",".join('"{0}":%s'.format(n) for n in names)
+                        + '},"geometry":{"type":"MultiLineString",'
+                        '"coordinates":[%s]}}')
+    stream.write('{{"type":"FeatureCollection","name":"{0}","features":[\n'
+                 .format(name).encode("utf-8"))
+    for start in range(0, len(rows), chunk_features):
+        stop = min(start + chunk_features, len(rows))
+        first, last = link_offsets[start], link_offsets[stop]
+        node_start, node_stop = links.offsets[first], links.offsets[last]
+        xy = np.column_stack((links.lon[node_start:node_stop],
+                              links.lat[node_start:node_stop]))
+        vertex = ("[%.7f,%.7f]\n" * len(xy) % tuple(xy.ravel())).split("\n")
+        offsets = links.offsets[first:last + 1] - node_start
+        line = ["[" + ",".join(vertex[offsets[i]:offsets[i + 1]]) + "]"
+                for i in range(last - first)]
+        properties = list(zip(*(_json_numbers(v[rows[start:stop]])
+                                for v in values)))
+        features = [feature_template % (properties[k - start] + (
+            ",".join(line[link_offsets[k] - first:link_offsets[k + 1] - first]),))
+            for k in range(start, stop)]
+        stream.write((",\n".join(features) + (",\n" if stop < len(rows)
+                                              else "\n")).encode("utf-8"))
+    stream.write(b"]}\n")
+
+
+def hilbert(x, y):
+    """
+    Returns the index along the Hilbert curve of the cells (x, y) of a
+    65536 x 65536 grid (arrays of integers), as used by FlatGeobuf to order
+    the features.
+    """
+    x = np.asarray(x, dtype=np.uint32)
+    y = np.asarray(y, dtype=np.uint32)
+    a = x ^ y
+    b = 0xFFFF ^ a
+    c = 0xFFFF ^ (x | y)
+    d = x & (y ^ 0xFFFF)
+    A = a | (b >> 1)
+    B = (a >> 1) ^ a
+    C = ((c >> 1) ^ (b & (d >> 1))) ^ c
+    D = ((a & (c >> 1)) ^ (d >> 1)) ^ d
+    for shift in (2, 4):
+        a, b, c, d = A, B, C, D
+        A = (a & (a >> shift)) ^ (b & (b >> shift))
+        B = (a & (b >> shift)) ^ (b & ((a ^ b) >> shift))
+        C = C ^ ((a & (c >> shift)) ^ (b & (d >> shift)))
+        D = D ^ ((b & (c >> shift)) ^ ((a ^ b) & (d >> shift)))
+    a, b, c, d = A, B, C, D
+    C = C ^ ((a & (c >> 8)) ^ (b & (d >> 8)))
+    D = D ^ ((b & (c >> 8)) ^ ((a ^ b) & (d >> 8)))
+    a = C ^ (C >> 1)
+    b = D ^ (D >> 1)
+    i0 = x ^ y
+    i1 = b | (0xFFFF ^ (i0 | a))
+    for shift, mask in ((8, 0x00FF00FF), (4, 0x0F0F0F0F), (2, 0x33333333),
+                        (1, 0x55555555)):
+        i0 = (i0 | (i0 << shift)) & mask
+        i1 = (i1 | (i1 << shift)) & mask
+    return (i1 << 1) | i0
+
+
+def hilbert_order(bounds, extent):
+    """
+    Returns the order of the bounding boxes 'bounds' (4 x n) along the
+    Hilbert curve of their centers in 'extent'.
+    """
+    size = np.maximum(np.array([extent[2] - extent[0],
+                                extent[3] - extent[1]]), 1e-12)
+    center_x = (bounds[0] + bounds[2]) / 2.
+    center_y = (bounds[1] + bounds[3]) / 2.
+    x = np.floor(0xFFFF * (center_x - extent[0]) / size[0])
+    y = np.floor(0xFFFF * (center_y - extent[1]) / size[1])
+    return np.argsort(hilbert(x, y), kind="stable")
+
+
+def packed_rtree(bounds, offsets, node_size=INDEX_NODE_SIZE):
+    """
+    Builds the packed R-tree of the bounding boxes 'bounds' (4 x n, in
+    Hilbert order), whose features are at the byte offsets 'offsets'.
+    Returns the array of NODE_ITEM nodes, root first and leaves last.
+    """
+    level_count = [len(offsets)]
+    while True:
+        level_count.append(-(-level_count[-1] // node_size))
+        if level_count[-1] == 1:
+            break
+    nodes = np.zeros(sum(level_count), dtype=NODE_ITEM)
+    # Start of every level in 'nodes', from the leaves up.
+    level_start = len(nodes) - np.cumsum(level_count)
+    leaves = nodes[level_start[0]:]
+    for i, field in enumerate(("min_x", "min_y", "max_x", "max_y")):
+        leaves[field] = bounds[i]
+    leaves["offset"] = offsets
+    for level in range(len(level_count) - 1):
+        children = nodes[level_start[level]:
+                         level_start[level] + level_count[level]]
+        first = np.arange(0, len(children), node_size)
+        parents = nodes[level_start[level + 1]:
+                        level_start[level + 1] + len(first)]
+        for field in ("min_x", "min_y"):
+            parents[field] = np.minimum.reduceat(children[field], first)
+        for field in ("max_x", "max_y"):
+            parents[field] = np.maximum.reduceat(children[field], first)
+        parents["offset"] = level_start[level] + first
+    return nodes
+
+
+# FlatBuffers encoding of the header. A table is a list of fields indexed as
+# in the schema: None (absent), (format, value) for a scalar, ("str", text),
+# ("vec", format, values) for a vector of scalars, ("table", fields) or
+# ("tables", [fields, ...]). The objects are laid out front to back: a table,
+# then the objects it refers to.
+def _flatbuffer_table(buffer, fields):
+    """
+    Appends a table to 'buffer' (bytearray), followed by the objects it
+    refers to. Returns the position of the table.
+    """
+    _align(buffer, 2)
+    vtable = len(buffer)
+    buffer.extend(bytes(4 + 2 * len(fields)))
+    _align(buffer, 4)
+    table = len(buffer)
+    buffer.extend(bytes(4))
+    slots, references = [0] * len(fields), []
+    for i, field in enumerate(fields):
+        if field is None:
+            continue
+        fmt = "<I" if field[0] in ("str", "vec", "table", "tables") \
+            else field[0]
+        _align(buffer, struct.calcsize(fmt))
+        slots[i] = len(buffer) - table
+        if fmt == field[0]:
+            buffer.extend(struct.pack(fmt, field[1]))
+        else:
+            references.append((len(buffer), field))
+            buffer.extend(bytes(4))
+    struct.pack_into("<HH%dH" % len(fields), buffer, vtable,
+                     4 + 2 * len(fields), len(buffer) - table, *slots)
+    struct.pack_into("<i", buffer, table, table - vtable)
+    for position, field in references:
+        _patch(buffer, position, _flatbuffer_object(buffer, field))
+    return table
+
+
+def _flatbuffer_object(buffer, field):
+    """
+    Appends a string, vector or table to 'buffer'; returns its position.
+    """
+    if field[0] == "table":
+        return _flatbuffer_table(buffer, field[1])
+    if field[0] == "str":
+        data = field[1].encode("utf-8") + b"\x00"
+        _align(buffer, 4)
+        position = len(buffer)
+        buffer.extend(struct.pack("<I", len(data) - 1) + data)
+        return position
+    if field[0] == "vec":
+        fmt, values = field[1], field[2]
+        _align(buffer, max(struct.calcsize(fmt), 4), 4)
+        position = len(buffer)
+        buffer.extend(struct.pack("<I%d%s" % (len(values), fmt[1:]),
+                                  len(values), *values))
+        return position
+    _align(buffer, 4)
+    position = len(buffer)
+    buffer.extend(struct.pack("<I", len(field[1])) + bytes(4 * len(field[1])))
+    for i, table in enumerate(field[1]):
+        _patch(buffer, position + 4 + 4 * i,
+               _flatbuffer_table(buffer, table))
+    return position
+
+
+def _align(buffer, alignment, extra=0):
+    """
+    Pads 'buffer' so that (its length + 'extra') is a multiple of
+    'alignment'.
+    """
+    buffer.extend(bytes(-(len(buffer) + extra) % alignment))
+
+
+def _patch(buffer, position, target):
+    struct.pack_into("<I", buffer, position, target - position)
+
+
+def flatgeobuf_header(name, extent, names, features_count, index_node_size):
+    """
+    Returns the size-prefixed FlatGeobuf header of a layer of
+    MultiLineString features in longitude/latitude (EPSG:4326).
+    """
+    columns = [[("str", n), ("<B", _LONG if n == "OSM_ID" else _DOUBLE)]
+               for n in names]
+    crs = [("str", "EPSG"), ("<i", 4326)]
+    fields = [("str", name), ("vec", "<d", list(extent)),
+              ("<B", _MULTILINESTRING), None, None, None, None,
+              ("tables", columns), ("<Q", features_count),
+              ("<H", index_node_size), ("table", crs)]
+    buffer = bytearray(4)
+    _patch(buffer, 0, _flatbuffer_table(buffer, fields))
+    return struct.pack("<I", len(buffer)) + bytes(buffer)
+
+
+def feature_sizes(vertex_count, part_count, column_count):
+    """
+    Returns the size, with its 4-byte size prefix, of the features encoded by
+    'write_flatgeobuf'.
+    """
+    return 60 + 16 * vertex_count + 4 * part_count + 10 * column_count
+
+
+def write_flatgeobuf(stream, network, df, name="emission_links",
+                     index_node_size=INDEX_NODE_SIZE,
+                     chunk_features=FEATURE_CHUNK):
+    """
+    Writes the links of 'df' that have a geometry in 'network' as a
+    FlatGeobuf layer of MultiLineString features to a binary stream, in
+    Hilbert order with a spatial index (unless 'index_node_size' is 0).
+
+    Every feature has the same layout: the Feature table (geometry and
+    properties), the Geometry table (ends and xy), the coordinates, the ends
+    of the parts, and the properties (column index and value of every
+    column).
+    """
+    rows, link_offsets, links = link_geometry(network, df["OSM_ID"].values)
+    names, values = property_columns(df)
+    vertex_count = links.offsets[link_offsets[1:]] \
+        - links.offsets[link_offsets[:-1]]
+    part_count = np.diff(link_offsets)
+    part_bounds = geometry.polyline_bounds(links.offsets, links.lon,
+                                           links.lat)
+    if len(rows):
+        # Empty parts have NaN bounds, which fmin and fmax ignore.
+        bounds = np.array([reduce.reduceat(part_bounds[i], link_offsets[:-1])
+                           for i, reduce in enumerate((np.fmin, np.fmin,
+                                                       np.fmax, np.fmax))])
+        extent = [bounds[0].min(), bounds[1].min(), bounds[2].max(),
+                  bounds[3].max()]
+    else:
+        bounds = np.empty((4, 0))
+        extent = [0., 0., 0., 0.]
+        # An index needs at least one feature.
+        index_node_size = 0
+
+    if index_node_size > 0:
+        order = hilbert_order(bounds, extent)
+    else:
+        order = np.arange(len(rows))
+    sizes = feature_sizes(vertex_count[order], part_count[order], len(names))
+    offsets = np.zeros(len(rows), dtype=np.int64)
+    np.cumsum(sizes[:-1], out=offsets[1:])
+
+    stream.write(FLATGEOBUF_MAGIC)
+    stream.write(flatgeobuf_header(name, extent, names, len(rows),
+                                   index_node_size))
+    if index_node_size > 0:
+        stream.write(packed_rtree(bounds[:, order], offsets,
+                                  index_node_size).tobytes())
+
+    # Properties: the column index and the value of every column.
+    property_dtype = np.dtype([(f, t) for i, v in enumerate(values)
+                               for f, t in (("c%d" % i, "<u2"),
+                                            ("v%d" % i, v.dtype.str))])
+    for start in range(0, len(rows), chunk_features):
+        chunk = order[start:start + chunk_features]
+        n, parts = vertex_count[chunk], part_count[chunk]
+        position = offsets[start:start + len(chunk)] - offsets[start]
+        data = np.zeros(sizes[start:start + len(chunk)].sum(), dtype=np.uint8)
+
+        # Everything up to the coordinates.
+        head = np.zeros(len(chunk), dtype=_FEATURE_HEAD)
+        head["size"] = sizes[start:start + len(chunk)] - 4
+        head["root"] = 12
+        head["feature_vtable"] = head["geometry_vtable"] = (8, 12, 4, 8)
+        head["feature_table"] = head["geometry_table"] = 8
+        head["geometry"] = 16
+        head["properties"] = 32 + 16 * n + 4 * parts
+        head["ends"] = 48 + 16 * n - 36
+        head["xy"] = 4
+        head["xy_length"] = 2 * n
+        _scatter(data, position, head)
+
+        # Coordinates, from the first node of every link.
+        node_start = links.offsets[link_offsets[chunk]]
+        first = np.zeros(len(chunk), dtype=np.int64)
+        np.cumsum(n[:-1], out=first[1:])
+        node = np.repeat(node_start - first, n) + np.arange(n.sum())
+        xy = np.empty(len(node), dtype=[("x", "<f8"), ("y", "<f8")])
+        xy["x"], xy["y"] = links.lon[node], links.lat[node]
+        _scatter(data, np.repeat(position + 52 - 16 * first, n)
+                 + 16 * np.arange(len(node)), xy)
+
+        # Number of parts and end of every part.
+        _scatter(data, position + 52 + 16 * n, parts.astype("<u4"))
+        first = np.zeros(len(chunk), dtype=np.int64)
+        np.cumsum(parts[:-1], out=first[1:])
+        part = np.repeat(link_offsets[chunk] - first, parts) \
+            + np.arange(parts.sum())
+        ends = links.offsets[part + 1] - np.repeat(node_start, parts)
+        _scatter(data, np.repeat(position + 56 + 16 * n - 4 * first, parts)
+                 + 4 * np.arange(len(part)), ends.astype("<u4"))
+
+        # Properties, at the end of the features.
+        properties = np.zeros(len(chunk), dtype=property_dtype)
+        for i, v in enumerate(values):
+            properties["c%d" % i] = i
+            properties["v%d" % i] = v[rows[chunk]]
+        property_position = position + sizes[start:start + len(chunk)] \
+            - property_dtype.itemsize
+        _scatter(data, property_position - 4,
+                 np.full(len(chunk), property_dtype.itemsize, dtype="<u4"))
+        _scatter(data, property_position, properties)
+        stream.write(data.tobytes())
+
+
+def _scatter(data, position, items):
+    """
+    Copies the bytes of every item of the array 'items' into the byte array
+    'data', at the positions 'position'.
+    """
+    width = items.dtype.itemsize
+    data[position[:, None] + np.arange(width)] = \
+        items.view(np.uint8).reshape(-1, width)
@@ -1,87 +1,435 @@
 import streamlit as st
 import pandas as pd
 import numpy as np
-import plotly.express as px
+# Streamlit already loads plotly.graph_objects; plotly.express and matplotlib
+# are imported by the features that use them.
 import plotly.graph_objects as go
-import matplotlib.pyplot as plt
-import matplotlib.colors as colors
-import matplotlib.cm as cmx
-from io import BytesIO
-import zipfile
+from plotly.colors import sample_colorscale, unlabel_rgb
 
+import calculator
+import engine
+import export
+import geometry
+import gridding
+import instrumentation
+import processing
+import queries
+import tiles
+import ui
+
+# Size of the rendered map, in pixels. With the zoom level, it sets the
+# extent of the view and the simplification tolerance.
+MAP_WIDTH_PX = 1200
+MAP_HEIGHT_PX = 800
+# Number of classes of the color scale of the interactive map. The map has one
+# line trace per class, whatever the number of links.
+MAP_COLOR_BINS = 8
+
+@st.fragment
 def render_analysis():
     """
     Renders the analysis tab, showing charts and key metrics.
-    Uses st.session_state['results_df'] (created in calculator.py).
+    Uses st.session_state['results_df'] (created in calculator.py). Its
+    widgets only rerun this fragment, whose stages are timed in a
+    Performance panel.
     """
+    with instrumentation.recording(ui.trace_memory()) as recorder:
+        _render_analysis()
+    ui.render_performance(recorder.to_dict())
+
+def _render_analysis():
     st.header("📈 Multi-Metric Analysis")
     st.markdown("Visualize emission results using interactive charts.")
 
+    with st.expander("📂 Load Saved Results"):
+        saved = st.file_uploader(
+            "Results file (.parquet, .feather, .npz, .csv, .zip)",
+            type=["parquet", "feather", "npz", "csv", "zip"],
+            key="saved_results")
+        if saved is not None and st.session_state.get('saved_results_id') != saved.file_id:
+            try:
+                with instrumentation.span("load_results"):
+                    df = export.load_results(saved)
+            except Exception as e:
+                st.error(f"Could not read the results file: {e}")
+            else:
+                calculator.store_results(df, [c[len('Total_'):] for c in df.columns if c.startswith('Total_')])
+                st.session_state.saved_results_id = saved.file_id
+                st.success(f"Loaded {len(df):,} links from '{saved.name}'.")
+
     if 'results_df' in st.session_state and not st.session_state['results_df'].empty:
-        df = st.session_state['results_df']
-        
+        import plotly.express as px
+
+        # Totals aggregated once per calculation (see summary.py).
+        if 'summary_cube' not in st.session_state:
+            with instrumentation.span("summary_cube"):
+                calculator.store_results(st.session_state['results_df'], st.session_state['selected_pollutants'])
+        cube = st.session_state['summary_cube']
+        if not cube.pollutants:
+            st.info("The results have no 'Total_' emission column to analyze.")
+            return
+
         # --- Key Metrics ---
         st.subheader("Global Emission Totals")
-        metric_cols = st.columns(len(st.session_state['selected_pollutants']))
-        
-        for i, poll in enumerate(st.session_state['selected_pollutants']):
-            # Assumes 'Total_{Pollutant}' columns are created in calculator.py
-            col_name = f'Total_{poll}'
-            if col_name in df.columns:
-                total_emission = df[col_name].sum()
-                unit = 'g' if poll != 'CO2' and poll != 'FC' else ('kg' if poll == 'CO2' else 'L')
-                
-                with metric_cols[i]:
-                    st.metric(
-                        label=f"Total {poll}",
-                        value=f"{total_emission:.2f} {unit}"
-                    )
-        
+        metric_cols = st.columns(len(cube.pollutants))
+
+        for i, poll in enumerate(cube.pollutants):
+            unit = 'g' if poll != 'CO2' and poll != 'FC' else ('kg' if poll == 'CO2' else 'L')
+            with metric_cols[i]:
+                st.metric(
+                    label=f"Total {poll}",
+                    value=f"{cube.total(poll):.2f} {unit}"
+                )
+
         st.markdown("---")
-        
-        # --- Breakdown by Vehicle Type (Example Chart) ---
+
+        # --- Breakdown by Vehicle Type ---
         st.subheader("Emission Breakdown by Vehicle Type")
-        
-        # Aggregate total emissions for each vehicle type/pollutant
-        # Example: ['PC_CO', 'LDV_CO', 'HDV_CO', 'Moto_CO', 'Total_CO']
-        
-        # Filter for the relevant total columns
-        cols_to_plot = [c for c in df.columns if any(vt in c for vt in ['PC_', 'LDV_', 'HDV_', 'Moto_']) and 'Total' in c]
-        
-        if cols_to_plot:
-            emission_totals = df[cols_to_plot].sum().reset_index()
-            emission_totals.columns = ['Metric', 'Value']
-            
-            # Parse the Metric name (e.g., 'PC_Total_CO' -> Type: PC, Pollutant: CO)
-            emission_totals['Vehicle Type'] = emission_totals['Metric'].apply(lambda x: x.split('_')[0])
-            emission_totals['Pollutant'] = emission_totals['Metric'].apply(lambda x: x.split('_')[-1])
 
+        emission_totals = cube.by_category()
+        if emission_totals['Value'].any():
             # Create an interactive stacked bar chart
-            fig = px.bar(
-                emission_totals,
-                x='Pollutant',
-                y='Value',
-                color='Vehicle Type',
-                title='Total Emissions Contribution by Vehicle Type and Pollutant',
-                height=500
-            )
-            st.plotly_chart(fig, use_container_width=True)
-            
+            with instrumentation.span("vehicle_type_chart", bars=len(emission_totals)):
+                fig = px.bar(
+                    emission_totals,
+                    x='Pollutant',
+                    y='Value',
+                    color='Vehicle Type',
+                    title='Total Emissions Contribution by Vehicle Type and Pollutant',
+                    height=500
+                )
+                st.plotly_chart(fig, use_container_width=True)
+
         else:
             st.warning("No calculated results found for vehicle type breakdown.")
 
+        # --- Breakdown by Road Class ---
+        if len(cube.road_classes) > 1:
+            st.subheader("Emission Breakdown by Road Class")
+            poll = st.selectbox("Pollutant", cube.pollutants, key='road_class_pollutant')
+            with instrumentation.span("road_class_chart", road_classes=len(cube.road_classes)):
+                fig = px.bar(
+                    cube.by_road_class(poll),
+                    x='Road Class',
+                    y='Value',
+                    color='Vehicle Type',
+                    title=f'Total {poll} Emissions by Road Class',
+                    height=500
+                )
+                st.plotly_chart(fig, use_container_width=True)
+            st.dataframe(pd.DataFrame({'Road Class': cube.road_classes, 'Links': cube.link_count,
+                                       'Length (km)': cube.length_km}), hide_index=True)
+
+        # --- Top Links ---
+        st.subheader("Top Emitting Links")
+        with instrumentation.span("top_links", links=len(st.session_state['results_df'])):
+            render_top_links(st.session_state['results_df'], 'analysis')
+
     else:
         st.info("Calculate emissions first in the 'Calculate Emissions' tab to view analysis.")
 
+def render_top_links(df, key, index=None):
+    """
+    Renders the links with the highest values of a results column, among
+    the rows 'index' of the results table if given (see queries.py).
+    """
+    columns = [c for c in df.columns if c not in ('OSM_ID', 'Length_km')]
+    c1, c2, c3 = st.columns([2, 1, 1])
+    column = c1.selectbox("Column", columns, key=f'{key}_top_column',
+                          index=next((i for i, c in enumerate(columns) if c.startswith('Total_')), 0))
+    n = c2.number_input("Number of links", min_value=1, max_value=10000, value=100, step=10,
+                        key=f'{key}_top_n')
+    per_km = c3.checkbox("Per km", key=f'{key}_top_per_km')
+    if index is not None:
+        df = df.iloc[index]
+    st.dataframe(queries.top_table(df, column, n, per_km), hide_index=True, use_container_width=True)
+
+@st.cache_resource(max_entries=2, show_spinner=False)
+def _cached_link_index(key, _network, _osm_id):
+    return queries.LinkIndex.from_network(_network, _osm_id)
+
+def render_region_query(network, df, osm_file, map_params):
+    """
+    Renders the totals and the top links inside a bounding box or a polygon,
+    through the grid index of the link geometries, built once per results
+    and network.
+    """
+    with st.expander("🔎 Region Totals and Top Links", expanded=False):
+        with instrumentation.span("link_index", links=len(df)):
+            index = _cached_link_index((calculator.results_version(), processing.network_key(osm_file, map_params)),
+                                       network, df['OSM_ID'].values)
+        lon_min, lon_max = float(np.min(network.lon)), float(np.max(network.lon))
+        lat_min, lat_max = float(np.min(network.lat)), float(np.max(network.lat))
+        shape = st.radio("Region", ["Bounding Box", "Polygon"], horizontal=True, key='region_shape')
+        if shape == "Bounding Box":
+            c1, c2, c3, c4 = st.columns(4)
+            box = (c1.number_input("Min Longitude", value=lon_min, format="%.5f", key='region_lon_min'),
+                   c2.number_input("Min Latitude", value=lat_min, format="%.5f", key='region_lat_min'),
+                   c3.number_input("Max Longitude", value=lon_max, format="%.5f", key='region_lon_max'),
+                   c4.number_input("Max Latitude", value=lat_max, format="%.5f", key='region_lat_max'))
+            within = st.checkbox("Only the links entirely inside the box", key='region_within')
+            with instrumentation.span("region_query") as span:
+                links = index.in_box(*box, within=within)
+                span.count(links=len(links))
+        else:
+            text = st.text_area("Polygon (one 'lon, lat' per line)", key='region_polygon',
+                                help="A link is inside if the center of its bounding box is.")
+            try:
+                polygon = engine.parse_polygon(text)
+            except ValueError as e:
+                st.error(f"Invalid polygon: {e}")
+                return
+            if polygon is None:
+                st.info("Enter the polygon of the region.")
+                return
+            with instrumentation.span("region_query") as span:
+                links = index.in_polygon(polygon)
+                span.count(links=len(links))
+
+        total_cols = [c for c in df.columns if c.startswith('Total_')]
+        st.dataframe(pd.DataFrame([queries.region_totals(df, links, total_cols)]), hide_index=True,
+                     use_container_width=True)
+        st.caption(f"{len(links):,} of {len(df):,} links in the region "
+                   f"({len(df) - index.located:,} without geometry).")
+        render_top_links(df, 'region', links)
+
+def fit_zoom(network):
+    """
+    Returns the center and the zoom level at which the whole network fits in
+    the map.
+    """
+    lon_min, lon_max = np.min(network.lon), np.max(network.lon)
+    lat_min, lat_max = np.min(network.lat), np.max(network.lat)
+    center_lat = (lat_min + lat_max) / 2.
+    width = max(lon_max - lon_min, (lat_max - lat_min) * MAP_WIDTH_PX / MAP_HEIGHT_PX
+                / np.cos(np.radians(center_lat)), 1e-6)
+    zoom = int(np.clip(np.floor(np.log2(MAP_WIDTH_PX * 360. / (256. * width))), 1, 18))
+    return (lon_min + lon_max) / 2., center_lat, zoom
+
+def map_level_of_detail(network, values, center_lon, center_lat, zoom):
+    """
+    Keeps the highways that intersect the view and simplifies them with the
+    tolerance of one pixel at this zoom level, so that the amount of drawn
+    geometry depends on the view and not on the size of the network.
+    Returns the view extent and the CSR geometry and values to draw.
+    """
+    pixel = 360. / (256. * 2. ** zoom)
+    half_width = MAP_WIDTH_PX / 2. * pixel
+    half_height = MAP_HEIGHT_PX / 2. * pixel * np.cos(np.radians(center_lat))
+    extent = (center_lon - half_width, center_lon + half_width,
+              center_lat - half_height, center_lat + half_height)
+    x_min, y_min, x_max, y_max = geometry.polyline_bounds(network.offsets, network.lon, network.lat)
+    visible = (x_max >= extent[0]) & (x_min <= extent[1]) & (y_max >= extent[2]) & (y_min <= extent[3]) \
+        & np.isfinite(values)
+    view = network.subset(visible)
+    offsets, lon, lat = geometry.simplify_polylines(view.offsets, view.lon, view.lat,
+                                                    geometry.pixel_size(zoom, center_lat))
+    return extent, offsets, lon, lat, values[visible]
+
+def draw_static_map(extent, offsets, lon, lat, values, label):
+    """
+    Draws the links colored by their values with a single LineCollection and
+    returns the figure.
+    """
+    import matplotlib.colors as colors
+    from matplotlib.collections import LineCollection
+    from matplotlib.figure import Figure
+
+    # A Figure without pyplot: nothing to close, no global state.
+    fig = Figure(figsize=(MAP_WIDTH_PX / 100., MAP_HEIGHT_PX / 100.), dpi=100)
+    ax = fig.subplots()
+    segments = np.split(np.column_stack([lon, lat]), offsets[1:-1]) if len(values) else []
+    positive = values[values > 0]
+    # A logarithmic scale when the values span several orders of magnitude.
+    if len(positive) and positive.max() > 100. * positive.min():
+        norm = colors.LogNorm(vmin=positive.min(), vmax=positive.max(), clip=True)
+    else:
+        norm = colors.Normalize(vmin=values.min() if len(values) else 0.,
+                                vmax=values.max() if len(values) else 1.)
+    collection = LineCollection(segments, array=values, cmap='YlOrRd', norm=norm, linewidths=1.2)
+    ax.add_collection(collection)
+    ax.set_xlim(extent[0], extent[1])
+    ax.set_ylim(extent[2], extent[3])
+    ax.set_aspect(1. / np.cos(np.radians((extent[2] + extent[3]) / 2.)))
+    ax.set_facecolor('#f4f4f4')
+    ax.set_xlabel("Longitude")
+    ax.set_ylabel("Latitude")
+    fig.colorbar(collection, ax=ax, label=label, shrink=0.8)
+    fig.tight_layout()
+    return fig
+
+def color_bins(values, n_bins=MAP_COLOR_BINS):
+    """
+    Splits the values into classes of (nearly) equal counts. Returns the
+    class of every value and the class edges.
+    """
+    edges = np.unique(np.quantile(values, np.linspace(0., 1., n_bins + 1))) if len(values) else np.array([0., 1.])
+    if len(edges) < 2:
+        edges = np.array([edges[0], edges[0] + 1.])
+    return np.clip(np.searchsorted(edges, values, side='right') - 1, 0, len(edges) - 2), edges
+
+def build_webgl_map(network, values, osm_ids, label, detail_zoom):
+    """
+    Builds the interactive map of the links colored by their values. The
+    geometry is simplified for the zoom level 'detail_zoom', then the links
+    of each color class are concatenated, NaN-separated, into one line
+    trace, so that the number of traces does not depend on the number of
+    links. A marker trace at the middle of every link carries the hover
+    labels and the color bar.
+    """
+    drawn = np.isfinite(values)
+    view = network.subset(drawn)
+    values, osm_ids = values[drawn], osm_ids[drawn]
+    center_lon, center_lat, zoom = fit_zoom(view)
+    offsets, lon, lat = geometry.simplify_polylines(view.offsets, view.lon, view.lat,
+                                                    geometry.pixel_size(detail_zoom, center_lat))
+    bins, edges = color_bins(values)
+    n_bins = len(edges) - 1
+    palette = sample_colorscale('YlOrRd', list(np.linspace(0.1, 1., n_bins)))
+
+    fig = go.Figure()
+    for i in range(n_bins):
+        in_bin = np.flatnonzero(bins == i)
+        if len(in_bin) == 0:
+            continue
+        count = offsets[in_bin + 1] - offsets[in_bin]
+        bin_offsets = np.zeros(len(in_bin) + 1, dtype=np.int64)
+        np.cumsum(count, out=bin_offsets[1:])
+        node = np.arange(bin_offsets[-1]) - np.repeat(bin_offsets[:-1], count) + np.repeat(offsets[in_bin], count)
+        x, y = geometry.nan_separated(bin_offsets, lon[node], lat[node])
+        # Single precision (below a meter) halves what is sent to the browser.
+        fig.add_trace(go.Scattermap(lon=x.astype(np.float32), lat=y.astype(np.float32), mode='lines', line=dict(width=2, color=palette[i]),
+                                    hoverinfo='skip', showlegend=False))
+
+    # Middle node of every link, for the hover labels and the color bar.
+    middle = (offsets[:-1] + offsets[1:]) // 2
+    tick_text = [f"{edges[i]:.3g} – {edges[i + 1]:.3g}" for i in range(n_bins)]
+    step_scale = []
+    for i, color in enumerate(palette):
+        step_scale += [[i / n_bins, color], [(i + 1) / n_bins, color]]
+    fig.add_trace(go.Scattermap(
+        lon=lon[middle].astype(np.float32), lat=lat[middle].astype(np.float32), mode='markers',
+        marker=dict(size=4, color=(bins + 0.5).astype(np.float32), cmin=0, cmax=n_bins, colorscale=step_scale,
+                    colorbar=dict(title=label, tickvals=np.arange(n_bins) + 0.5, ticktext=tick_text)),
+        customdata=np.column_stack([osm_ids, values]),
+        hovertemplate="OSM ID %{customdata[0]:.0f}<br>" + label + ": %{customdata[1]:.4g}<extra></extra>",
+        showlegend=False))
+    fig.update_layout(map=dict(style='open-street-map', center=dict(lon=center_lon, lat=center_lat), zoom=zoom),
+                      height=MAP_HEIGHT_PX * 3 // 4, margin=dict(l=0, r=0, t=0, b=0))
+    return fig, len(lon)
+
+@st.cache_resource(max_entries=4, show_spinner=False)
+def _cached_webgl_map(key, _network, _values, _label, detail_zoom):
+    return build_webgl_map(_network, _values, _network.osmid, _label, detail_zoom)
+
+def render_emission_grid(network, df):
+    """
+    Renders the gridded emissions of all pollutants as a heatmap, and offers
+    them for download as a binary raster.
+    """
+    with st.expander("🔲 Gridded Emissions (dispersion model input)", expanded=False):
+        if not st.checkbox("Compute emissions per grid cell", key="grid_emissions"):
+            return
+        total_cols = [c for c in df.columns if c.startswith('Total_')]
+        c1, c2 = st.columns(2)
+        metric = c1.radio("Grid Coordinates", ["Metric (m)", "Longitude/Latitude (°)"], horizontal=True) == "Metric (m)"
+        if metric:
+            cell_size = c2.number_input("Cell Size (m)", min_value=10.0, value=500.0, step=50.0)
+        else:
+            cell_size = c2.number_input("Cell Size (°)", min_value=0.0001, value=0.005, step=0.001, format="%.4f")
+
+        emissions, _ = network.align(df['OSM_ID'].values, df[total_cols].values)
+        grid = gridding.Grid.from_bounds(np.min(network.lon), np.min(network.lat),
+                                         np.max(network.lon), np.max(network.lat), cell_size, metric)
+        if grid.nx * grid.ny > 25_000_000:
+            st.warning(f"The grid would have {grid.nx} x {grid.ny} cells; please choose a larger cell size.")
+            return
+        with instrumentation.span("grid_emissions", cells=grid.nx * grid.ny):
+            values = gridding.grid_emissions(network.offsets, network.lon, network.lat, emissions, grid)
+
+        shown = st.selectbox("Pollutant to Display:", options=total_cols)
+        band = values[total_cols.index(shown)]
+        x, y = grid.cell_centers()
+        with np.errstate(divide='ignore'):
+            fig = go.Figure(go.Heatmap(x=x, y=y, z=np.where(band > 0, np.log10(band), np.nan),
+                                       colorscale='YlOrRd', colorbar=dict(title=f"log10 {shown}")))
+        fig.update_layout(height=600, xaxis_title="x (m)" if metric else "Longitude",
+                          yaxis_title="y (m)" if metric else "Latitude")
+        fig.update_yaxes(scaleanchor="x", scaleratio=1. if metric else 1. / np.cos(np.radians(grid.lat0)))
+        st.plotly_chart(fig, use_container_width=True)
+        st.caption(f"{grid.nx} x {grid.ny} cells; total {shown} on the grid: {band.sum():.4g}")
+
+        st.download_button(
+            label="Download Emission Grid (ESRI BIL raster, one band per pollutant)",
+            data=lambda: gridding.write_raster(grid, values, total_cols),
+            file_name="emission_grid.zip",
+            mime="application/zip",
+            key='download_emission_grid'
+        )
+
+def render_tile_map(network, values, label, selected_metric, default_zoom, workers):
+    """
+    Renders the map from a pyramid of pre-rendered PNG tiles, drawn once per
+    network, metric and color scale in a pool of processes and then served
+    from the disk cache.
+    """
+    drawn = np.isfinite(values)
+    view = network.subset(drawn)
+    bins, edges = color_bins(values[drawn])
+    palette = sample_colorscale('YlOrRd', list(np.linspace(0.1, 1., len(edges) - 1)))
+    # Matplotlib colors for the tile workers.
+    mpl_palette = [tuple(c / 255. for c in unlabel_rgb(color)) for color in palette]
+
+    c1, c2 = st.columns(2)
+    min_zoom = c1.slider("Minimum Tile Zoom", min_value=1, max_value=18, value=max(default_zoom - 1, 1))
+    max_zoom = c2.slider("Maximum Tile Zoom", min_value=min_zoom, max_value=18, value=min(default_zoom + 4, 18))
+    budget = tiles.budget_zoom(view, min_zoom, max_zoom, tiles.MAX_TILES)
+    if budget < min_zoom:
+        st.error(f"The network needs more than {tiles.MAX_TILES} tiles at zoom {min_zoom}: "
+                 "lower the minimum zoom, or use the WebGL map.")
+        return
+    if budget < max_zoom:
+        st.warning(f"The pyramid up to zoom {max_zoom} would need more than {tiles.MAX_TILES} tiles: "
+                   f"the tiles are rendered up to zoom {budget}.")
+        max_zoom = budget
+    key = tiles.tile_key(view, values[drawn], selected_metric, edges, palette)
+    n_tiles = tiles.count_tiles(view, min_zoom, max_zoom)
+    st.caption(f"Tile pyramid of {n_tiles} tiles (the tiles without roads are left blank), rendered with {workers} processes.")
+
+    progress_bar = st.progress(0., text="Rendering map tiles...")
+    url = tiles.render_pyramid(key, view, bins, mpl_palette, min_zoom, max_zoom, workers,
+                               progress=lambda f: progress_bar.progress(f, text="Rendering map tiles..."))
+    progress_bar.empty()
+
+    center_lon, center_lat, zoom = fit_zoom(view)
+    tick_text = [f"{edges[i]:.3g} – {edges[i + 1]:.3g}" for i in range(len(palette))]
+    fig = go.Figure(go.Scattermap(lon=[center_lon], lat=[center_lat], mode='markers',
+                                  marker=dict(size=0, opacity=0), hoverinfo='skip', showlegend=False))
+    fig.update_layout(map=dict(style='open-street-map', center=dict(lon=center_lon, lat=center_lat), zoom=zoom,
+                               layers=[dict(sourcetype='raster', source=[url], below='traces',
+                                            minzoom=min_zoom, maxzoom=max_zoom + 1)]),
+                      height=MAP_HEIGHT_PX * 3 // 4, margin=dict(l=0, r=0, t=0, b=0))
+    st.plotly_chart(fig, use_container_width=True)
+    st.markdown(" ".join(f"<span style='background:{color};padding:2px 8px;margin-right:4px'>{text}</span>"
+                         for color, text in zip(palette, tick_text)) + f" <em>{label}</em>",
+                unsafe_allow_html=True)
+
+@st.fragment
 def render_map(osm_file, map_params):
     """
-    Renders the interactive map tab.
-    Currently uses placeholder map logic since the full OSM processing is complex.
+    Renders the map tab: the road links of the OSM file, colored by the
+    selected emission metric. Its widgets only rerun this fragment, whose
+    stages are timed in a Performance panel.
     """
+    with instrumentation.recording(ui.trace_memory()) as recorder:
+        _render_map(osm_file, map_params)
+    ui.render_performance(recorder.to_dict())
+
+def _render_map(osm_file, map_params):
     st.header("🗺️ Interactive Map Visualization")
 
     if osm_file is None:
-        st.info("Please upload an OSM map file (.osm) in the sidebar to render the map.")
+        st.info("Please upload an OSM map file (.osm.pbf, .osm, .osm.bz2 or .osm.gz) in the sidebar to render the map.")
         return
     
     if 'results_df' not in st.session_state or st.session_state['results_df'].empty:
@@ -100,21 +448,71 @@ def render_map(osm_file, map_params):
         index=0 if default_cols else None
     )
 
-    if selected_metric:
-        st.warning(f"Map visualization is currently a placeholder. To integrate a real map, you need to process the OSM file ({osm_file.name}) and link the calculated {selected_metric} results back to the geographic coordinates (latitude/longitude) of each OSM_ID. This often requires libraries like OSMnx or custom GIS processing.")
-        
-        # --- Placeholder Map ---
-        # Display a simple, non-functional placeholder to show the intent
-        st.markdown("#### Placeholder Map Area")
-        st.image("https://via.placeholder.com/800x400.png?text=Interactive+Map+Placeholder", use_container_width=True)
-        st.caption("Imagine this map shows the road links colored by the selected emission metric's intensity.")
-    else:
+    if not selected_metric:
         st.info("No calculated metrics available to map.")
+        return
+
+    with st.spinner("Extracting road network..."), instrumentation.span("load_network") as span:
+        network = processing.load_network(osm_file, map_params)
+        span.count(ways=len(network))
+    if len(network) == 0:
+        st.warning("No road was found in the OSM file inside the study area.")
+        return
+
+    per_km = st.checkbox("Show emission intensity per km", value=True)
+    metric_values = df[selected_metric].values
+    if per_km:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            metric_values = metric_values / df['Length_km'].values
+    with instrumentation.span("align", links=len(df)):
+        values, unmatched = network.align(df['OSM_ID'].values, metric_values)
+    if len(unmatched):
+        st.caption(f"{len(unmatched)} of {len(df)} links have no geometry in the OSM file and are not drawn.")
+
+    label = f"{selected_metric} per km" if per_km else selected_metric
+    default_lon, default_lat, default_zoom = fit_zoom(network)
+    map_type = st.radio("Map Type", ["Interactive (WebGL)", "Pre-rendered Tiles", "Static Image"], horizontal=True,
+                        help="Pre-rendered tiles suit very large networks: they are drawn once and cached on disk.")
+
+    if map_type == "Interactive (WebGL)":
+        # The browser handles pan and zoom; the detail level sets how much
+        # geometry is sent to it.
+        detail_zoom = st.slider("Detail Level (zoom level of the geometry)", min_value=1, max_value=18,
+                                value=min(default_zoom + 2, 18))
+        # The figure is memoized on the results, network and settings.
+        with instrumentation.span("webgl_map") as span:
+            fig, n_vertices = _cached_webgl_map(
+                (calculator.results_version(), processing.network_key(osm_file, map_params), selected_metric, per_km),
+                network, values, label, detail_zoom)
+            span.count(vertices=n_vertices)
+        with instrumentation.span("plotly_chart"):
+            st.plotly_chart(fig, use_container_width=True)
+        st.caption(f"{int(np.isfinite(values).sum())} links drawn with {n_vertices} vertices after simplification.")
+    elif map_type == "Pre-rendered Tiles":
+        with instrumentation.span("tile_map"):
+            render_tile_map(network, values, label, selected_metric, default_zoom, int(map_params['ncore']))
+    else:
+        c1, c2, c3 = st.columns(3)
+        zoom = c1.slider("Zoom Level", min_value=1, max_value=18, value=default_zoom)
+        center_lon = c2.number_input("Center Longitude", value=float(default_lon), format="%.5f")
+        center_lat = c3.number_input("Center Latitude", value=float(default_lat), format="%.5f")
 
+        with instrumentation.span("static_map") as span:
+            extent, offsets, lon, lat, view_values = map_level_of_detail(network, values, center_lon, center_lat, zoom)
+            fig = draw_static_map(extent, offsets, lon, lat, view_values, label)
+            st.pyplot(fig)
+            span.count(links=len(view_values), vertices=len(lon))
+        st.caption(f"{len(view_values)} links in view, drawn with {len(lon)} vertices after simplification.")
 
-def render_downloads(methodology, selected_pollutants):
+    render_region_query(network, df, osm_file, map_params)
+    render_emission_grid(network, df)
+
+
+@st.fragment
+def render_downloads(methodology, selected_pollutants, osm_file=None, map_params=None):
     """
-    Creates the downloadable results package.
+    Creates the downloadable results package, and the GIS layers of the
+    links if an OSM file is given. Its widgets only rerun this fragment.
     """
     st.header("📥 Download Results")
 
@@ -122,12 +520,12 @@ def render_downloads(methodology, selected_pollutants):
         df = st.session_state['results_df']
         
         st.subheader("Download CSV Results")
-        
-        # 1. Download CSV
-        csv_data = df.to_csv(index=False).encode('utf-8')
+
+        # The files are written only when a button is clicked, in chunks, and
+        # kept on disk for the same results (see export.py).
         st.download_button(
             label="Download Emission Results CSV",
-            data=csv_data,
+            data=lambda: export.csv_export(df),
             file_name="emission_results.csv",
             mime="text/csv",
             key='download_csv',
@@ -135,46 +533,77 @@ def render_downloads(methodology, selected_pollutants):
         )
 
         st.markdown("---")
-        
-        # 2. Create ZIP Package
-        buffer = BytesIO()
-        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zf:
-            # Add the main CSV results
-            zf.writestr("emission_results.csv", csv_data)
-
-            # Add a metadata/report file
-            summary = (
-                f"Advanced Traffic Emission Analysis Report\n"
-                f"Methodology: {methodology}\n"
-                f"Pollutants Calculated: {', '.join(selected_pollutants)}\n"
-                f"Number of Road Links: {len(df)}\n"
-                f"Date Generated: {pd.Timestamp.now().strftime('%Y-%m-%d %H:%M:%S')}\n"
-                f"\n"
-                f"Note: This file is a key to the data in 'emission_results.csv'.\n"
-            )
-            zf.writestr("report_metadata.txt", summary.encode('utf-8'))
 
-        # Rewind the buffer to the start
-        buffer.seek(0)
+        # Metadata/report file of the ZIP package
+        summary = (
+            f"Advanced Traffic Emission Analysis Report\n"
+            f"Methodology: {methodology}\n"
+            f"Pollutants Calculated: {', '.join(selected_pollutants)}\n"
+            f"Number of Road Links: {len(df)}\n"
+            f"\n"
+            f"Note: This file is a key to the data in 'emission_results.csv'.\n"
+        )
 
         st.markdown("### ⬇️ Download Package")
         
         # Download button for the ZIP file
         st.download_button(
             label="Download Complete ZIP Report",
-            data=buffer,
+            data=lambda: export.zip_export(df, summary),
             file_name="traffic_emission_analysis.zip",
             mime="application/zip",
             key='download_zip_complete',
             use_container_width=True
         )
         
+        st.markdown("---")
+        st.markdown("### 🗃️ Columnar Formats")
+
+        # Typed binary files load much faster than CSV and can be loaded again
+        # in the analysis tab.
+        col1, col2 = st.columns(2)
+        with col1:
+            file_format = st.selectbox("Format", export.available_columnar_formats(),
+                                       key='columnar_format')
+        suffix, mime, compressions = export.COLUMNAR_FORMATS[file_format]
+        with col2:
+            compression = st.selectbox("Compression", compressions,
+                                       key='columnar_compression')
+        st.download_button(
+            label=f"Download Emission Results ({file_format})",
+            data=lambda: export.columnar_export(df, file_format, compression),
+            file_name="emission_results" + suffix,
+            mime=mime,
+            key='download_columnar',
+            use_container_width=True
+        )
+
+        st.markdown("---")
+        st.markdown("### 🌍 GIS Layers")
+
+        if osm_file is None:
+            st.info("Upload the OSM map file in the sidebar to export the links with their geometry.")
+        else:
+            gis_format = st.selectbox("Layer Format", list(export.GIS_FORMATS), key='gis_format',
+                                      help="FlatGeobuf files have a spatial index and open quickly in QGIS.")
+            suffix, mime, _ = export.GIS_FORMATS[gis_format]
+            st.download_button(
+                label=f"Download Emission Links ({gis_format})",
+                data=lambda: export.gis_export(df, processing.load_network(osm_file, map_params), gis_format),
+                file_name="emission_links" + suffix,
+                mime=mime,
+                key='download_gis',
+                use_container_width=True
+            )
+
         st.markdown("---")
         st.markdown("### 📚 Export Formats")
         st.info(f"""
         **Available Export Formats:**
         - **CSV**: Main results for spreadsheet applications (`emission_results.csv`)
         - **ZIP**: Complete analysis package (containing the CSV, metadata, and methodology details)
+        - **Parquet / Feather / NPZ**: Typed columnar results, fast to load again in Python or in the analysis tab
+        - **FlatGeobuf / GeoJSON**: Road links with their results, for QGIS and other GIS software (longitude/latitude, EPSG:4326)
         
         **Methodology Used:**
         The current download package is based on the **{methodology}** standard and includes data for **{', '.join(selected_pollutants)}**.